@@ -4,11 +4,13 @@ import datetime
 import time
 import os
 import logging
+import re
 import sys
 import threading
 import sqlite3
 
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
 
 """
 This is the dbfile.py (database file)
@@ -40,19 +42,33 @@ The following classes are provided:
   DBSQL() - An abstract SQLDatbase class. Largely wraps the Python API.
   DBSqlite3(DBQSL) - DBSQL for SQLite3. The __init__ method lets one specify the file.
   DBMySQLAuth() - An authentication object for MySQL. Allows host, database, user, password to
-                  be passed as a single parameter. Also holds a debug flag and a cached
-                  database connection that uses these authentication parameters.
+                  be passed as a single parameter. Also holds a debug flag and a pool of
+                  database connections that use these authentication parameters.
+  ConnectionPool() - A bounded pool of connections, shared by the threads of a process.
 
   DBMySQL(DBSQL) - DBSQL for MySQL. Includes logic for retrying, and a class method
                    that makes INSERT and SELECT an automic operation with automatic retry.
                  - *many* functions in this should probably be migrated to DBSQL().
 
+Rows can be loaded in batches with bulk_insert(), which is available on DBSqlite3 and DBMySQL objects.
+With MySQL, check a connection out of the auth's pool for it:
+
+  with auth.pool.connection() as db:
+      db.bulk_insert('table', ['col1', 'col2'], rows)
+
 The main DBMySQL class method that we use is:
 
   DBMySQL.csfr(auth, cmd, vals, quiet, rowcount, time_zone, get_column_names, asDicts, debug)
   
   "Connect, Select, FetchAll, Retry"
 
+Read-only lookups that are repeated often can pass cache=True (or a TTL in seconds) to csfr()
+to be answered from a QueryCache. Writes made through csfr() and bulk_insert() invalidate the
+cached results for the tables they write; writes by other processes are seen when the TTL expires.
+
+Large SELECTs can be read with DBMySQL.csfr_stream(), which generates the rows as they
+arrive from the server instead of returning a list of all of them.
+
 cmd - Statements should use "%s" for substituted arguments; this is turned to ? for SQLite3
     - Use INSERT IGNORE; this is turned to "INSERT OR IGNORE" for MySQL
 
@@ -90,6 +106,19 @@ MYSQL_PASSWORD = 'MYSQL_PASSWORD'
 MYSQL_DATABASE = 'MYSQL_DATABASE'
 
 
+POOL_MAX_SIZE = 16              # most connections that one process opens with one DBMySQLAuth
+POOL_IDLE_TIMEOUT = 300         # close connections that have been idle for longer than this
+POOL_PING_AFTER = 30            # ping connections that have been idle for longer than this on checkout
+POOL_WAIT_TIMEOUT = 60          # how long checkout waits for a connection when the pool is full
+
+STREAM_FETCH_ROWS = 1000        # rows read from the server at a time by csfr_stream()
+DICTIONARY_MAX_FRACTION = 0.5   # dictionary-encode string columns with at most this fraction of distinct values
+BULK_INSERT_ROWS = 1000         # most rows in one bulk_insert() batch
+BULK_INSERT_BYTES = 1024*1024   # send a bulk_insert() batch once its values are about this large
+
+QUERY_CACHE_TTL = 60            # seconds that csfr(cache=True) results are kept
+QUERY_CACHE_ENTRIES = 10000     # bound on the process-wide query result cache
+
 CACHE_SIZE = 2000000
 SQL_SET_CACHE = "PRAGMA cache_size = {};".format(CACHE_SIZE)
 
@@ -101,6 +130,297 @@ def hostname():
     """Hostname without domain"""
     return socket.gethostname().partition('.')[0]
 
+def value_bytes(v):
+    """Rough size of a value in an INSERT statement"""
+    if isinstance(v, (str, bytes, bytearray)):
+        return len(v) + 3
+    return 8
+
+def insert_batches(rows, batch_rows=BULK_INSERT_ROWS, batch_bytes=BULK_INSERT_BYTES):
+    """Group an iterable of rows into lists of at most batch_rows rows and about batch_bytes bytes"""
+    batch = []
+    size = 0
+    for row in rows:
+        batch.append(row)
+        size += sum(value_bytes(v) for v in row)
+        if len(batch) >= batch_rows or size >= batch_bytes:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+def mysql_errors():
+    """Return the errors module of whichever MySQL connector is installed"""
+    try:
+        import mysql.connector.errors as errors
+    except ImportError as e:
+        import pymysql.err as errors
+    return errors
+
+def stream_chunks(c, names, *, asDicts, chunk_rows, fetch_rows):
+    """Generate the rows of a cursor, or lists of up to chunk_rows rows, reading fetch_rows at a time"""
+    while True:
+        rows = c.fetchmany(chunk_rows or fetch_rows)
+        if not rows:
+            return
+        if asDicts:
+            rows = [OrderedDict(zip(names, row)) for row in rows]
+        if chunk_rows:
+            yield rows
+        else:
+            yield from rows
+
+def numpy_column(values, interned):
+    """Convert one column of a chunk of rows to a numpy array.
+    Integers become int64 (float64 if there are NULLs), floats become float64 with NULL as NaN,
+    and dates and times become datetime64. Strings are kept in an object array, but each distinct
+    string is stored once, using the interned dictionary that is shared by the chunks of the column."""
+    import numpy as np
+    kinds = {type(v) for v in values if v is not None}
+    nulls = any(v is None for v in values)
+    try:
+        if kinds == {bool} and not nulls:
+            return np.array(values, dtype=bool)
+        if kinds and kinds <= {int, bool} and not nulls:
+            return np.array(values, dtype=np.int64)
+        if kinds and kinds <= {int, bool, float}:
+            return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+        if kinds == {datetime.datetime} and all(v is None or v.tzinfo is None for v in values):
+            return np.array(values, dtype='datetime64[us]')
+        if kinds == {datetime.date}:
+            return np.array(values, dtype='datetime64[D]')
+    except OverflowError as e:
+        pass                    # integers too large for int64
+    if kinds == {str}:
+        values = [v if v is None else interned.setdefault(v, v) for v in values]
+    a = np.empty(len(values), dtype=object)
+    a[:] = values
+    return a
+
+def fetch_columns(c, format, fetch_rows=STREAM_FETCH_ROWS):
+    """Read the rest of a cursor's result into typed columns, fetch_rows rows at a time, so that only
+    one chunk of rows is held as Python tuples.
+    @param format - 'numpy' returns an OrderedDict of column name to numpy array, which
+                    pandas.DataFrame() accepts directly.
+                  - 'arrow' returns a pyarrow.Table, with dictionary-encoded string columns
+                    when no more than DICTIONARY_MAX_FRACTION of the values are distinct.
+    """
+    if format not in ('numpy','arrow'):
+        raise ValueError(f"unknown result format {format!r}; expecting 'numpy' or 'arrow'")
+    names = [d[0] for d in c.description]
+    chunks = [[] for name in names]
+    if format=='numpy':
+        import numpy as np
+        interned = [dict() for name in names]
+        for rows in stream_chunks(c, names, asDicts=False, chunk_rows=fetch_rows, fetch_rows=fetch_rows):
+            for (n, values) in enumerate(zip(*rows)):
+                chunks[n].append(numpy_column(list(values), interned[n]))
+        return OrderedDict((name, np.concatenate(parts) if len(parts)>1 else
+                            parts[0] if parts else np.empty(0, dtype=object))
+                           for (name, parts) in zip(names, chunks))
+    else:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        for rows in stream_chunks(c, names, asDicts=False, chunk_rows=fetch_rows, fetch_rows=fetch_rows):
+            for (n, values) in enumerate(zip(*rows)):
+                chunks[n].append(pa.array(values))
+        columns = []
+        for parts in chunks:
+            types = {part.type for part in parts} - {pa.null()}
+            if len(types)==1:
+                # chunks that are all NULL have the null type
+                target = types.pop()
+                parts = [part.cast(target) if part.type == pa.null() else part for part in parts]
+            try:
+                column = pa.chunked_array(parts, type=None if parts else pa.null())
+            except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as e:
+                # chunks inferred different types, such as int64 and double
+                column = pa.chunked_array([pa.array([v for part in parts for v in part.to_pylist()])])
+            if (pa.types.is_string(column.type) and len(column) > 0 and
+                pc.count_distinct(column).as_py() <= DICTIONARY_MAX_FRACTION * len(column)):
+                column = column.dictionary_encode()
+            columns.append(column)
+        return pa.table(columns, names=names)
+
+READ_VERBS  = ['SELECT','DESCRIBE','DESC','SHOW','EXPLAIN']   # csfr() fetches and can cache their rows
+WRITE_VERBS = ['INSERT','REPLACE','UPDATE','DELETE','TRUNCATE','ALTER','DROP','CREATE','RENAME','LOAD','CALL']
+TABLE_RE    = r"([`\"\w.]+)"
+SQL_TOKEN_RE = re.compile(r"'(?:[^'\\]|\\.)*'|(?:`[^`]*`|\"[^\"]*\"|[\w.$])+|\S")
+IDENTIFIER_RE = re.compile(r"(?:`[^`]*`|\"[^\"]*\"|[\w.$])+")
+FROM_LIST_END = {'WHERE','GROUP','HAVING','ORDER','LIMIT','UNION','WINDOW','FOR','LOCK','INTO','PROCEDURE'}
+JOIN_WORDS    = {'JOIN','STRAIGHT_JOIN'}
+WRITE_TABLES_RE = re.compile(r"(?:\bINTO|^\s*UPDATE(?:\s+IGNORE)?|\bFROM|\bJOIN|\bTABLE(?:\s+IF\s+(?:NOT\s+)?EXISTS)?|^\s*TRUNCATE(?!\s+TABLE\b))\s+"
+                             + TABLE_RE, re.I)
+
+def table_name(identifier):
+    """Return the lower-case table name in an identifier, without the database or quotes"""
+    return identifier.split('.')[-1].strip('`"').lower()
+
+def table_names(regex, cmd):
+    """Return the set of lower-case table names, without the database, that regex finds in cmd"""
+    return {table_name(m.group(1)) for m in regex.finditer(cmd)}
+
+def read_tables(cmd):
+    """Return the set of lower-case table names that a read statement reads, or None if they cannot be
+    found reliably. Every FROM list is parsed, so comma joins, JOINs and subqueries are all included;
+    a name that is not a table (such as the column in EXTRACT(YEAR FROM d)) only costs an extra invalidation."""
+    tokens = SQL_TOKEN_RE.findall(cmd)
+    verb = tokens[0].upper() if tokens else ''
+    if verb == 'SHOW':
+        return None
+    tables = set()
+    if verb in ['DESCRIBE','DESC','EXPLAIN'] and len(tokens) > 1 and tokens[1].upper() not in READ_VERBS:
+        if not IDENTIFIER_RE.fullmatch(tokens[1]):
+            return None
+        tables.add(table_name(tokens[1]))
+    for (k, token) in enumerate(tokens):
+        if token.upper() != 'FROM':
+            continue
+        # Split the FROM list into the table references between its commas and JOINs
+        (depth, piece, pieces) = (0, [], [])
+        for token in tokens[k+1:]:
+            if depth == 0 and (token in [')',';'] or token.upper() in FROM_LIST_END):
+                break
+            if depth == 0 and (token == ',' or token.upper() in JOIN_WORDS):
+                pieces.append(piece)
+                piece = []
+                continue
+            depth += (token == '(') - (token == ')')
+            piece.append(token)
+        pieces.append(piece)
+        for piece in pieces:
+            if piece[:1] == ['('] and len(piece) > 1 and piece[1].upper() == 'SELECT':
+                continue        # a subquery; its own FROM is parsed in turn
+            if not piece or not IDENTIFIER_RE.fullmatch(piece[0]):
+                return None     # such as a parenthesized join
+            tables.add(table_name(piece[0]))
+    return tables
+
+ANY_TABLE = '*'                     # the tag of cache entries whose tables are not known
+
+class QueryCache:
+    """A bounded LRU cache of SELECT results for csfr(cache=...).
+    Entries are keyed by a scope (the database), the SQL with its whitespace normalized, the
+    parameter values and anything else that changes the result. Each entry has its own TTL.
+    When csfr() or bulk_insert() writes a table in this process, the entries that read it are
+    invalidated; a write to a table that cannot be parsed out of the SQL invalidates the scope, and an
+    entry whose tables cannot be parsed out of its SQL is invalidated by every write in its scope.
+    Writes by other processes are only seen when entries expire."""
+
+    def __init__(self, max_entries=QUERY_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()        # key -> (expires, tables, value)
+        self.tables  = defaultdict(set)     # (scope, table) -> keys that read it
+        self.lock = threading.Lock()
+        self.generation = 0                 # incremented by each invalidation
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(scope, cmd, vals, *extra):
+        return (scope, " ".join(cmd.split()), tuple(vals) if vals else (), extra)
+
+    def get(self, key):
+        """Return (True, value) for a live entry, or (False, None)"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return (False, None)
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return (True, entry[2])
+
+    def _remove(self, key):
+        (expires, tables, value) = self.entries.pop(key)
+        for table in tables:
+            self.tables[(key[0], table)].discard(key)
+            if not self.tables[(key[0], table)]:
+                del self.tables[(key[0], table)]
+
+    def put(self, key, value, ttl, tables, generation):
+        """Cache value for ttl seconds, unless something was invalidated since generation was read.
+        @param tables - the tables that value was read from, or None if they are not known
+        """
+        if tables is None:
+            tables = {ANY_TABLE}
+        with self.lock:
+            if generation != self.generation:
+                return
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.time() + ttl, tables, value)
+            for table in tables:
+                self.tables[(key[0], table)].add(key)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate_table(self, scope, table):
+        with self.lock:
+            self.generation += 1
+            keys = self.tables.get((scope, table.lower()), set()) | self.tables.get((scope, ANY_TABLE), set())
+            for key in list(keys):
+                self._remove(key)
+                self.invalidations += 1
+
+    def invalidate_scope(self, scope):
+        with self.lock:
+            self.generation += 1
+            for key in [key for key in self.entries if key[0]==scope]:
+                self._remove(key)
+                self.invalidations += 1
+
+    def invalidate_cmd(self, scope, cmd):
+        """Invalidate what a statement may have changed, if it is a write"""
+        if cmd.split()[0].upper() not in WRITE_VERBS:
+            return
+        tables = table_names(WRITE_TABLES_RE, cmd)
+        if not tables:
+            self.invalidate_scope(scope)
+        for table in tables:
+            self.invalidate_table(scope, table)
+
+    def cached(self, scope, ttl, cmd, vals, get_column_names, run, *extra):
+        """Return a copy of the cached result of a SELECT, or call run(names) to compute it and cache that.
+        The rows are copied too, both when they are computed and on every hit.
+        run() fills names with the column names, which are returned through get_column_names on a hit."""
+        key = self.key(scope, cmd, vals, *extra)
+        (found, value) = self.get(key)
+        if not found:
+            generation = self.generation
+            names = []
+            value = (names, run(names))
+            self.put(key, value, ttl, read_tables(cmd), generation)
+        (names, result) = value
+        if get_column_names is not None:
+            get_column_names[:] = names
+        return [self.copy_row(row) for row in result]
+
+    @staticmethod
+    def copy_row(row):
+        """Copy a mutable row (a dictionary or list), so that a caller that changes it does not change the cache"""
+        if isinstance(row, dict):
+            return type(row)(row)
+        if isinstance(row, list):
+            return list(row)
+        return row
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.tables.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries),
+                    'invalidations': self.invalidations}
+
+
+query_cache = QueryCache()
+
 from abc import ABC, abstractmethod
 class DBSQL(ABC):
     def __init__(self,dicts=True,debug=False):
@@ -149,18 +469,68 @@ class DBSQL(ABC):
                     print("Error:",e,file=sys.stderr)
                     exit(1)
 
-    def execselect(self, sql, vals=()):
-        """Execute a SQL query and return the first line"""
+    def execselect(self, sql, vals=(), *, format=None):
+        """Execute a SQL query and return the first line.
+        @param format - 'numpy' or 'arrow' to return all of the rows as columns instead; see fetch_columns()
+        """
         c = self.conn.cursor()
         c.execute(sql, vals)
+        if format is not None:
+            return fetch_columns(c, format)
         return c.fetchone()
 
+    def bulk_insert(self, table, columns, rows, *, ignore=False,
+                    batch_rows=BULK_INSERT_ROWS, batch_bytes=BULK_INSERT_BYTES):
+        """Insert rows into table in batches, and return the number of rows sent.
+        Each batch is inserted in a single transaction. A batch that fails with a transient error
+        (a lost connection, a lock or a deadlock) is rolled back and retried as a unit.
+        @param table   - the table
+        @param columns - the names of the columns
+        @param rows    - an iterable of sequences of values, one for each column. It may be a generator.
+        @param ignore  - True to skip rows that duplicate a unique key (INSERT IGNORE)
+        @param batch_rows  - most rows in one batch
+        @param batch_bytes - a batch is sent once its values add up to about this many bytes
+        """
+        count = 0
+        for batch in insert_batches(rows, batch_rows, batch_bytes):
+            for i in range(1,RETRIES):
+                try:
+                    self.insert_batch(table, columns, batch, ignore=ignore)
+                    break
+                except Exception as e:
+                    if not self.transient_error(e) or i==RETRIES-1:
+                        raise
+                    logging.warning(f"{type(e).__name__}: {e}. RETRYING batch {i}/{RETRIES}: {table} {len(batch)} rows")
+                    self.recover(e)
+                    time.sleep(RETRY_DELAY_TIME)
+            count += len(batch)
+            (cache, scope) = self.cache_scope()
+            cache.invalidate_table(scope, table)
+        return count
+
+    @abstractmethod
+    def cache_scope(self):
+        """Return the QueryCache for this database and the scope of its entries"""
+
+    @abstractmethod
+    def insert_batch(self, table, columns, batch, *, ignore=False):
+        """Insert a list of rows in one transaction"""
+
+    def transient_error(self, e):
+        """Return True if a batch that raised e may succeed if it is retried"""
+        return False
+
+    def recover(self, e):
+        """Called before a batch that raised e is retried"""
+        pass
+
     def close(self):
         self.conn.close()
 
 class DBSqlite3(DBSQL):
     def __init__(self,fname=None,*args,**kwargs):
         super().__init__(*args, **kwargs)
+        self.query_cache = QueryCache()
         try:
             self.conn = sqlite3.connect(fname)
             if self.dicts:
@@ -170,17 +540,51 @@ class DBSqlite3(DBSQL):
             print(f"Cannot open database file: {fname}")
             exit(1)
 
+    def csfr_stream(self, auth, cmd, vals=[], *, get_column_names=None, asDicts=False,
+                    chunk_rows=None, fetch_rows=STREAM_FETCH_ROWS, debug=False):
+        """Generate the rows of a SELECT as they are read, like DBMySQL.csfr_stream()"""
+        assert auth is None
+        cmd = cmd.replace("%s","?")
+        if debug or self.debug:
+            print(f"PID{os.getpid()}: cmd:{cmd} vals:{vals}",file=sys.stderr)
+        c = self.conn.cursor()
+        c.execute(cmd, vals)
+        names = [d[0] for d in c.description]
+        if get_column_names is not None:
+            get_column_names[:] = names
+        try:
+            yield from stream_chunks(c, names, asDicts=asDicts, chunk_rows=chunk_rows, fetch_rows=fetch_rows)
+        finally:
+            c.close()
+
     def set_cache_bytes(self,b):
         self.execute(f"PRAGMA cache_size = {-b/1024}") # negative numbers are multiples of 1024
 
+    def cache_scope(self):
+        return (self.query_cache, None)
+
+    def insert_batch(self, table, columns, batch, *, ignore=False):
+        sql = "INSERT {}INTO {} ({}) VALUES ({})".format("OR IGNORE " if ignore else "", table,
+                                                         ",".join(columns), ",".join(["?"]*len(columns)))
+        with self.conn:         # commits, or rolls back if executemany raises
+            self.conn.executemany(sql, batch)
+
+    def transient_error(self, e):
+        return isinstance(e, sqlite3.OperationalError) and ('locked' in str(e) or 'busy' in str(e))
+
     # For sqlite3, csfr doesn't need to be a static method, because we don't disconnect from the database
     # Notice that we try to keep API compatiability, but we lose 'auth'. We also change '%s' into '?'
     def csfr(self, auth, cmd,vals=[],quiet=True, rowcount=None, time_zone=None,
-             get_column_names=None, asDicts=False, debug=False, cache=True):
+             get_column_names=None, asDicts=False, debug=False, cache=False, format=None):
+        """@param cache - True or a TTL in seconds to answer a SELECT from self.query_cache; see QueryCache"""
         assert auth is None
         assert get_column_names is None # not implemented yet
         cmd = cmd.replace("%s","?")
         cmd = cmd.replace("INSERT IGNORE","INSERT OR IGNORE")
+        if cache and format is None and cmd.split()[0].upper() in READ_VERBS:
+            return self.query_cache.cached(
+                None, QUERY_CACHE_TTL if cache is True else cache, cmd, vals, None,
+                lambda names: self.csfr(auth, cmd, vals, quiet=quiet, debug=debug, cache=False))
 
         if quiet==False:
             print(f"PID{os.getpid()}: cmd:{cmd} vals:{vals}")
@@ -194,29 +598,204 @@ class DBSqlite3(DBSQL):
             print(f"vals: {vals}",file=sys.stderr)
             print(str(e),file=sys.stderr)
             raise RuntimeError("Invalid SQL")
+        self.query_cache.invalidate_cmd(None, cmd)
 
         verb = cmd.split()[0].upper()
         if verb in ['INSERT','DELETE','UPDATE']:
             return
-        elif verb in ['SELECT','DESCRIBE','SHOW']:
+        elif verb in READ_VERBS:
+            if format is not None:
+                return fetch_columns(c, format)
             return c.fetchall()
         else:
             raise RuntimeError(f"Unknown SQLite3 verb '{verb}'")
 
 
+class ConnectionPool:
+    """A bounded pool of database connections, shared by the threads of a process.
+    A connection is checked out for one query and checked in when the query is done.
+    At most max_size connections are open at once; checkout waits for one to be checked in
+    when they are all in use. Connections idle for longer than idle_timeout are closed, and a
+    connection idle for longer than ping_after is pinged on checkout and replaced if it is dead.
+    The pool is discarded in a child process after a fork."""
+
+    def __init__(self, connect, *, max_size=POOL_MAX_SIZE, idle_timeout=POOL_IDLE_TIMEOUT,
+                 ping_after=POOL_PING_AFTER, wait_timeout=POOL_WAIT_TIMEOUT):
+        """
+        @param connect - function that returns a new connection, which has ping() and close() methods.
+        """
+        self.connect = connect
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.ping_after = ping_after
+        self.wait_timeout = wait_timeout
+        self.cond = threading.Condition()
+        self.idle = []              # (db, time checked in), most recently used last
+        self.size = 0               # connections open or being opened, idle or checked out
+        self.pid = os.getpid()
+        self.counters = {'checkouts': 0, 'connects': 0, 'pings': 0, 'stale': 0, 'reaped': 0,
+                         'discarded': 0, 'waits': 0, 'wait_time': 0.0, 'max_wait': 0.0, 'peak_in_use': 0}
+
+    def _check_pid(self):
+        if self.pid != os.getpid():
+            # The parent owns the sockets; closing them here would close its sessions.
+            self.idle = []
+            self.size = 0
+            self.pid = os.getpid()
+
+    def _expired(self, now):
+        """Remove and return the connections that have been idle too long. Call with the lock held."""
+        n = 0
+        while n < len(self.idle) and now - self.idle[n][1] > self.idle_timeout:
+            n += 1
+        expired = [db for (db, _) in self.idle[0:n]]
+        del self.idle[0:n]
+        self.size -= n
+        self.counters['reaped'] += n
+        return expired
+
+    @staticmethod
+    def _close(dbs):
+        for db in dbs:
+            try:
+                db.close()
+            except Exception as e:
+                logging.debug("close: %s", e)
+
+    def _opened(self):
+        """Open a connection for a slot that has already been counted in self.size"""
+        try:
+            db = self.connect()
+        except BaseException:
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            raise
+        with self.cond:
+            self.counters['connects'] += 1
+        return db
+
+    def _available(self):
+        return self.idle or self.size < self.max_size
+
+    def _take(self, t0, waited):
+        """Take an idle connection as (db, time checked in), or a slot for a new one as (None, None).
+        Call with the lock held when _available() is true."""
+        if waited:
+            wait = time.time() - t0
+            self.counters['waits'] += 1
+            self.counters['wait_time'] += wait
+            self.counters['max_wait'] = max(self.counters['max_wait'], wait)
+        if self.idle:
+            (db, last) = self.idle.pop()
+        else:
+            (db, last) = (None, None)
+            self.size += 1
+        self.counters['checkouts'] += 1
+        self.counters['peak_in_use'] = max(self.counters['peak_in_use'], self.size - len(self.idle))
+        return (db, last)
+
+    def _timeout(self, timeout):
+        """Count a checkout that waited too long, and return the exception for it. Call with the lock held."""
+        self.counters['waits'] += 1
+        return TimeoutError(f"no database connection available after {timeout}s ({self.size} in use)")
+
+    def _stale(self, db, last):
+        """Return True if db has been idle long enough to need a ping"""
+        if time.time() - last <= self.ping_after:
+            return False
+        with self.cond:
+            self.counters['pings'] += 1
+        return True
+
+    def _replace(self, db):
+        with self.cond:
+            self.counters['stale'] += 1
+        self._close([db])
+
+    def checkout(self, timeout=None):
+        """Return a connection, waiting up to timeout seconds (default wait_timeout) if the pool is full"""
+        timeout = self.wait_timeout if timeout is None else timeout
+        t0 = time.time()
+        with self.cond:
+            self._check_pid()
+            expired = self._expired(t0)
+            waited = False
+            while not self._available():
+                remaining = t0 + timeout - time.time()
+                if remaining <= 0:
+                    raise self._timeout(timeout)
+                waited = True
+                self.cond.wait(remaining)
+            (db, last) = self._take(t0, waited)
+        self._close(expired)
+        if db is None:
+            return self._opened()
+        if self._stale(db, last) and not db.ping():
+            self._replace(db)
+            return self._opened()
+        return db
+
+    def checkin(self, db, discard=False):
+        """Return a connection to the pool. If discard is True, the connection is closed instead,
+        for example because a query on it failed with a connection error."""
+        with self.cond:
+            if self.pid != os.getpid():
+                return
+            if discard:
+                self.size -= 1
+                self.counters['discarded'] += 1
+            else:
+                self.idle.append((db, time.time()))
+            expired = self._expired(time.time())
+            self.cond.notify()
+        self._close(expired + ([db] if discard else []))
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the body of a with statement.
+        The connection is discarded if the body raises an exception."""
+        db = self.checkout()
+        try:
+            yield db
+        except BaseException:
+            self.checkin(db, discard=True)
+            raise
+        self.checkin(db)
+
+    def clear(self):
+        """Close the idle connections. Connections that are checked out are not affected."""
+        with self.cond:
+            self._check_pid()
+            idle = [db for (db, _) in self.idle]
+            self.size -= len(idle)
+            self.idle = []
+            self.cond.notify_all()
+        self._close(idle)
+
+    def stats(self):
+        """Return a dictionary of pool usage statistics"""
+        with self.cond:
+            ret = dict(self.counters)
+            ret.update({'size': self.size, 'idle': len(self.idle), 'in_use': self.size - len(self.idle),
+                        'max_size': self.max_size})
+        return ret
+
+
 class DBMySQLAuth:
-    """Class that represents MySQL credentials. Will cache the
-connection. If run under bottle, the bottle object can be passed in,
-and cached_db is stored in the request-local storage."""
+    """Class that represents MySQL credentials. Holds a ConnectionPool of
+connections that use them, which is shared by all of the threads in the process."""
 
-    def __init__(self,*,host,database,user,password,bottle=None,debug=False):
+    def __init__(self,*,host,database,user,password,bottle=None,debug=False,
+                 pool_size=POOL_MAX_SIZE, idle_timeout=POOL_IDLE_TIMEOUT, ping_after=POOL_PING_AFTER):
         self.host     = host
         self.database = database
         self.user     = user
         self.password = password
         self.debug    = debug   # enable debugging
-        self.dbcache  = dict()  # dictionary of cached connections.
         self.bottle   = bottle
+        self.pool     = ConnectionPool(lambda: DBMySQL(self), max_size=pool_size,
+                                       idle_timeout=idle_timeout, ping_after=ping_after)
 
     def __eq__(self,other):
         return ((self.host==other.host) and (self.database==other.database)
@@ -267,17 +846,12 @@ and cached_db is stored in the request-local storage."""
             pass
         raise KeyError(f"config file section must have {MYSQL_HOST}, {MYSQL_USER}, {MYSQL_PASSWORD} and {MYSQL_DATABASE} sections")
 
-    def cache_store(self,db):
-        self.dbcache[ (os.getpid(), threading.get_ident()) ] = db
-
-    def cache_get(self):
-        return self.dbcache[ (os.getpid(), threading.get_ident()) ]
-
     def cache_clear(self):
-        try:
-            del self.dbcache[ (os.getpid(), threading.get_ident()) ]
-        except KeyError as e:
-            pass
+        """Close the idle connections, so that the next query opens a new one"""
+        self.pool.clear()
+
+    def pool_stats(self):
+        return self.pool.stats()
 
 RETRIES = 10
 RETRY_DELAY_TIME = 1
@@ -285,6 +859,11 @@ class DBMySQL(DBSQL):
     """MySQL Database Connection"""
     def __init__(self, auth, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.auth = auth
+        self.connect()
+
+    def connect(self):
+        """Open the connection to the server"""
         try:
             import mysql.connector as mysql
             internalError = RuntimeError
@@ -297,18 +876,103 @@ class DBMySQL(DBSQL):
                 print(f"Please install MySQL connector with 'conda install mysql-connector-python' or the pure-python pymysql connector")
                 raise ImportError()
             
+        auth = self.auth
         self.conn = mysql.connect(host=auth.host,
                                   database=auth.database,
                                   user=auth.user,
                                   password=auth.password)
         if self.debug:
             print(f"Successfully connected to {auth}",file=sys.stderr)
+        self.session = {}       # session state that has been set on this connection
         # Census standard TZ is America/New_York
         try:
             self.cursor().execute('SET @@session.time_zone = "America/New_York"')
+            self.session['time_zone'] = "America/New_York"
         except internalError as e:
             pass
         self.cursor().execute('SET autocommit = 1') # autocommit
+        self.session['autocommit'] = 1
+
+    def set_session(self, c, time_zone=None):
+        """Turn on autocommit and set the time zone with cursor c, unless they are already set"""
+        if self.session.get('autocommit') != 1:
+            c.execute('SET autocommit=1')
+            self.session['autocommit'] = 1
+        if time_zone is not None and self.session.get('time_zone') != time_zone:
+            c.execute('SET @@session.time_zone = "{}"'.format(time_zone)) # MySQL
+            self.session['time_zone'] = time_zone
+
+    def run_setup(self, c, setup, setup_vals=()):
+        """Execute a setup statement with cursor c. It is always executed, because the query may
+        change what it set (for example a user variable), and the session state is forgotten
+        afterwards if it may have changed it."""
+        if setup is None:
+            return
+        c.execute(setup, setup_vals)
+        self.session_changed(setup)
+
+    def session_changed(self, cmd):
+        """Forget the session state if cmd may have changed it"""
+        if cmd.split()[0].upper() in ['SET','CALL']:
+            self.session.clear()
+
+    def reconnect(self):
+        """Close the connection, ignoring errors, and open a new one"""
+        try:
+            self.conn.close()
+        except Exception as e:
+            logging.debug("close: %s", e)
+        self.connect()
+
+    def ping(self):
+        """Return True if the connection to the server is still alive"""
+        try:
+            self.conn.ping(reconnect=False)
+            return True
+        except Exception as e:
+            logging.info("ping failed: %s", e)
+            return False
+
+    def insert_batch(self, table, columns, batch, *, ignore=False):
+        """Insert the batch with one multi-row INSERT statement"""
+        row = "(" + ",".join(["%s"]*len(columns)) + ")"
+        sql = "INSERT {}INTO {} ({}) VALUES {}".format("IGNORE " if ignore else "", table,
+                                                      ",".join(columns), ",".join([row]*len(batch)))
+        c = self.cursor()
+        try:
+            c.execute('START TRANSACTION')
+            c.execute(sql, [v for r in batch for v in r])
+            c.execute('COMMIT')
+        except BaseException:
+            try:
+                c.execute('ROLLBACK')
+            except Exception as e:
+                logging.debug("rollback: %s", e)
+            raise
+        finally:
+            c.close()
+
+    def cache_scope(self):
+        return (query_cache, (self.auth.host, self.auth.database))
+
+    def stream_cursor(self):
+        """Return an unbuffered cursor, which reads rows from the server as they are fetched"""
+        try:
+            import pymysql
+            if isinstance(self.conn, pymysql.connections.Connection):
+                return self.conn.cursor(pymysql.cursors.SSCursor)
+        except ImportError as e:
+            pass
+        return self.conn.cursor(buffered=False)
+
+    def transient_error(self, e):
+        errors = mysql_errors()
+        if isinstance(e, errors.InternalError):
+            return "Unknown column" not in str(e)
+        return isinstance(e, (errors.InterfaceError, errors.OperationalError, BlockingIOError))
+
+    def recover(self, e):
+        self.reconnect()
 
     RETRIES = 10
     RETRY_DELAY_TIME = 1
@@ -328,7 +992,7 @@ class DBMySQL(DBSQL):
     @staticmethod
     def csfr(auth, cmd, vals=None, quiet=True, rowcount=None, time_zone=None,
              setup=None, setup_vals=(),
-             get_column_names=None, asDicts=False, debug=False, dry_run=False, cache=True):
+             get_column_names=None, asDicts=False, debug=False, dry_run=False, cache=False, format=None):
         """Connect, select, fetchall, and retry as necessary.
         @param auth      - authentication otken
         @param cmd       - SQL query
@@ -336,106 +1000,111 @@ class DBMySQL(DBSQL):
         @param setup     - An SQL statement that runs before cmd (typcially setting a variable)
         @param setup_vals - Values for SQL parameters for setup
         @param time_zone - if provided, set the session.time_zone to this value
+                           (skipped if the pooled connection already has it; see set_session())
         @param quiet     - don't print anything
         @param get_column_names - an array in which to return the column names.
         @param asDict    - True to return each row as a dictionary
+        @param format    - 'numpy' or 'arrow' to return a SELECT as typed columns; see fetch_columns()
+        @param cache     - True, or a TTL in seconds, to answer a SELECT from query_cache. Writes made with
+                           csfr() and bulk_insert() in this process invalidate the tables they touch.
         """
 
         if not isinstance(auth, DBMySQLAuth):
             raise ValueError(f"auth is type {type(auth)} expecting type {DBMySQLAuth}")
         debug = (debug or auth.debug)
+        scope = (auth.host, auth.database)
+        if cache and format is None and not dry_run and cmd.split()[0].upper() in READ_VERBS:
+            return query_cache.cached(
+                scope, QUERY_CACHE_TTL if cache is True else cache, cmd, vals, get_column_names,
+                lambda names: DBMySQL.csfr(auth, cmd, vals, quiet=quiet, rowcount=rowcount, time_zone=time_zone,
+                                           setup=setup, setup_vals=setup_vals, get_column_names=names,
+                                           asDicts=asDicts, debug=debug),
+                time_zone, setup, tuple(setup_vals or ()), asDicts)
 
 
-        try:
-            import mysql.connector.errors as errors
-        except ImportError as e:
-            import pymysql.err as errors
+        errors = mysql_errors()
         for i in range(1,RETRIES):
             try:
-                try:
-                    db = auth.cache_get()
-                except KeyError:
-                    if i>2:
-                        logging.warning(f"Reconnecting. i={i}")
-                    db = DBMySQL(auth)
-                    auth.cache_store(db)
-                result = None
-                c      = db.cursor()
-                c.execute('SET autocommit=1')
-                if time_zone is not None:
-                    c.execute('SET @@session.time_zone = "{}"'.format(time_zone)) # MySQL
-
-                try:
-                    if quiet==False or debug:
-                        logging.warning("quiet:%s debug: %s cmd: %s  vals: %s",quiet,debug,cmd,vals)
-                        logging.warning("EXPLAIN:")
-                        logging.warning(DBMySQL.explain(cmd,vals))
+                # A connection that raises is discarded by the pool, so the retry gets a fresh one.
+                with auth.pool.connection() as db:
+                    result = None
+                    c      = db.cursor()
+                    db.set_session(c, time_zone)
+
+                    try:
+                        if quiet==False or debug:
+                            logging.warning("quiet:%s debug: %s cmd: %s  vals: %s",quiet,debug,cmd,vals)
+                            logging.warning("EXPLAIN:")
+                            logging.warning(DBMySQL.explain(cmd,vals))
                         
                     
-                    ###
-                    ###
-                    if dry_run:
-                        logging.warning("Would execute: %s,%s",cmd,vals)
-                        return None
-
-                    ### If there are multiple queries, execute them all.
-                    ### Hopefully there is no semi-colon in a quoted string.
-                    if setup is not None:
-                        c.execute(setup, setup_vals)
-                    c.execute(cmd,vals)
-                    ###
-                    ###
-
-                    if (rowcount is not None) and (c.rowcount!=rowcount):
-                        raise RuntimeError(f"{cmd} {vals} expected rowcount={rowcount} != {c.rowcount}")
-
-                except (errors.ProgrammingError, errors.InternalError) as e:
-                    logging.error("setup: %s",setup)
-                    logging.error("setup_vals: %s", setup_vals)
-                    logging.error("cmd: %s",cmd)
-                    logging.error("vals: %s",vals)
-                    logging.error("explained: %s ",DBMySQL.explain(cmd,vals))
-                    logging.error(str(e))
-                    raise e
+                        ###
+                        ###
+                        if dry_run:
+                            logging.warning("Would execute: %s,%s",cmd,vals)
+                            return None
+
+                        ### If there are multiple queries, execute them all.
+                        ### Hopefully there is no semi-colon in a quoted string.
+                        db.run_setup(c, setup, setup_vals)
+                        db.session_changed(cmd)
+                        c.execute(cmd,vals)
+                        ###
+                        ###
+
+                        query_cache.invalidate_cmd(scope, cmd)
+                        if (rowcount is not None) and (c.rowcount!=rowcount):
+                            raise RuntimeError(f"{cmd} {vals} expected rowcount={rowcount} != {c.rowcount}")
+
+                    except (errors.ProgrammingError, errors.InternalError) as e:
+                        logging.error("setup: %s",setup)
+                        logging.error("setup_vals: %s", setup_vals)
+                        logging.error("cmd: %s",cmd)
+                        logging.error("vals: %s",vals)
+                        logging.error("explained: %s ",DBMySQL.explain(cmd,vals))
+                        logging.error(str(e))
+                        raise e
                     
-                except TypeError as e:
-                    logging.error(f"TYPE ERROR: cmd:{cmd} vals:{vals} {e}")
-                    raise e
+                    except TypeError as e:
+                        logging.error(f"TYPE ERROR: cmd:{cmd} vals:{vals} {e}")
+                        raise e
                     
-                verb = cmd.split()[0].upper()
-                if verb in ['SELECT','DESCRIBE','SHOW']:
-                    result = c.fetchall()
-                    if asDicts and get_column_names is None:
-                        get_column_names = []
-                    if get_column_names is not None:
-                        get_column_names.clear()
-                        for (name,type_code,display_size,internal_size,precision,scale,null_ok) in c.description:
-                            get_column_names.append(name)
-                    if asDicts:
-                        result =[OrderedDict(zip(get_column_names, row)) for row in result]
-                    if debug:
-                        logging.warning("   SELECTED ROWS count=%s  row[0]=%s",len(result), result[0] if len(result)>0 else None)
-                if verb in ['INSERT']:
-                    result = c.lastrowid
-                    if debug:
-                        logging.warning("   INSERT c.lastworid=%s",c.lastrowid)
-                if verb in ['UPDATE']:
-                    result = c.rowcount
-                c.close()  # close the cursor
-                if i>2:
-                    logging.warning(f"Success with i={i}")
-                return result
+                    verb = cmd.split()[0].upper()
+                    if verb in READ_VERBS and format is not None:
+                        result = fetch_columns(c, format)
+                        if get_column_names is not None:
+                            get_column_names[:] = [d[0] for d in c.description]
+                    elif verb in READ_VERBS:
+                        result = c.fetchall()
+                        if asDicts and get_column_names is None:
+                            get_column_names = []
+                        if get_column_names is not None:
+                            get_column_names.clear()
+                            for (name,type_code,display_size,internal_size,precision,scale,null_ok) in c.description:
+                                get_column_names.append(name)
+                        if asDicts:
+                            result =[OrderedDict(zip(get_column_names, row)) for row in result]
+                        if debug:
+                            logging.warning("   SELECTED ROWS count=%s  row[0]=%s",len(result), result[0] if len(result)>0 else None)
+                    if verb in ['INSERT']:
+                        result = c.lastrowid
+                        if debug:
+                            logging.warning("   INSERT c.lastworid=%s",c.lastrowid)
+                    if verb in ['UPDATE']:
+                        result = c.rowcount
+                    c.close()  # close the cursor
+                    if i>2:
+                        logging.warning(f"Success with i={i}")
+                    return result
             except errors.InterfaceError as e:
                 if i>1:
                     logging.warning(e)
                     logging.warning(f"InterfaceError. threadid={threading.get_ident()} RETRYING {i}/{RETRIES}: {cmd} {vals} ")
-                auth.cache_clear()
                 pass
             except errors.OperationalError as e:
                 if i>1:
                     logging.warning(e)
                     logging.warning(f"OperationalError. RETRYING {i}/{RETRIES}: {cmd} {vals} ")
-                auth.cache_clear()
                 pass
             except errors.InternalError as e:
                 if "Unknown column" in str(e):
@@ -444,22 +1113,68 @@ class DBMySQL(DBSQL):
                 if i>1:
                     logging.warning(e)
                     logging.warning(f"InternalError. threadid={threading.get_ident()} RETRYING {i}/{RETRIES}: {cmd} {vals} ")
-                auth.cache_clear()
                 pass
             except BlockingIOError as e:
                 if i>1:
                     logging.warning(e)
                     logging.warning(f"BlockingIOError. RETRYING {i}/{RETRIES}: {cmd} {vals} ")
-                auth.cache_clear()
                 pass
-            time.sleep(RETRY_DELAY_TIME)
+            if i>1:
+                time.sleep(RETRY_DELAY_TIME)  # the first retry is on a new connection
         raise RuntimeError("Retries Exceeded")
 
 
+    @staticmethod
+    def csfr_stream(auth, cmd, vals=None, *, time_zone=None, setup=None, setup_vals=(),
+                    get_column_names=None, asDicts=False, chunk_rows=None, fetch_rows=STREAM_FETCH_ROWS,
+                    debug=False):
+        """Connect, select and generate the rows as they arrive, using an unbuffered cursor.
+        Only fetch_rows rows are held in memory at a time. Connection errors are retried as in csfr()
+        until the first row has been generated; after that they are raised.
+        The connection stays checked out of the pool until the generator is exhausted. A generator that
+        is closed early discards its connection, which still has unread rows.
+        @param chunk_rows - if provided, generate lists of up to chunk_rows rows instead of single rows
+        @param fetch_rows - rows to read from the server at a time
+        The other parameters are as for csfr().
+        """
+        if not isinstance(auth, DBMySQLAuth):
+            raise ValueError(f"auth is type {type(auth)} expecting type {DBMySQLAuth}")
+        debug = (debug or auth.debug)
+        errors = mysql_errors()
+        for i in range(1,RETRIES):
+            started = False
+            try:
+                with auth.pool.connection() as db:
+                    c = db.stream_cursor()
+                    db.set_session(c, time_zone)
+                    if debug:
+                        logging.warning("cmd: %s  vals: %s",cmd,vals)
+                    db.run_setup(c, setup, setup_vals)
+                    db.session_changed(cmd)
+                    c.execute(cmd,vals)
+                    names = [d[0] for d in c.description]
+                    if get_column_names is not None:
+                        get_column_names[:] = names
+                    for chunk in stream_chunks(c, names, asDicts=asDicts, chunk_rows=chunk_rows,
+                                               fetch_rows=fetch_rows):
+                        started = True
+                        yield chunk
+                    c.close()
+                    return
+            except (errors.InterfaceError, errors.OperationalError, errors.InternalError, BlockingIOError) as e:
+                if started or "Unknown column" in str(e):
+                    raise e
+                if i>1:
+                    logging.warning(e)
+                    logging.warning(f"{type(e).__name__}. RETRYING {i}/{RETRIES}: {cmd} {vals} ")
+            if i>1:
+                time.sleep(RETRY_DELAY_TIME)
+        raise RuntimeError("Retries Exceeded")
+
     @staticmethod
     def table_columns(auth, table_name):
         """Return a dictionary of the schema. This should probably be upgraded to return the ctools schema"""
-        return [row[0] for row in DBMySQL.csfr(auth, "describe "+table_name)]
+        return [row[0] for row in DBMySQL.csfr(auth, "describe "+table_name, cache=True)]
                     
 
 ################################################################
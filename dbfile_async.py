@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""dbfile_async.py
+
+An asyncio counterpart of dbfile.py's DBMySQL.csfr(), for services that run on an event loop.
+
+  AsyncConnectionPool - dbfile.ConnectionPool for coroutines: checkout waits without blocking the loop.
+  AsyncDBMySQL        - MySQL through aiomysql (pip install aiomysql). Takes a dbfile.DBMySQLAuth.
+  AsyncDBSqlite3      - SQLite3. Each connection runs its statements on its own thread.
+
+Both have the same csfr() as DBMySQL: connection errors are retried on a fresh connection,
+rowcount is checked, and SELECTs can return dictionaries and column names:
+
+   db = AsyncDBMySQL(auth, pool_size=64)
+   rows = await db.csfr("SELECT name, value FROM config WHERE app=%s", ["web"], asDicts=True)
+   await db.close()
+
+Queries from many coroutines share the pool, so up to pool_size of them are in flight at once
+and the rest wait for a connection. Statements use "%s" for parameters with both backends.
+"""
+
+import asyncio
+import functools
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+# Bring in dbfile from the current directory
+sys.path.append(os.path.dirname(__file__))
+import dbfile
+
+
+class AsyncConnectionPool(dbfile.ConnectionPool):
+    """A bounded pool of connections for the coroutines of one event loop.
+    connect() is a coroutine function, and the connections' ping() is a coroutine.
+    The bookkeeping, limits and statistics are those of dbfile.ConnectionPool."""
+
+    def __init__(self, connect, **kwargs):
+        super().__init__(connect, **kwargs)
+        self.waiters = deque()      # futures of the checkouts waiting for a connection
+
+    def _wake(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    async def _opened(self):
+        try:
+            db = await self.connect()
+        except BaseException:
+            with self.cond:
+                self.size -= 1
+            self._wake()
+            raise
+        with self.cond:
+            self.counters['connects'] += 1
+        return db
+
+    async def checkout(self, timeout=None):
+        """Return a connection, waiting up to timeout seconds (default wait_timeout) if the pool is full"""
+        timeout = self.wait_timeout if timeout is None else timeout
+        t0 = time.time()
+        with self.cond:
+            self._check_pid()
+            expired = self._expired(t0)
+        self._close(expired)
+        waited = False
+        while True:
+            with self.cond:
+                if self._available():
+                    (db, last) = self._take(t0, waited)
+                    break
+                remaining = t0 + timeout - time.time()
+                if remaining <= 0:
+                    raise self._timeout(timeout)
+            waited = True
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, remaining)
+            except asyncio.TimeoutError:   # not the builtin TimeoutError before Python 3.11
+                pass            # the loop checks once more before giving up
+            finally:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+        if db is None:
+            return await self._opened()
+        if self._stale(db, last) and not await db.ping():
+            self._replace(db)
+            return await self._opened()
+        return db
+
+    def checkin(self, db, discard=False):
+        super().checkin(db, discard)
+        self._wake()
+
+    @asynccontextmanager
+    async def connection(self):
+        """Check out a connection for the body of an async with statement.
+        The connection is discarded if the body raises an exception."""
+        db = await self.checkout()
+        try:
+            yield db
+        except BaseException:
+            self.checkin(db, discard=True)
+            raise
+        self.checkin(db)
+
+    def clear(self):
+        super().clear()
+        self._wake()
+
+
+def aiomysql_errors():
+    """Return the errors module of pymysql, which aiomysql raises. dbfile.mysql_errors() is not used,
+    because it returns mysql.connector's errors when that is installed too."""
+    import pymysql.err as errors
+    return errors
+
+
+class AsyncMySQLConnection:
+    """An aiomysql connection, with the session state tracking of dbfile.DBMySQL"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.session = {'autocommit': 1}
+
+    @classmethod
+    async def connect(cls, auth):
+        try:
+            import aiomysql
+        except ImportError as e:
+            print("Please install the asyncio MySQL connector with 'pip install aiomysql'")
+            raise
+        self = cls(await aiomysql.connect(host=auth.host, db=auth.database, user=auth.user,
+                                          password=auth.password, autocommit=True))
+        # Census standard TZ is America/New_York
+        try:
+            await self.execute('SET @@session.time_zone = "America/New_York"')
+            self.session['time_zone'] = "America/New_York"
+        except aiomysql_errors().InternalError as e:
+            pass
+        return self
+
+    async def execute(self, sql, vals=None, fetch=False):
+        """Return (description, rows, rowcount, lastrowid); rows is None unless fetch is True"""
+        async with self.conn.cursor() as c:
+            await c.execute(sql, vals)
+            rows = await c.fetchall() if fetch else None
+            return (c.description, rows, c.rowcount, c.lastrowid)
+
+    async def set_session(self, time_zone=None):
+        if self.session.get('autocommit') != 1:
+            await self.execute('SET autocommit=1')
+            self.session['autocommit'] = 1
+        if time_zone is not None and self.session.get('time_zone') != time_zone:
+            await self.execute('SET @@session.time_zone = "{}"'.format(time_zone)) # MySQL
+            self.session['time_zone'] = time_zone
+
+    async def run_setup(self, setup, setup_vals=()):
+        """Like DBMySQL.run_setup(): always executed, and the session state is forgotten if it may have changed"""
+        if setup is None:
+            return
+        await self.execute(setup, setup_vals)
+        self.session_changed(setup)
+
+    def session_changed(self, cmd):
+        if cmd.split()[0].upper() in ['SET','CALL']:
+            self.session.clear()
+
+    async def ping(self):
+        try:
+            await self.conn.ping(reconnect=False)
+            return True
+        except Exception as e:
+            logging.info("ping failed: %s", e)
+            return False
+
+    def close(self):
+        self.conn.close()
+
+
+class AsyncSqlite3Connection:
+    """A sqlite3 connection in autocommit mode whose statements run on a thread of its own"""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.conn = None
+
+    async def _run(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    @classmethod
+    async def connect(cls, fname):
+        self = cls(fname)
+        self.conn = await self._run(sqlite3.connect, fname, isolation_level=None, check_same_thread=False)
+        return self
+
+    def _execute(self, sql, vals, fetch):
+        c = self.conn.execute(sql, vals or ())
+        rows = c.fetchall() if fetch else None
+        return (c.description, rows, c.rowcount, c.lastrowid)
+
+    async def execute(self, sql, vals=None, fetch=False):
+        return await self._run(self._execute, sql, vals, fetch)
+
+    async def set_session(self, time_zone=None):
+        pass
+
+    async def run_setup(self, setup, setup_vals=()):
+        if setup is not None:
+            await self.execute(setup, setup_vals)
+
+    def session_changed(self, cmd):
+        pass
+
+    async def ping(self):
+        return True
+
+    def close(self):
+        self.executor.submit(self.conn.close)
+        self.executor.shutdown(wait=False)
+
+
+class AsyncDBSQL(ABC):
+    def __init__(self, *, scope, pool_size=dbfile.POOL_MAX_SIZE, idle_timeout=dbfile.POOL_IDLE_TIMEOUT,
+                 ping_after=dbfile.POOL_PING_AFTER, wait_timeout=dbfile.POOL_WAIT_TIMEOUT, debug=False):
+        """
+        @param scope - the scope in dbfile.query_cache whose entries this database's writes invalidate
+        """
+        self.scope = scope
+        self.debug = debug
+        self.pool = AsyncConnectionPool(self.connect, max_size=pool_size, idle_timeout=idle_timeout,
+                                        ping_after=ping_after, wait_timeout=wait_timeout)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, a, b, c):
+        await self.close()
+
+    @abstractmethod
+    async def connect(self):
+        """Return a new connection"""
+
+    def prepare(self, cmd):
+        """Translate a statement written for MySQL into this database's dialect"""
+        return cmd
+
+    def transient_error(self, e):
+        """Return True if a statement that raised e may succeed on another connection"""
+        return False
+
+    async def csfr(self, cmd, vals=None, quiet=True, rowcount=None, time_zone=None,
+                   setup=None, setup_vals=(), get_column_names=None, asDicts=False, debug=False, dry_run=False):
+        """Connect, select, fetchall, and retry as necessary. The parameters are those of DBMySQL.csfr(),
+        without auth. Returns the rows of a SELECT, the lastrowid of an INSERT, and the rowcount of an UPDATE."""
+        debug = (debug or self.debug)
+        cmd = self.prepare(cmd)
+        verb = cmd.split()[0].upper()
+        for i in range(1,dbfile.RETRIES):
+            try:
+                async with self.pool.connection() as conn:
+                    await conn.set_session(time_zone)
+                    if quiet==False or debug:
+                        logging.warning("quiet:%s debug: %s cmd: %s  vals: %s",quiet,debug,cmd,vals)
+                    if dry_run:
+                        logging.warning("Would execute: %s,%s",cmd,vals)
+                        return None
+                    await conn.run_setup(setup, setup_vals)
+                    conn.session_changed(cmd)
+                    (description, rows, count, lastrowid) = await conn.execute(
+                        cmd, vals, fetch=verb in dbfile.READ_VERBS)
+                    dbfile.query_cache.invalidate_cmd(self.scope, cmd)
+                    if (rowcount is not None) and (count!=rowcount):
+                        raise RuntimeError(f"{cmd} {vals} expected rowcount={rowcount} != {count}")
+
+                    result = None
+                    if verb in dbfile.READ_VERBS:
+                        result = list(rows)
+                        if asDicts and get_column_names is None:
+                            get_column_names = []
+                        if get_column_names is not None:
+                            get_column_names[:] = [d[0] for d in description]
+                        if asDicts:
+                            result = [OrderedDict(zip(get_column_names, row)) for row in result]
+                    if verb in ['INSERT']:
+                        result = lastrowid
+                    if verb in ['UPDATE']:
+                        result = count
+                    if i>2:
+                        logging.warning(f"Success with i={i}")
+                    return result
+            except Exception as e:
+                if not self.transient_error(e):
+                    logging.error("cmd: %s vals: %s error: %s", cmd, vals, e)
+                    raise
+                if i>1:
+                    logging.warning(e)
+                    logging.warning(f"{type(e).__name__}. RETRYING {i}/{dbfile.RETRIES}: {cmd} {vals} ")
+            if i>1:
+                await asyncio.sleep(dbfile.RETRY_DELAY_TIME)  # the first retry is on a new connection
+        raise RuntimeError("Retries Exceeded")
+
+    def stats(self):
+        return self.pool.stats()
+
+    async def close(self):
+        self.pool.clear()
+
+
+class AsyncDBMySQL(AsyncDBSQL):
+    """MySQL for asyncio, with the credentials in a dbfile.DBMySQLAuth"""
+
+    def __init__(self, auth, **kwargs):
+        super().__init__(scope=(auth.host, auth.database), debug=auth.debug, **kwargs)
+        self.auth = auth
+
+    async def connect(self):
+        return await AsyncMySQLConnection.connect(self.auth)
+
+    def transient_error(self, e):
+        try:
+            errors = aiomysql_errors()
+        except ImportError as ie:
+            return False        # aiomysql is not installed, so nothing was raised by it
+        if isinstance(e, errors.InternalError):
+            return "Unknown column" not in str(e)
+        return isinstance(e, (errors.InterfaceError, errors.OperationalError, BlockingIOError))
+
+
+class AsyncDBSqlite3(AsyncDBSQL):
+    """SQLite3 for asyncio. Every pooled connection opens fname, so ':memory:' needs pool_size=1."""
+
+    def __init__(self, fname, **kwargs):
+        super().__init__(scope=('sqlite3', fname), **kwargs)
+        self.fname = fname
+
+    async def connect(self):
+        return await AsyncSqlite3Connection.connect(self.fname)
+
+    def prepare(self, cmd):
+        return cmd.replace("%s","?").replace("INSERT IGNORE","INSERT OR IGNORE")
+
+    def transient_error(self, e):
+        return isinstance(e, sqlite3.OperationalError) and ('locked' in str(e) or 'busy' in str(e))
@@ -369,8 +369,18 @@ def inspect_json_all_pages_have_same_orientation(info):
         return info[PAGES][0][ORIENTATION]
     return None
 
-def inspect_pdf_latex(pdf_fname,texinputs=None):
+def file_sha256(fname):
+    """Return the SHA-256 of a file, reading it in blocks rather than all at once"""
+    h = hashlib.sha256()
+    with open(fname,"rb") as f:
+        for block in iter(lambda: f.read(1024*1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def inspect_pdf_latex(pdf_fname,texinputs=None,sha256=None):
     """Using PAGECOUNTER_TEX, run LaTeX on each page and determine each page's orientation and size.
+    If the caller already knows the file's sha256 (e.g. from the SHA256 that s3.get_object(..., digests=True) returns),
+    it is used rather than hashing the file again.
     Returns a dictionary containing the following properties:
     [FILENAME] - filename
     [SHA256]   - sha256
@@ -388,7 +398,7 @@ def inspect_pdf_latex(pdf_fname,texinputs=None):
     ret = {VERSION:1,
            FILENAME:pdf_fname,
            UNITS:POINTS,
-           SHA256:hashlib.sha256( open(pdf_fname,"rb").read() ).hexdigest(),
+           SHA256:sha256 or file_sha256(pdf_fname),
            PAGES:[]}
 
     def cb(auxfile):
@@ -426,14 +436,13 @@ def inspect_pdf_latex(pdf_fname,texinputs=None):
         os.unlink( tmp.name)
     return ret
 
-def inspect_pdf_pypdf(pdf_fname):
+def inspect_pdf_pypdf(pdf_fname,sha256=None):
     """As above, but with PyPDF"""
     if os.path.getsize(pdf_fname)==0:
         raise RuntimeError(f"{pdf_fname} is a zero-length file")
 
     import PyPDF2
-    with open(pdf_fname,"rb") as f:
-        sha256 = hashlib.sha256(f.read()).hexdigest()
+    sha256 = sha256 or file_sha256(pdf_fname)
     ret = {VERSION:1,
            FILENAME:pdf_fname,
            UNITS:POINTS,
@@ -449,11 +458,11 @@ def inspect_pdf_pypdf(pdf_fname):
                            PAGE:pageNumber+1})
     return ret
 
-def inspect_pdf(pdf_fname,texinputs=None):
+def inspect_pdf(pdf_fname,texinputs=None,sha256=None):
     try:
-        return inspect_pdf_pypdf(pdf_fname)
+        return inspect_pdf_pypdf(pdf_fname,sha256=sha256)
     except (ImportError,ModuleNotFoundError):
-        return inspect_pdf_latex(pdf_fname,texinputs=texinputs)
+        return inspect_pdf_latex(pdf_fname,texinputs=texinputs,sha256=sha256)
 
 def count_pdf_pages_pypdf(pdf_fname):
     import PyPDF2
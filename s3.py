@@ -1,13 +1,25 @@
 import json
 import errno
+import fcntl
+import hashlib
+import io
+import logging
 import os
+import shutil
 import tempfile
 import sys
+import sqlite3
 import subprocess
+import threading
 import time
 
+from collections import OrderedDict, defaultdict
 from urllib.parse import urlparse
 
+# Bring in s3client from the current directory
+sys.path.append(os.path.dirname(__file__))
+import s3client
+
 # 
 # This creates an S3 file that supports seeking and caching.
 # We keep this file at Python2.7 for legacy reasons
@@ -21,12 +33,34 @@ _Key = 'Key'
 _Size = 'Size'
 _Prefix = 'Prefix'
 
-READ_CACHE_SIZE = 4096  # big enough for front and back caches
 MAX_READ = 65536 * 16
+BLOCK_SIZE = 4 * 1024 * 1024            # S3File reads aligned blocks of this size
+BLOCK_CACHE_BYTES = 256 * 1024 * 1024   # bound on the process-wide block cache
+READAHEAD_BLOCKS = 8                    # most blocks that S3File prefetches ahead of a sequential reader
+READAHEAD_THREADS = 16                  # threads shared by all S3File objects for prefetching
+PART_SIZE = 8 * 1024 * 1024             # byte range fetched by each request of a parallel transfer
+TRANSFER_THREADS = 16                   # concurrent requests of a parallel transfer
+MIN_PART_SIZE = 5 * 1024 * 1024         # S3's minimum size for all but the last part of a multipart upload
+MAX_PARTS = 10000                       # S3's maximum number of parts in a multipart upload
+DELETE_BATCH = 1000                     # S3's maximum number of keys in a DeleteObjects request
+DELETE_RETRIES = 5
+DELETE_RETRY_CODES = ('InternalError', 'SlowDown', 'ServiceUnavailable', 'RequestTimeout')
+MAX_COPY_PART_SIZE = 5 * 1024 ** 3      # S3's maximum size of a part, including a copied part
+COMPACT_TARGET_SIZE = 1024 ** 3         # size of the objects that compact_objects() builds
+MD5_METADATA = 'md5'                    # metadata keys under which transfers store the digests of an object
+SHA256_METADATA = 'sha256'
+SYNC_PART_THREADS = 4                   # threads that sync() uses for each file larger than PART_SIZE
 debug = False
 
+METADATA_TTL = 60                       # seconds that cached object metadata and existence are trusted
+METADATA_CACHE_ENTRIES = 1000000        # bound on the process-wide metadata cache
+EXISTS_THREADS = 16                     # concurrent listings of s3exists_many()
+KEY_MAX = '\U0010ffff'                  # sorts after every character that can follow a key
 READTHROUGH_CACHE_DIR = '/mnt/tmp/s3cache'
+READTHROUGH_CACHE_BYTES = 64 * 1024 * 1024 * 1024  # bound on the read-through disk cache
 
+WAIT_DELAY = 5                          # seconds between the polls of s3open(fsync=True)
+WAIT_ATTEMPTS = 20
 AWS_LIST = ['/usr/bin/aws', '/usr/local/bin/aws', '/usr/local/aws/bin/aws']
 
 
@@ -88,10 +122,94 @@ def aws_s3api(cmd, debug=False):
         raise RuntimeError("s3 api {} failed data: {}".format(cmd, data))
 
 
-def put_object(bucket, key, fname):
-    """Given a bucket and a key, upload a file"""
+class TransferDigests:
+    """The digests of an object computed as its bytes stream through a transfer, in order:
+    the MD5 and SHA-256 of the whole object, and the MD5 of each part of part_size, from
+    which the ETag that S3 gives an object uploaded in such parts can be derived."""
+
+    def __init__(self, part_size=PART_SIZE):
+        self.part_size = part_size
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self.part = hashlib.md5()
+        self.part_bytes = 0
+        self.part_md5s = []
+        self.length = 0
+
+    def update(self, data):
+        self.md5.update(data)
+        self.sha256.update(data)
+        self.length += len(data)
+        view = memoryview(data)
+        while view:
+            n = min(len(view), self.part_size - self.part_bytes)
+            self.part.update(view[0:n])
+            self.part_bytes += n
+            view = view[n:]
+            if self.part_bytes == self.part_size:
+                self._end_part()
+
+    def _end_part(self):
+        self.part_md5s.append(self.part.digest())
+        self.part = hashlib.md5()
+        self.part_bytes = 0
+
+    def finish(self):
+        """End the last, short part. Returns result()."""
+        if self.part_bytes:
+            self._end_part()
+        return self.result()
+
+    def multipart_etag(self):
+        if len(self.part_md5s) <= 1:
+            return self.md5.hexdigest()
+        return "{}-{}".format(hashlib.md5(b''.join(self.part_md5s)).hexdigest(), len(self.part_md5s))
+
+    def result(self):
+        return {'MD5': self.md5.hexdigest(), 'SHA256': self.sha256.hexdigest(), 'MultipartETag': self.multipart_etag()}
+
+    def metadata(self):
+        """Return the digests as object metadata"""
+        return {MD5_METADATA: self.md5.hexdigest(), SHA256_METADATA: self.sha256.hexdigest()}
+
+    def matches(self, etag):
+        """Return True if etag is the object's MD5 or the ETag of a multipart upload in parts of part_size.
+        Objects encrypted with SSE-KMS, or uploaded in other part sizes, have ETags that do not match."""
+        return s3client.strip_etag(etag) in (self.md5.hexdigest(), self.multipart_etag())
+
+
+def replace_metadata(bucket, key, length, metadata, *, client=None):
+    """Replace the metadata of an object by copying it onto itself within S3, in parts if it is over 5 GiB.
+    Returns a dictionary with the new ETag."""
+    client = client or s3client.default_client()
+    metadata_cache.invalidate(bucket, key)
+    if length <= MAX_COPY_PART_SIZE:
+        return client.copy_object(bucket, key, bucket, key, metadata=metadata)
+    upload_id = client.create_multipart_upload(bucket, key, metadata=metadata)
+    try:
+        parts = [(n, client.upload_part_copy(bucket, key, upload_id, n, bucket, key,
+                                             start, min(start + MAX_COPY_PART_SIZE, length)))
+                 for (n, start) in enumerate(range(0, length, MAX_COPY_PART_SIZE), 1)]
+        return client.complete_multipart_upload(bucket, key, upload_id, parts)
+    except BaseException:
+        client.abort_multipart_upload(bucket, key, upload_id)
+        raise
+
+
+def put_object(bucket, key, fname, store_digests=False, client=None, digests=False):
+    """Given a bucket and a key, upload a file. Files larger than PART_SIZE are sent with a multipart upload.
+    Returns a dictionary with the ETag.
+    @param digests       - if True, send each part with its Content-MD5 and also return the MD5, SHA256 and
+                           MultipartETag computed as the file was sent; see S3MultipartWriter.
+    @param store_digests - if True, also store the MD5 and SHA-256 as the object's metadata.
+    """
+    metadata_cache.invalidate(bucket, key)
     assert os.path.exists(fname)
-    return aws_s3api(['put-object', '--bucket', bucket, '--key', key, '--body', fname])
+    with open(fname, 'rb') as f:
+        with S3MultipartWriter("s3://{}/{}".format(bucket, key), digests=digests, store_digests=store_digests,
+                               client=client) as writer:
+            shutil.copyfileobj(f, writer, PART_SIZE)
+    return writer.result
 
 
 def put_s3url(s3url, fname):
@@ -101,120 +219,540 @@ def put_s3url(s3url, fname):
 
  
 
-def get_object(bucket, key, fname):
-    """Given a bucket and a key, download a file"""
+def get_object(bucket, key, fname, parallel=False, **kwargs):
+    """Given a bucket and a key, download a file with ranged GETs of PART_SIZE.
+    @param parallel - if True, fetch the parts with parallel_get_object(), passing it kwargs.
+                      Otherwise they are fetched one at a time.
+    """
     if os.path.exists(fname):
         raise FileExistsError(fname)
-    return aws_s3api(['get-object', '--bucket', bucket, '--key', key, fname])
+    if not parallel:
+        kwargs['threads'] = 1
+    return parallel_get_object(bucket, key, fname, **kwargs)
+
+
+def _pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        count = os.pwrite(fd, view, offset)
+        view = view[count:]
+        offset += count
+
+
+def _parallel_download(bucket, key, fd, *, part_size=PART_SIZE, threads=TRANSFER_THREADS, client=None, info=None,
+                       digests=None):
+    """Download an object into the file open on fd. The file is preallocated to the object's length,
+    then byte ranges of part_size are fetched by a pool of threads and each is written into place with pwrite.
+    At most threads parts are in memory at once. Returns a dictionary describing the transfer.
+    @param info    - the object's head_object() result, if the caller already has it.
+    @param digests - if provided, a TransferDigests that is fed the parts in order as they arrive. Parts that
+                     arrive early wait in memory, up to 2 * threads of them. Its results are added to the
+                     dictionary, with Verified set if they match the ETag. If the object has a stored SHA-256
+                     that does not match, RuntimeError is raised.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    client = client or s3client.default_client()
+    t0 = time.time()
+    info = info or client.head_object(bucket, key)
+    length = info['ContentLength']
+    if length > 0:
+        try:
+            os.posix_fallocate(fd, 0, length)
+        except (AttributeError, OSError):
+            os.ftruncate(fd, length)
+
+    ready = dict()              # start -> data of parts that have arrived but not yet been hashed
+    hashed = [0]                # the start of the next part to hash
+    lock = threading.Lock()
+    hashing = threading.Lock()
+    window = threading.Semaphore(2 * threads)
+
+    def hash_ready():
+        """Hash the parts that are next in order. One thread hashes at a time; the others just leave their parts."""
+        while hashing.acquire(blocking=False):
+            try:
+                while True:
+                    with lock:
+                        data = ready.pop(hashed[0], None)
+                    if data is None:
+                        break
+                    digests.update(data)
+                    hashed[0] += len(data)
+                    window.release()
+            finally:
+                hashing.release()
+            with lock:
+                if hashed[0] not in ready:
+                    return
+
+    def fetch(start):
+        data = client.get_range(bucket, key, start, min(part_size, length - start), etag=info['ETag'])
+        _pwrite_all(fd, data, start)
+        if digests is not None:
+            with lock:
+                ready[start] = data
+            hash_ready()
+        return len(data)
+
+    def submit(pool, futures, start):
+        while digests is not None and not window.acquire(timeout=0.1):
+            for f in futures:
+                if f.done() and f.exception():
+                    raise f.exception()
+        return pool.submit(fetch, start)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        futures = []
+        try:
+            for start in range(0, length, part_size):
+                futures.append(submit(pool, futures, start))
+            total = sum(f.result() for f in futures)
+        except BaseException:
+            for f in futures:
+                f.cancel()
+            raise
+    if total != length:
+        raise RuntimeError("s3://{}/{}: downloaded {} bytes, expected {}".format(bucket, key, total, length))
+    elapsed = time.time() - t0
+    ret = {'ContentLength': length, 'ETag': info['ETag'], 'Parts': len(futures),
+           'Seconds': elapsed, 'MBps': length / 1e6 / elapsed if elapsed > 0 else 0}
+    if digests is not None:
+        ret.update(digests.finish())
+        ret['Verified'] = digests.matches(info['ETag'])
+        stored = info.get('Metadata', {}).get(SHA256_METADATA)
+        if stored and stored != ret['SHA256']:
+            raise RuntimeError("s3://{}/{}: SHA-256 is {}, but the object's metadata says {}".format(
+                bucket, key, ret['SHA256'], stored))
+    logging.info("s3://%s/%s: %d bytes in %d parts, %.2f seconds, %.1f MB/s",
+                 bucket, key, length, ret['Parts'], elapsed, ret['MBps'])
+    return ret
+
+
+def parallel_get_object(bucket, key, fname, *, part_size=PART_SIZE, threads=TRANSFER_THREADS, client=None,
+                        digests=False, etag_part_size=PART_SIZE):
+    """Download an object to fname over threads concurrent connections, each fetching part_size byte ranges.
+    Returns a dictionary with the ContentLength and ETag of the object and the
+    Parts, Seconds and MBps (throughput) of the transfer.
+    @param digests        - if True, also compute the MD5, SHA256 and MultipartETag of the object as it arrives
+                            and set Verified if they match its ETag (see _parallel_download()). The hashing is
+                            done in order by one thread, which can limit the throughput of a fast download.
+    @param etag_part_size - the part size that the object is assumed to have been uploaded with.
+    """
+    fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        ret = _parallel_download(bucket, key, fd, part_size=part_size, threads=threads, client=client,
+                                 digests=TransferDigests(etag_part_size) if digests else None)
+    except BaseException:
+        os.close(fd)
+        os.unlink(fname)
+        raise
+    os.close(fd)
+    return ret
 
 
 def head_object(bucket, key):
-    """Wrap the head-object api"""
-    return aws_s3api(['head-object', '--bucket', bucket, '--key', key])
+    """Return a dictionary in the format of the head-object api"""
+    return s3client.default_client().head_object(bucket, key)
+
+
+class MetadataCache:
+    """A TTL cache of object metadata shared by S3File, s3exists() and s3exists_many().
+    Each entry maps (bucket, key) to a dictionary with the object's ContentLength, ETag and
+    LastModified, or to None if nothing exists at or below the key. Entries are trusted for
+    ttl seconds; the functions in this module that write or delete objects invalidate them."""
+
+    def __init__(self, ttl=METADATA_TTL, max_entries=METADATA_CACHE_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()    # (bucket, key) -> (expires, info)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, bucket, key):
+        """Return (True, info) for a live entry, where info is None for a missing object, or (False, None)"""
+        with self.lock:
+            entry = self.entries.get((bucket, key))
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return (False, None)
+            self.hits += 1
+            return (True, entry[1])
+
+    def put(self, bucket, key, info):
+        with self.lock:
+            self.entries[(bucket, key)] = (time.time() + self.ttl, info)
+            self.entries.move_to_end((bucket, key))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, bucket, key):
+        with self.lock:
+            self.entries.pop((bucket, key), None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+
+metadata_cache = MetadataCache()
+
+
+def _listed_info(obj):
+    """Convert a list_objects() dictionary to the metadata that MetadataCache holds"""
+    return {'ContentLength': obj[_Size], 'ETag': obj[_ETag], 'LastModified': obj[_LastModified]}
+
+
+def stat_object(bucket, key, *, client=None, cache=None):
+    """Return the ContentLength, ETag and LastModified of an object, or None if it does not exist.
+    Answers from the metadata cache when it can, and otherwise sends a HEAD request and caches the result.
+    """
+    cache = cache if cache is not None else metadata_cache
+    (found, info) = cache.get(bucket, key)
+    if found:
+        return info
+    try:
+        head = (client or s3client.default_client()).head_object(bucket, key)
+        info = {k: head[k] for k in ('ContentLength', 'ETag', 'LastModified')}
+    except FileNotFoundError:
+        info = None
+    if info is not None:
+        cache.put(bucket, key, info)
+    return info
 
 
 def delete_object(bucket, key):
     """Wrap the delete-object api"""
-    return aws_s3api(['delete-object', '--bucket', bucket, '--key', key])
+    metadata_cache.invalidate(bucket, key)
+    return s3client.default_client().delete_object(bucket, key)
 
 
 PAGE_SIZE = 1000
-MAX_ITEMS = 1000
 
 
-def list_objects(bucket, prefix=None, limit=None, delimiter=None):
-    """Returns a generator that lists objects in a bucket. Returns a list of dictionaries, including Size and ETag"""
+LIST_THREADS = 16
+LIST_QUEUE_PAGES = 64   # pages buffered between the parallel listing threads and the caller
+SPLIT_CHARS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+SHARD_KEYS = PAGE_SIZE  # a range shard that holds more keys than this is split further
+LIST_MAX_SHARDS = 1024  # range shards are not split once there are this many
+LAST_CHAR = '\U0010ffff'   # sorts after every other character, in UTF-8 as in Python
+
+
+def list_objects(bucket, prefix=None, limit=None, delimiter=None, parallel=False, **kwargs):
+    """Returns a generator that lists objects in a bucket. Returns a list of dictionaries, including Size and ETag
+    @param parallel - if True, list with parallel_list_objects(), passing it kwargs.
+    """
 
     # handle the case where an S3 URL is provided instead of a bucket and prefix
     if bucket.startswith('s3://') and (prefix is None):
         (bucket, prefix) = get_bucket_key(bucket)
 
-    next_token = None
-    total = 0
-    while True:
-        cmd = ['list-objects-v2', '--bucket', bucket, '--prefix', prefix,
-               '--page-size', str(PAGE_SIZE), '--max-items', str(MAX_ITEMS)]
+    if parallel:
         if delimiter:
-            cmd += ['--delimiter', delimiter]
-        if next_token:
-            cmd += ['--starting-token', next_token]
+            raise ValueError("parallel listing does not support a delimiter")
+        yield from parallel_list_objects(bucket, prefix or '', limit=limit, **kwargs)
+        return
 
-        res = aws_s3api(cmd)
-        if not res:
-            return
-        if 'Contents' in res:
-            for data in res['Contents']:
-                yield data
+    total = 0
+    for page in s3client.default_client().list_pages(bucket, prefix or '', delimiter=delimiter, max_keys=PAGE_SIZE):
+        for data in page['Contents']:
+            yield data
+            total += 1
+            if limit and total >= limit:
+                return
+        yield from page['CommonPrefixes']
+
+
+def _in_range(key, start_after, last):
+    """Return True if start_after < key <= last in S3's (UTF-8) key order; None is no bound"""
+    key = key.encode('utf-8')
+    return ((start_after is None or key > start_after.encode('utf-8')) and
+            (last is None or key <= last.encode('utf-8')))
+
+
+def _split_ranges(client, bucket, prefix, threads):
+    """Divide the keys under prefix into range shards, for _list_shards().
+    Each range is probed with a one-key listing, and dropped if it is empty, and then with a listing of
+    SHARD_KEYS keys, which the shard keeps so it is not listed twice. If that listing did not reach the
+    end of the range, the rest of the range is split at the longest prefix that all of its keys share
+    (found with one-key listings) followed by each of SPLIT_CHARS, and the parts are probed in turn.
+    So a flat directory of part-NNNNN keys is split on the digits of the part numbers."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    def first_key(start_after, last):
+        page = client.list_objects_v2(bucket, prefix, start_after=start_after, max_keys=1)
+        keys = [obj['Key'] for obj in page['Contents'] if _in_range(obj['Key'], start_after, last)]
+        return keys[0] if keys else None
+
+    def split(start, last):
+        """Return the shards found in (start, last] and the ranges left to split"""
+        if first_key(start, last) is None:
+            return ([], [])
+        page = client.list_objects_v2(bucket, prefix, start_after=start, max_keys=SHARD_KEYS)
+        objs = [obj for obj in page['Contents'] if _in_range(obj['Key'], start, last)]
+        if len(objs) < len(page['Contents']) or not page['IsTruncated']:
+            return ([(prefix, start, last, objs)], [])
+        shards = [(prefix, start, objs[-1]['Key'], objs)]
+        start = objs[-1]['Key']
+        key = first_key(start, last)
+        if key is None:
+            return (shards, [])
+        # Find the longest prefix of key that every key in the rest of the range begins with
+        (lo, hi) = (len(prefix), len(key))
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if first_key(key[:mid] + LAST_CHAR, last) is None:
+                lo = mid
+            else:
+                hi = mid - 1
+        common = key[:lo]
+        # key[:lo+1] + LAST_CHAR separates key from the keys that do not share its next character
+        bounds = {common + c for c in SPLIT_CHARS} | {key if lo == len(key) else key[:lo+1] + LAST_CHAR}
+        bounds = sorted([b for b in bounds if _in_range(b, start, last) and b != last],
+                        key=lambda b: b.encode('utf-8'))
+        if not bounds:
+            return (shards + [(prefix, start, last, None)], [])
+        return (shards, list(zip([start] + bounds, bounds + [last])))
+
+    shards = []
+    todo = [(None, None)]
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while todo:
+            if len(shards) + len(todo) >= LIST_MAX_SHARDS:
+                shards += [(prefix, start, last, None) for (start, last) in todo]
+                break
+            ranges = []
+            for (found, rest) in pool.map(lambda r: split(*r), todo):
+                shards += found
+                ranges += rest
+            todo = ranges
+    return sorted(shards, key=lambda s: (s[1] is not None, (s[1] or '').encode('utf-8')))
+
+
+def _list_shards(client, bucket, prefix, shard_by, splits, threads=LIST_THREADS):
+    """Divide the keys under prefix into shards. Each shard is (first, start_after, last, objs):
+    it covers the keys k with start_after < k <= last that begin with first (None means no bound),
+    or, if objs is not None, just the objects objs that were found while discovering the shards.
+    Shards are returned in key order and do not overlap."""
+    if shard_by == 'prefix':
+        # Shard on the sub-prefixes below prefix; objects directly below prefix are shards of one key.
+        shards = []
+        for page in client.list_pages(bucket, prefix, delimiter='/'):
+            shards += [(obj['Key'], None, obj['Key'], [obj]) for obj in page['Contents']]
+            shards += [(p['Prefix'], None, None, None) for p in page['CommonPrefixes']]
+        if len([s for s in shards if s[3] is None]) > 1:
+            return sorted(shards, key=lambda s: s[0].encode('utf-8'))
+    elif shard_by != 'range':
+        raise ValueError("shard_by must be 'prefix' or 'range'")
+    if not splits:
+        return _split_ranges(client, bucket, prefix, threads)
+    # Shard on key ranges split at the caller's splits
+    bounds = sorted(splits, key=lambda k: k.encode('utf-8'))
+    starts = [None] + bounds
+    lasts = bounds + [None]
+    return [(prefix, start, last, None) for (start, last) in zip(starts, lasts)]
+
+
+def parallel_list_objects(bucket, prefix='', *, shard_by='prefix', splits=None, ordered=False, limit=None,
+                          threads=LIST_THREADS, progress=None, client=None):
+    """List the objects under a prefix by listing shards of the keyspace concurrently with the
+    in-process client. Returns a generator of the same dictionaries as list_objects().
+    @param shard_by - 'prefix' shards on the sub-prefixes found with the '/' delimiter (falling back to
+                      'range' if there is at most one); 'range' shards on key ranges with start-after.
+    @param splits   - for 'range', the keys at which to split. By default the key ranges are split
+                      until each holds at most SHARD_KEYS keys; see _split_ranges().
+    @param ordered  - if True, generate the keys in key order; otherwise in the order they arrive.
+    @param limit    - stop after this many keys.
+    @param progress - if provided, called as progress(keys, shards_done, shards) after each page.
+    At most LIST_QUEUE_PAGES pages are buffered, so memory is bounded however many keys there are.
+    """
+    import queue
+    from concurrent.futures import ThreadPoolExecutor
+
+    client = client or s3client.default_client()
+    shards = _list_shards(client, bucket, prefix, shard_by, splits, threads)
+    stop = threading.Event()
+    lock = threading.Lock()
+    counts = {'keys': 0, 'done': 0}
+    DONE = object()
+    # An ordered listing drains the shards one at a time, so each needs its own queue
+    if ordered:
+        queues = [queue.Queue(max(1, LIST_QUEUE_PAGES // max(threads, 1))) for s in shards]
+    else:
+        queues = [queue.Queue(LIST_QUEUE_PAGES)] * len(shards)
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def list_shard(i):
+        (first, start_after, last, objs) = shards[i]
+        q = queues[i]
+        try:
+            if objs is not None:
+                pages = [{'Contents': objs}]
+            else:
+                pages = client.list_pages(bucket, first, start_after=start_after)
+            for page in pages:
+                contents = page['Contents']
+                if last is not None:
+                    contents = [o for o in contents if o['Key'].encode('utf-8') <= last.encode('utf-8')]
+                if contents and not put(q, contents):
+                    return
+                with lock:
+                    counts['keys'] += len(contents)
+                    if progress:
+                        progress(counts['keys'], counts['done'], len(shards))
+                if len(contents) < len(page['Contents']):
+                    break       # passed the end of the shard
+            with lock:
+                counts['done'] += 1
+                if progress:
+                    progress(counts['keys'], counts['done'], len(shards))
+            put(q, DONE)
+        except BaseException as e:
+            put(q, e)
+
+    total = 0
+    pool = ThreadPoolExecutor(max_workers=threads)
+    try:
+        for i in range(len(shards)):
+            pool.submit(list_shard, i)
+        remaining = len(shards)
+        i = 0
+        while remaining:
+            item = queues[i].get()
+            if item is DONE:
+                remaining -= 1
+                if ordered:
+                    i += 1
+                continue
+            if isinstance(item, BaseException):
+                raise item
+            for obj in item:
+                yield obj
                 total += 1
                 if limit and total >= limit:
                     return
-
-            if 'NextToken' not in res:
-                return  # no more!
-            next_token = res['NextToken']
-        elif 'CommonPrefixes' in res:
-            for data in res['CommonPrefixes']:
-                yield data
-            return
-        else:
-            return
+    finally:
+        stop.set()
+        pool.shutdown(wait=True, cancel_futures=True)
 
 
-def search_objects(bucket, prefix=None, *, name, delimiter='/', limit=None, searchFoundPrefixes=True, threads=20):
-    """Search for occurences of a name. Returns a list of all found keys as dictionaries.
+async def search_objects_async(bucket, prefix=None, *, name, delimiter='/', limit=None, searchFoundPrefixes=True,
+                               concurrency=20, client=None):
+    """Search for occurences of a name. An async generator that yields each found key as a dictionary
+    as soon as it is found.
     @param bucket - the bucket to search
     @param prefix - the prefix to start with
     @param name   - the name being searched for
     @param delimiter - the delimiter that separates names
-    @param limit  - the maximum number of names keys to return
-    @param searchFoundPrefixes - If true, do not search for prefixes below where name is found.
-    @param threads - the number of Python threds to use. Note that this is all in the same process.
+    @param limit  - the maximum number of names keys to return. Outstanding listings are cancelled when it is reached.
+    @param searchFoundPrefixes - If False, do not search for prefixes below where name is found.
+    @param concurrency - the maximum number of prefixes being listed at once.
+    The listing requests are made by the in-process client on a pool of concurrency threads.
     """
-
-    import queue, threading
-
-    if limit is None:
-        limit = sys.maxsize  # should be big enough
-    ret = []
-
-    def worker():
-        while True:
-            prefix = q.get()
-            if prefix is None:
-                break
+    import asyncio
+    import functools
+    from concurrent.futures import ThreadPoolExecutor
+
+    client = client or s3client.default_client()
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    results = asyncio.Queue()
+    tasks = set()
+    outstanding = [0]     # walks that have not yet reported DONE
+    DONE = object()
+
+    async def walk(prefix):
+        try:
             found_prefixes = []
             found_names = 0
-            for obj in list_objects(bucket, prefix=prefix, delimiter=delimiter):
-                if _Prefix in obj:
-                    found_prefixes.append(obj[_Prefix])
-                if (_Key in obj) and obj[_Key].split(delimiter)[-1] == name:
-                    if len(ret) < limit:
-                        ret.append(obj)
-                if len(ret) > limit:
-                    break
+            token = None
+            async with semaphore:
+                while True:
+                    page = await loop.run_in_executor(executor, functools.partial(
+                        client.list_objects_v2, bucket, prefix, delimiter=delimiter, continuation_token=token))
+                    for obj in page['Contents']:
+                        if obj[_Key].split(delimiter)[-1] == name:
+                            found_names += 1
+                            results.put_nowait(obj)
+                    found_prefixes += [p[_Prefix] for p in page['CommonPrefixes']]
+                    if not page['IsTruncated']:
+                        break
+                    token = page['NextContinuationToken']
             if found_names == 0 or searchFoundPrefixes:
-                if len(ret) < limit:
-                    for lp in found_prefixes:
-                        q.put(lp)
-            q.task_done()
-
-    q = queue.Queue()
-    thread_pool = []
-    for i in range(threads):
-        t = threading.Thread(target=worker)
-        t.start()
-        thread_pool.append(t)
-    q.put(prefix)
-
-    # block until all tasks are done
-    q.join()
-
-    # stop workers
-    for i in range(threads):
-        q.put(None)
-    for t in thread_pool:
-        t.join()
-    return ret
+                for lp in found_prefixes:
+                    spawn(lp)
+            results.put_nowait(DONE)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            results.put_nowait(e)
+
+    def spawn(prefix):
+        # walk() spawns a prefix's children before it reports DONE, so outstanding only reaches 0 at the end
+        outstanding[0] += 1
+        task = asyncio.ensure_future(walk(prefix))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    total = 0
+    spawn(prefix or '')
+    try:
+        while outstanding[0]:
+            item = await results.get()
+            if item is DONE:
+                outstanding[0] -= 1
+                continue
+            if isinstance(item, Exception):
+                raise item
+            yield item
+            total += 1
+            if limit and total >= limit:
+                return
+    finally:
+        for task in list(tasks):
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def run_coroutine(coro):
+    """Run a coroutine to completion from synchronous code and return its result.
+    If this thread is already running an event loop (e.g. in Jupyter or an asyncio service),
+    the coroutine runs on a private event loop in a worker thread, which this thread waits for."""
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, coro).result()
+
+
+def search_objects(bucket, prefix=None, *, name, delimiter='/', limit=None, searchFoundPrefixes=True, threads=20):
+    """Search for occurences of a name. Returns a list of all found keys as dictionaries.
+    This runs search_objects_async() on a new event loop with run_coroutine(); see it for the parameters.
+    @param threads - the number of prefixes to list at once.
+    """
+    async def collect():
+        return [obj async for obj in search_objects_async(bucket, prefix, name=name, delimiter=delimiter, limit=limit,
+                                                           searchFoundPrefixes=searchFoundPrefixes,
+                                                           concurrency=threads)]
+    return run_coroutine(collect())
 
 
 def etag(obj):
@@ -238,8 +776,7 @@ def sum_object_sizes(sobjs):
 
 def any_object_too_small(sobjs):
     """Return if any of the objects in sobjs is too small"""
-    MIN_MULTIPART_COMBINE_OBJECT_SIZE = 0
-    return any([size < MIN_MULTIPART_COMBINE_OBJECT_SIZE for size in object_sizes(sobjs)])
+    return any([size < MIN_PART_SIZE for size in object_sizes(sobjs)])
 
 
 def download_object(tempdir, bucket, obj):
@@ -266,10 +803,199 @@ def concat_downloaded_objects(obj1, obj2):
     return
 
 
-class S3File:
-    """Open an S3 file that can be seeked. This is done by caching to the local file system."""
-
-    def __init__(self, name, mode='rb'):
+def compact_groups(sobjs, target_size=COMPACT_TARGET_SIZE):
+    """Group objects, in key order, into consecutive runs whose total size reaches target_size.
+    Returns a list of lists of objects. Objects that are target_size or larger are left out, since there is
+    nothing to gain from copying them."""
+    groups = []
+    group = []
+    total = 0
+    for obj in sorted(sobjs, key=lambda obj: obj[_Key]):
+        if obj[_Size] >= target_size:
+            continue
+        if group and total + obj[_Size] > target_size:
+            groups.append(group)
+            (group, total) = ([], 0)
+        group.append(obj)
+        total += obj[_Size]
+    if group:
+        groups.append(group)
+    return [group for group in groups if len(group) > 1]
+
+
+def compact_plan(group, min_part_size=MIN_PART_SIZE):
+    """Plan the parts of a multipart upload that concatenates a group of objects.
+    Returns a list of parts, each either ('copy', key, start, end), to be copied inside S3 with upload-part-copy,
+    or ('merge', [(key, start, end), ...]), to be downloaded and uploaded as one part.
+    Every part except the last is at least min_part_size. Small objects are merged together; a merge that
+    is still too small when it reaches a large object is filled up from the beginning of the large object."""
+    parts = []
+    merge = []
+    merge_len = 0
+    for obj in group:
+        (key, size, offset) = (obj[_Key], obj[_Size], 0)
+        if merge_len > 0 and size > 0:
+            offset = min(min_part_size - merge_len, size)
+            merge.append((key, 0, offset))
+            merge_len += offset
+            if merge_len >= min_part_size:
+                parts.append(('merge', merge))
+                (merge, merge_len) = ([], 0)
+        if size - offset >= min_part_size:
+            while offset < size:
+                end = min(offset + MAX_COPY_PART_SIZE, size)
+                if 0 < size - end < min_part_size:
+                    end = size - min_part_size      # leave the final copy large enough
+                parts.append(('copy', key, offset, end))
+                offset = end
+        elif size > offset:
+            merge.append((key, offset, size))
+            merge_len += size - offset
+    if merge:
+        parts.append(('merge', merge))
+    return parts
+
+
+def compact_object(bucket, group, dest_key, *, min_part_size=MIN_PART_SIZE, client=None):
+    """Concatenate a group of objects in bucket into dest_key, using compact_plan().
+    Returns a dictionary describing the new object."""
+    client = client or s3client.default_client()
+    plan = compact_plan(group, min_part_size)
+
+    def merged(ranges):
+        return b''.join(client.get_range(bucket, key, start, end - start) for (key, start, end) in ranges)
+
+    if len(plan) == 1 and plan[0][0] == 'merge':
+        result = client.put_object(bucket, dest_key, merged(plan[0][1]))
+    else:
+        upload_id = client.create_multipart_upload(bucket, dest_key)
+        try:
+            etags = []
+            for (part_number, part) in enumerate(plan, 1):
+                if part[0] == 'copy':
+                    (_, key, start, end) = part
+                    etags.append((part_number, client.upload_part_copy(bucket, dest_key, upload_id, part_number,
+                                                                       bucket, key, start, end)))
+                else:
+                    etags.append((part_number, client.upload_part(bucket, dest_key, upload_id, part_number,
+                                                                  merged(part[1]))))
+            result = client.complete_multipart_upload(bucket, dest_key, upload_id, etags)
+        except BaseException:
+            client.abort_multipart_upload(bucket, dest_key, upload_id)
+            raise
+    return {_Key: dest_key, _Size: sum(obj[_Size] for obj in group), _ETag: result['ETag'],
+            'Sources': [obj[_Key] for obj in group],
+            'CopiedParts': len([p for p in plan if p[0] == 'copy']),
+            'MergedParts': len([p for p in plan if p[0] == 'merge'])}
+
+
+def compact_objects(bucket, prefix, dest_prefix, *, target_size=COMPACT_TARGET_SIZE, suffix='',
+                    threads=TRANSFER_THREADS, min_part_size=MIN_PART_SIZE, client=None):
+    """Compact the small objects under prefix into objects of about target_size under dest_prefix,
+    named part-00000{suffix}, part-00001{suffix}, ... The data is copied inside S3 with upload-part-copy
+    wherever the parts are large enough. The groups are built in parallel by threads threads.
+    The source objects are not deleted. Returns a list of the compact_object() results."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    client = client or s3client.default_client()
+    if dest_prefix.startswith(prefix):
+        raise ValueError("dest_prefix {} must not be under prefix {}".format(dest_prefix, prefix))
+    groups = compact_groups(list_objects(bucket, prefix, parallel=True, client=client), target_size)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        futures = [pool.submit(compact_object, bucket, group, "{}part-{:05}{}".format(dest_prefix, i, suffix),
+                               min_part_size=min_part_size, client=client)
+                   for (i, group) in enumerate(groups)]
+        return [f.result() for f in futures]
+
+
+class BlockCache:
+    """A thread-safe LRU cache of aligned object blocks, bounded by the total bytes held.
+    Blocks are keyed by (bucket, key, ETag, block size, block number), so a block of an
+    object that has since changed is never returned."""
+
+    def __init__(self, max_bytes=BLOCK_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.blocks = OrderedDict()
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, k):
+        with self.lock:
+            try:
+                block = self.blocks[k]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.blocks.move_to_end(k)
+            self.hits += 1
+            return block
+
+    def put(self, k, block):
+        with self.lock:
+            if k in self.blocks:
+                self.bytes -= len(self.blocks.pop(k))
+            self.blocks[k] = block
+            self.bytes += len(block)
+            while self.bytes > self.max_bytes and len(self.blocks) > 1:
+                (_, old) = self.blocks.popitem(last=False)
+                self.bytes -= len(old)
+                self.evictions += 1
+
+    def __contains__(self, k):
+        """Test for a block without counting a hit or miss or changing its LRU position"""
+        with self.lock:
+            return k in self.blocks
+
+    def clear(self):
+        with self.lock:
+            self.blocks.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'blocks': len(self.blocks), 'bytes': self.bytes}
+
+
+block_cache = BlockCache()
+
+_readahead_pool = None
+_readahead_pid = None
+
+
+def readahead_pool():
+    """Return the process-wide thread pool that S3File uses for readahead, creating it after a fork"""
+    global _readahead_pool, _readahead_pid
+    from concurrent.futures import ThreadPoolExecutor
+
+    if _readahead_pid != os.getpid():
+        _readahead_pool = ThreadPoolExecutor(max_workers=READAHEAD_THREADS, thread_name_prefix='s3readahead')
+        _readahead_pid = os.getpid()
+    return _readahead_pool
+
+
+class S3File(io.RawIOBase):
+    """Open an S3 file that can be seeked. Reads are made with in-process ranged GETs of aligned
+    blocks, which are kept in a size-bounded LRU cache shared by all S3File objects in the process.
+    S3File is an io.RawIOBase, so it can be wrapped with io.BufferedReader, and readinto(), view()
+    and iter_views() give access to the cached blocks without the extra copy that read() makes.
+    When reads are sequential, the following blocks are prefetched on a background thread pool.
+    The readahead starts at one block and doubles with each further sequential read, up to
+    readahead_blocks; a seek elsewhere turns it off until reads are sequential again."""
+
+    def __init__(self, name, mode='rb', *, block_size=BLOCK_SIZE, cache=None, client=None,
+                 readahead_blocks=READAHEAD_BLOCKS):
+        """
+        @param block_size - the size of the aligned blocks that are read and cached.
+        @param cache      - the BlockCache to use. Defaults to the process-wide block_cache.
+        @param client     - the s3client.S3Client to use. Defaults to s3client.default_client().
+        @param readahead_blocks - the most blocks to prefetch; 0 disables readahead.
+        """
+        super().__init__()
+        self.pending = dict()       # block number -> future of a prefetch
         self.name = name
         self.url = urlparse(name)
         if self.url.scheme != 's3':
@@ -277,74 +1003,188 @@ class S3File:
         self.bucket = self.url.netloc
         self.key = self.url.path[1:]
         self.fpos = 0
-        self.tf = tempfile.NamedTemporaryFile()
-        cmd = ['aws', 's3api', 'list-objects', '--bucket', self.bucket, '--prefix', self.key, '--output', 'json']
-        data = json.loads(subprocess.Popen(cmd, encoding='utf8', stdout=subprocess.PIPE).communicate()[0])
-        file_info = data['Contents'][0]
-        self.length = file_info['Size']
+        self.block_size = block_size
+        self.cache = cache if cache is not None else block_cache
+        self.client = client or s3client.default_client()
+        file_info = stat_object(self.bucket, self.key, client=self.client)
+        if file_info is None:
+            raise FileNotFoundError(self.name)
+        self.length = file_info['ContentLength']
         self.ETag = file_info['ETag']
-
-        # Load the caches
-
-        self.frontcache = self._readrange(0, READ_CACHE_SIZE)  # read the first 1024 bytes and get length of the file
-        if self.length > READ_CACHE_SIZE:
-            self.backcache_start = self.length - READ_CACHE_SIZE
-            if debug:
-                print("backcache starts at {}".format(self.backcache_start))
-            self.backcache = self._readrange(self.backcache_start, READ_CACHE_SIZE)
+        self.readahead_blocks = readahead_blocks
+        self.refreshable = True     # nothing has been read yet, so a changed object can be reopened
+        self.readahead = 0          # blocks currently being read ahead
+        self.last_end = None        # end of the previous read
+        self.prefetched = -1        # highest block submitted for prefetch
+
+    def _cache_key(self, n):
+        return (self.bucket, self.key, self.ETag, self.block_size, n)
+
+    def _fetch(self, first, last):
+        """Read blocks first..last with a single ranged GET and add them to the cache"""
+        start = first * self.block_size
+        end = min((last + 1) * self.block_size, self.length)
+        if debug:
+            print("fetch blocks {}..{} bytes={}-{}".format(first, last, start, end - 1))
+        try:
+            data = self.client.get_range(self.bucket, self.key, start, end - start, etag=self.ETag)
+        except s3client.S3Error as e:
+            if e.status != 412:
+                raise
+            # The object changed since its metadata was cached. Before anything has been read,
+            # reopen it with a fresh HEAD and try once more; after that, the read must fail.
+            metadata_cache.invalidate(self.bucket, self.key)
+            if not self.refreshable:
+                raise
+            self.refreshable = False
+            file_info = stat_object(self.bucket, self.key, client=self.client)
+            if file_info is None:
+                raise FileNotFoundError(self.name)
+            (self.length, self.ETag) = (file_info['ContentLength'], file_info['ETag'])
+            end = min((last + 1) * self.block_size, self.length)
+            data = self.client.get_range(self.bucket, self.key, start, end - start, etag=self.ETag)
+        if len(data) != end - start:
+            raise RuntimeError("{}: expected {} bytes at {}, got {}".format(self.name, end - start, start, len(data)))
+        blocks = [data[i:i + self.block_size] for i in range(0, len(data), self.block_size)]
+        for (n, block) in enumerate(blocks, first):
+            self.cache.put(self._cache_key(n), block)
+        return blocks
+
+    def _blocks(self, first, last):
+        """Return the list of blocks first..last, fetching each run of missing blocks with one request"""
+        blocks = [self.cache.get(self._cache_key(n)) for n in range(first, last + 1)]
+        for (i, n) in enumerate(range(first, last + 1)):
+            f = self.pending.pop(n, None)
+            if blocks[i] is None and f is not None and not f.cancelled() and f.exception() is None:
+                blocks[i] = f.result()[0]       # a prefetch that failed is fetched again below
+        n = 0
+        while n < len(blocks):
+            if blocks[n] is not None:
+                n += 1
+                continue
+            m = n
+            while m + 1 < len(blocks) and blocks[m + 1] is None:
+                m += 1
+            blocks[n:m + 1] = self._fetch(first + n, first + m)
+            n = m + 1
+        return blocks
+
+    def _readahead(self, start, end, last):
+        """Adjust the readahead for a read of start..end and prefetch the blocks after last"""
+        if self.last_end is not None and self.last_end <= start <= self.last_end + self.block_size:
+            self.readahead = min(max(1, self.readahead * 2), self.readahead_blocks)
         else:
-            self.backcache = None
+            self.readahead = 0
+            for f in self.pending.values():
+                f.cancel()
+            self.pending.clear()
+            self.prefetched = last
+        self.last_end = end
+        pool = readahead_pool()
+        final = min(last + self.readahead, (self.length - 1) // self.block_size)
+        for n in range(max(last, self.prefetched) + 1, final + 1):
+            if self._cache_key(n) not in self.cache:
+                self.pending[n] = pool.submit(self._fetch, n, n)
+            self.prefetched = n
+
+    def _views(self, start, end, readahead=True):
+        """Return memoryviews over the cached blocks that hold bytes start..end-1. Nothing is copied.
+        @param readahead - if False, the caller adjusts the readahead itself with the bytes it consumed.
+        """
+        end = min(end, self.length)
+        if start >= end:
+            return []
+        first = start // self.block_size
+        last = (end - 1) // self.block_size
+        blocks = self._blocks(first, last)
+        self.refreshable = False
+        if self.readahead_blocks and readahead:
+            self._readahead(start, end, last)
+        views = [memoryview(block) for block in blocks]
+        views[-1] = views[-1][0:end - last * self.block_size]
+        views[0] = views[0][start - first * self.block_size:]
+        return views
 
     def _readrange(self, start, length):
-        # This is gross; we copy everything to the named temporary file, rather than a pipe
-        # because the pipes weren't showing up in /dev/fd/?
-        # We probably want to cache also... That's coming
-        cmd = ['aws', 's3api', 'get-object', '--bucket', self.bucket, '--key', self.key, '--output', 'json',
-               '--range', 'bytes={}-{}'.format(start, start + length - 1), self.tf.name]
-        if debug:
-            print(cmd)
-        data = json.loads(subprocess.Popen(cmd, encoding='utf8', stdout=subprocess.PIPE).communicate()[0])
-        if debug:
-            print(data)
-        self.tf.seek(0)  # go to the beginning of the data just read
-        return self.tf.read(length)  # and read that much
+        views = self._views(start, start + length)
+        if len(views) == 1:
+            return views[0].tobytes()
+        return b''.join(views)
 
     def __repr__(self):
         return "FakeFile<name:{} url:{}>".format(self.name, self.url)
 
-    def read(self, length=-1):
-        # If length==-1, figure out the max we can read to the end of the file
-        if length == -1:
-            length = min(MAX_READ, self.length - self.fpos + 1)
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
 
+    def read(self, length=-1):
+        if length is None or length < 0:
+            return self.readall()
         if debug:
             print("read: fpos={}  length={}".format(self.fpos, length))
-        # Can we satisfy from the front cache?
-        if self.fpos < READ_CACHE_SIZE and self.fpos + length < READ_CACHE_SIZE:
-            if debug:
-                print("front cache")
-            buf = self.frontcache[self.fpos:self.fpos + length]
-            self.fpos += len(buf)
-            if debug:
-                print("return 1: buf=", buf)
-            return buf
-
-        # Can we satisfy from the back cache?
-        if self.backcache and (self.length - READ_CACHE_SIZE < self.fpos):
-            if debug:
-                print("back cache")
-            buf = self.backcache[self.fpos - self.backcache_start:self.fpos - self.backcache_start + length]
-            self.fpos += len(buf)
-            if debug:
-                print("return 2: buf=", buf)
-            return buf
-
         buf = self._readrange(self.fpos, length)
         self.fpos += len(buf)
-        if debug:
-            print("return 3: buf=", buf)
         return buf
 
+    def readall(self):
+        """Read from the current position to the end of the file"""
+        return self.read(max(0, self.length - self.fpos))
+
+    def readline(self, size=-1):
+        """Read up to and including the next newline, or at most size bytes, scanning the cached
+        blocks in place. Iterating over an S3File uses this, so lines stream with readahead."""
+        end = self.length if size is None or size < 0 else min(self.length, self.fpos + size)
+        start = pos = self.fpos
+        parts = []
+        while pos < end:
+            block_end = min((pos // self.block_size + 1) * self.block_size, end)
+            (view,) = self._views(pos, block_end, readahead=False)
+            offset = pos % self.block_size
+            i = view.obj.find(b'\n', offset, offset + len(view))
+            if i >= 0:
+                parts.append(view[0:i - offset + 1])
+                pos += i - offset + 1
+                break
+            parts.append(view)
+            pos = block_end
+        if pos > start and self.readahead_blocks:
+            self._readahead(start, pos, (pos - 1) // self.block_size)
+        self.fpos = pos
+        return b''.join(parts)
+
+    def readinto(self, b):
+        """Read into the writable buffer b, copying straight from the cached blocks.
+        Returns the number of bytes read, which is 0 at end of file."""
+        out = memoryview(b).cast('B')
+        n = 0
+        for view in self._views(self.fpos, self.fpos + len(out)):
+            out[n:n + len(view)] = view
+            n += len(view)
+        self.fpos += n
+        return n
+
+    def view(self, start, length):
+        """Return a read-only memoryview of length bytes at start, without moving the file position.
+        A range that lies within one block is a view of the cached block and is not copied;
+        a range that spans blocks is joined into a new buffer. The view stays valid after the
+        block is evicted from the cache, so numpy.frombuffer() can be used on it directly."""
+        views = self._views(start, start + length)
+        if len(views) == 1:
+            return views[0]
+        return memoryview(b''.join(views))
+
+    def iter_views(self, start=0, length=None):
+        """Generate zero-copy memoryviews of the cached blocks covering length bytes at start
+        (by default, to the end of the file), one block at a time."""
+        end = self.length if length is None else min(start + length, self.length)
+        while start < end:
+            block_end = min((start // self.block_size + 1) * self.block_size, end)
+            yield from self._views(start, block_end)
+            start = block_end
+
     def seek(self, offset, whence=0):
         if debug:
             print("seek({},{})".format(offset, whence))
@@ -358,23 +1198,389 @@ class S3File:
             raise RuntimeError("whence={}".format(whence))
         if debug:
             print("   ={}  (self.length={})".format(self.fpos, self.length))
+        return self.fpos
 
     def tell(self):
         return self.fpos
 
-    def write(self):
+    def write(self, b=None):
         raise RuntimeError("Write not supported")
 
     def flush(self):
-        raise RuntimeError("Flush not supported")
+        return
 
     def close(self):
-        return
+        for f in self.pending.values():
+            f.cancel()
+        self.pending.clear()
+        super().close()
+
+
+class S3TextFile(io.TextIOBase):
+    """A text-mode S3File. Lines are found in the cached blocks and decoded incrementally, so
+    iterating over a large object streams it with readahead. Unlike io.TextIOWrapper, tell() and
+    seek() use plain byte offsets, so a reader can note where a line starts and resume there later.
+    The encoding must be ASCII-compatible (e.g. utf-8 or latin1), so that every b'\\n' ends a line.
+    Lines are returned with their newlines unchanged."""
+
+    def __init__(self, name, encoding='utf-8', errors='strict', **kwargs):
+        """
+        @param name   - an s3:// URL, or an S3File to decode.
+        @param kwargs - passed to S3File().
+        """
+        import codecs
+
+        super().__init__()
+        if '\n'.encode(encoding) != b'\n':
+            raise ValueError("{} is not an ASCII-compatible encoding".format(encoding))
+        self.raw = name if isinstance(name, S3File) else S3File(name, **kwargs)
+        self.name = self.raw.name
+        self._encoding = encoding
+        self._errors = errors
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors)
+
+    def __repr__(self):
+        return "S3TextFile<name:{} encoding:{}>".format(self.name, self._encoding)
+
+    @property
+    def encoding(self):
+        return self._encoding
+
+    @property
+    def errors(self):
+        return self._errors
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def _decode(self, data):
+        return self.decoder.decode(data, final=self.raw.tell() >= self.raw.length)
+
+    def read(self, size=-1):
+        """Read at most size characters, or to the end of the file"""
+        if size is None or size < 0:
+            return self._decode(self.raw.read(self.raw.length - self.raw.tell()))
+        out = ''
+        while len(out) < size:
+            # size - len(out) bytes never decode to more characters than that
+            data = self.raw.read(size - len(out))
+            if not data:
+                break
+            out += self._decode(data)
+        return out
+
+    def readline(self, size=-1):
+        """Read a line, or at most size bytes of it"""
+        return self._decode(self.raw.readline(size))
+
+    def tell(self):
+        """Return the byte offset of the next character"""
+        return self.raw.tell() - len(self.decoder.getstate()[0])
+
+    def seek(self, offset, whence=0):
+        """Move to a byte offset, which should be at the start of a character"""
+        self.decoder.reset()
+        return self.raw.seek(offset, whence)
+
+    def close(self):
+        self.raw.close()
+        super().close()
+
+
+class S3MultipartWriter(io.RawIOBase):
+    """A write-only file that streams to an S3 object with a multipart upload.
+    Writes are buffered into parts of part_size, which are uploaded by a pool of threads
+    while the caller keeps writing. At most max_inflight parts are queued or uploading
+    at once; write() blocks until one finishes, so memory is bounded by about
+    (max_inflight + 1) * part_size. close() uploads the last part and completes the upload.
+    An object smaller than part_size is sent with a single PUT.
+    If anything fails the upload is aborted, so no partial object is left behind.
+    With digests, each part is sent with its Content-MD5 so that S3 rejects a corrupted part, and
+    .result holds the MD5, SHA256 and MultipartETag of the object as well as its ETag. The hashing is
+    done on the writing thread, which can limit the throughput of a fast upload, so it is off by default.
+    With store_digests the MD5 and SHA-256 are also stored as the object's metadata. A multipart
+    upload only knows them at the end, so its metadata is then replaced with a copy within S3."""
+
+    def __init__(self, path, *, part_size=PART_SIZE, threads=TRANSFER_THREADS, max_inflight=None,
+                 metadata=None, client=None, digests=False, store_digests=False):
+        from concurrent.futures import ThreadPoolExecutor
+
+        super().__init__()
+        self.path = path
+        (self.bucket, self.key) = get_bucket_key(path)
+        self.part_size = part_size
+        self.metadata = metadata
+        self.client = client or s3client.default_client()
+        self.digests = TransferDigests(part_size) if digests or store_digests else None
+        self.store_digests = store_digests
+        self.length = 0
+        self.buf = bytearray()
+        self.upload_id = None
+        self.futures = []       # (part_number, future) in part_number order
+        self.result = None
+        self.inflight = threading.BoundedSemaphore(max_inflight or threads)
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+
+    def __repr__(self):
+        return "S3MultipartWriter<path:{} upload_id:{}>".format(self.path, self.upload_id)
+
+    def writable(self):
+        return True
+
+    def _upload_part(self, part_number, data, content_md5):
+        try:
+            return self.client.upload_part(self.bucket, self.key, self.upload_id, part_number, data,
+                                           content_md5=content_md5)
+        finally:
+            self.inflight.release()
+
+    def _check(self):
+        """Raise the error of any part that has failed"""
+        for (_, f) in self.futures:
+            if f.done() and f.exception():
+                raise f.exception()
+
+    def _submit(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(self.bucket, self.key, metadata=self.metadata)
+        part_number = len(self.futures) + 1
+        if part_number > MAX_PARTS:
+            raise RuntimeError("{}: more than {} parts; increase part_size".format(self.path, MAX_PARTS))
+        content_md5 = None
+        if self.digests:
+            self.digests.update(data)
+            self.digests.finish()           # only the last part can be short
+            content_md5 = self.digests.part_md5s[-1]
+        self.inflight.acquire()
+        self.futures.append((part_number, self.pool.submit(self._upload_part, part_number, data, content_md5)))
+
+    def write(self, b):
+        if self.closed:
+            raise ValueError("write to closed file")
+        try:
+            self._check()
+            self.buf += b
+            self.length += len(b)
+            while len(self.buf) >= self.part_size:
+                data = bytes(self.buf[0:self.part_size])
+                del self.buf[0:self.part_size]
+                self._submit(data)
+        except BaseException:
+            self.abort()
+            raise
+        return len(b)
+
+    def abort(self):
+        """Cancel outstanding parts and abort the multipart upload"""
+        for (_, f) in self.futures:
+            f.cancel()
+        self.pool.shutdown(wait=True)
+        if self.upload_id is not None:
+            try:
+                self.client.abort_multipart_upload(self.bucket, self.key, self.upload_id)
+            except (RuntimeError, OSError) as e:
+                logging.warning("%s: cannot abort upload %s: %s", self.path, self.upload_id, e)
+            self.upload_id = None
+        super().close()
+
+    def close(self):
+        if self.closed:
+            return
+        metadata_cache.invalidate(self.bucket, self.key)
+        try:
+            if self.upload_id is None:
+                data = bytes(self.buf)
+                metadata = self.metadata
+                content_md5 = None
+                if self.digests:
+                    self.digests.update(data)
+                    self.digests.finish()
+                    content_md5 = self.digests.md5.digest()
+                if self.store_digests:
+                    metadata = dict(metadata or {}, **self.digests.metadata())
+                self.result = self.client.put_object(self.bucket, self.key, data, metadata=metadata,
+                                                     content_md5=content_md5)
+            else:
+                if self.buf:
+                    self._submit(bytes(self.buf))
+                parts = [(part_number, f.result()) for (part_number, f) in self.futures]
+                self.result = self.client.complete_multipart_upload(self.bucket, self.key, self.upload_id, parts)
+                self.upload_id = None
+                if self.store_digests:
+                    self.result.update(replace_metadata(self.bucket, self.key, self.length,
+                                                        dict(self.metadata or {}, **self.digests.metadata()),
+                                                        client=self.client))
+            if self.digests:
+                self.result.update(self.digests.result())
+            self.buf = bytearray()
+        except BaseException:
+            self.abort()
+            raise
+        self.pool.shutdown(wait=True)
+        super().close()
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        if exception_type is not None:
+            self.abort()
+        else:
+            self.close()
+
 
 #
 # S3 Cache
 #
 
+class DiskCache:
+    """A read-through cache of S3 objects on local disk that can be shared by all of the processes on a node.
+    Entries are keyed by bucket, key and ETag, so an object that has changed is downloaded again.
+    The index is an SQLite3 database in the cache directory. New entries are downloaded to a temporary file
+    and renamed into place, and a lock file per entry ensures that only one process downloads it.
+    When the cache holds more than max_bytes, the least-recently used entries are evicted."""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS entries (bucket TEXT, key TEXT, etag TEXT, fname TEXT, size INTEGER, atime REAL,
+                                        PRIMARY KEY (bucket, key));
+    CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime);
+    CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER);
+    """
+
+    def __init__(self, cache_dir=READTHROUGH_CACHE_DIR, max_bytes=READTHROUGH_CACHE_BYTES, client=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.client = client
+        os.makedirs(os.path.join(cache_dir, 'data'), exist_ok=True)
+        with self._db() as db:
+            db.executescript(self.SCHEMA)
+
+    def __repr__(self):
+        return "DiskCache<cache_dir:{} max_bytes:{}>".format(self.cache_dir, self.max_bytes)
+
+    def _db(self):
+        # A connection for each operation, because neither processes nor threads can share one
+        db = sqlite3.connect(os.path.join(self.cache_dir, 'index.db'), timeout=60, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def _fname(self, bucket, key, etag):
+        h = hashlib.sha256("{}/{}/{}".format(bucket, key, etag).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, 'data', h[0:2], h)
+
+    @staticmethod
+    def _count(db, name, value=1):
+        db.execute("INSERT INTO stats (name, value) VALUES (?, ?) "
+                   "ON CONFLICT(name) DO UPDATE SET value=value+excluded.value", (name, value))
+
+    def _lookup(self, db, bucket, key, etag, fname):
+        """Return True and touch the entry if it is present"""
+        c = db.execute("UPDATE entries SET atime=? WHERE bucket=? AND key=? AND etag=?",
+                       (time.time(), bucket, key, etag))
+        if c.rowcount == 1 and os.path.exists(fname):
+            self._count(db, 'hits')
+            return True
+        return False
+
+    def _install(self, db, bucket, key, etag, fname, size):
+        """Record a new entry, removing the previous version of the object and evicting LRU entries"""
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for (old,) in db.execute("SELECT fname FROM entries WHERE bucket=? AND key=? AND etag!=?",
+                                     (bucket, key, etag)).fetchall():
+                self._unlink(old)
+            db.execute("INSERT OR REPLACE INTO entries (bucket, key, etag, fname, size, atime) VALUES (?,?,?,?,?,?)",
+                       (bucket, key, etag, fname, size, time.time()))
+            self._count(db, 'misses')
+            self._count(db, 'downloaded_bytes', size)
+            (total,) = db.execute("SELECT COALESCE(SUM(size),0) FROM entries").fetchone()
+            if total > self.max_bytes:
+                for (b, k, f, sz) in db.execute("SELECT bucket, key, fname, size FROM entries "
+                                                "ORDER BY atime").fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    if f == fname:
+                        continue
+                    db.execute("DELETE FROM entries WHERE bucket=? AND key=?", (b, k))
+                    self._unlink(f)
+                    self._count(db, 'evictions')
+                    total -= sz
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _unlink(fname):
+        for f in [fname, fname + '.lock']:
+            try:
+                os.unlink(f)
+            except FileNotFoundError:
+                pass
+
+    def get(self, bucket, key, **kwargs):
+        """Return the name of a local file holding the current version of the object,
+        downloading it with _parallel_download() (passing kwargs) if it is not in the cache."""
+        client = self.client or s3client.default_client()
+        info = client.head_object(bucket, key)
+        etag = s3client.strip_etag(info['ETag'])
+        fname = self._fname(bucket, key, etag)
+        db = self._db()
+        try:
+            if self._lookup(db, bucket, key, etag, fname):
+                return fname
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            with open(fname + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                # Another process may have installed it while we waited for the lock
+                if self._lookup(db, bucket, key, etag, fname):
+                    return fname
+                (fd, tmpname) = tempfile.mkstemp(dir=os.path.dirname(fname), prefix='.tmp')
+                try:
+                    _parallel_download(bucket, key, fd, client=client, info=info, **kwargs)
+                    os.close(fd)
+                    os.rename(tmpname, fname)
+                except BaseException:
+                    os.close(fd)
+                    os.unlink(tmpname)
+                    raise
+                self._install(db, bucket, key, etag, fname, info['ContentLength'])
+            return fname
+        finally:
+            db.close()
+
+    def open(self, path, mode='r', encoding=None, **kwargs):
+        """Open a cached copy of an s3:// path"""
+        (bucket, key) = get_bucket_key(path)
+        try:
+            return open(self.get(bucket, key, **kwargs), mode=mode, encoding=encoding)
+        except FileNotFoundError:
+            # Evicted by another process between get() and open()
+            return open(self.get(bucket, key, **kwargs), mode=mode, encoding=encoding)
+
+    def stats(self):
+        """Return the node-wide hits, misses, evictions and downloaded_bytes, and the current entries and bytes"""
+        db = self._db()
+        try:
+            ret = {'hits': 0, 'misses': 0, 'evictions': 0, 'downloaded_bytes': 0}
+            ret.update(db.execute("SELECT name, value FROM stats").fetchall())
+            (ret['entries'], ret['bytes']) = db.execute("SELECT COUNT(*), COALESCE(SUM(size),0) FROM entries").fetchone()
+            return ret
+        finally:
+            db.close()
+
+
+_disk_cache = None
+
+
+def disk_cache():
+    """Return the process-wide DiskCache in READTHROUGH_CACHE_DIR"""
+    global _disk_cache
+    if _disk_cache is None:
+        _disk_cache = DiskCache()
+    return _disk_cache
+
+
 # Tools for reading and write files from Amazon S3 without boto or boto3
 # http://boto.cloudhackers.com/en/latest/s3_tut.html
 # but it is easier to use the AWS cli, since it's configured to work.
@@ -383,13 +1589,19 @@ class S3File:
 # Todo: redesign so that it can be used in a "with" statement
 
 class s3open:
-    def __init__(self, path, mode="r", encoding=sys.getdefaultencoding(), cache=False, fsync=False):
+    def __init__(self, path, mode="r", encoding=sys.getdefaultencoding(), cache=False, fsync=False,
+                 parallel=False, part_size=PART_SIZE, threads=TRANSFER_THREADS):
         """
         Open an s3 file for reading or writing. Can handle any size, but cannot seek.
-        We could use boto.
-        http://boto.cloudhackers.com/en/latest/s3_tut.html
-        but it is easier to use the aws cli, since it is present and more likely to work.
-        @param fsync - if True and mode is writing, use object-exists to wait for the object to be created.
+        Reads stream through an S3File and writes through an S3MultipartWriter, both using the
+        process-wide client (see s3client.make_client() to use the aws CLI instead).
+        @param fsync - if True and mode is writing, poll until the object can be seen.
+        @param cache - if True and mode is reading, read through the process-wide DiskCache.
+                       May also be a DiskCache.
+        @param parallel - if True and mode is reading, first download the object to an anonymous temporary
+                          file with parallel ranged GETs of part_size, using threads threads.
+                          if True and mode is writing, upload the parts of the S3MultipartWriter with
+                          threads threads rather than one.
         """
         if not path.startswith("s3://"):
             raise ValueError("Invalid path: " + path)
@@ -402,35 +1614,29 @@ class s3open:
         self.encoding = encoding
         self.cache = cache
         self.fsync = fsync
-
-        cache_name = os.path.join(READTHROUGH_CACHE_DIR, path.replace("/", "_"))
-
-        # If not caching and a cache file is present, delete it. 
-        if not cache and os.path.exists(cache_name):
-            os.unlink(cache_name)
-
-        if cache and ('w' not in mode):
-            os.makedirs(READTHROUGH_CACHE_DIR, exist_ok=True)
-            if os.path.exists(cache_name):
-                self.file_obj = open(cache_name, mode=mode, encoding=encoding)
+        self.writer = None
 
         assert 'a' not in mode
         assert '+' not in mode
 
-        if "r" in mode:
-            if cache:
-                subprocess.check_call(['aws', 's3', 'cp', '--quiet', path, cache_name])
-                open(cache_name, mode=mode, encoding=encoding)
-            self.p = subprocess.Popen(['aws', 's3', 'cp', '--quiet', path, '-'],
-                                      stdout=subprocess.PIPE,
-                                      stderr=subprocess.PIPE,
-                                      encoding=encoding)
-            self.file_obj = self.p.stdout
+        if "r" in mode and cache:
+            cache = cache if isinstance(cache, DiskCache) else disk_cache()
+            self.file_obj = cache.open(path, mode=mode, encoding=encoding, part_size=part_size, threads=threads)
+        elif "r" in mode:
+            if parallel:
+                (bucket, key) = get_bucket_key(path)
+                tf = tempfile.TemporaryFile()
+                _parallel_download(bucket, key, tf.fileno(), part_size=part_size, threads=threads)
+                self.file_obj = tf if encoding is None else io.TextIOWrapper(tf, encoding=encoding)
+            else:
+                # A private block cache keeps a streaming read from evicting the shared one
+                raw = S3File(path, cache=BlockCache(max_bytes=(READAHEAD_BLOCKS + 1) * BLOCK_SIZE))
+                self.file_obj = raw if encoding is None else S3TextFile(raw, encoding=encoding)
 
         elif "w" in mode:
-            self.p = subprocess.Popen(['aws', 's3', 'cp', '--quiet', '-', path],
-                                      stdin=subprocess.PIPE, encoding=encoding)
-            self.file_obj = self.p.stdin
+            # Without parallel, one thread uploads each part while the next is written
+            self.writer = S3MultipartWriter(path, part_size=part_size, threads=threads if parallel else 1)
+            self.file_obj = self.writer if encoding is None else io.TextIOWrapper(self.writer, encoding=encoding)
         else:
             raise RuntimeError("invalid mode:{}".format(mode))
 
@@ -438,15 +1644,21 @@ class s3open:
         return self.file_obj
 
     def __exit__(self, exception_type, exception_value, traceback):
+        if exception_type is not None and self.writer is not None:
+            self.writer.abort()
         self.file_obj.close()
-        if self.p.wait() != 0:
-            raise RuntimeError(self.p.stderr.read())
         self.waitObjectExists()
 
     def waitObjectExists(self):
+        """Poll until the object can be seen, as 'aws s3api wait object-exists' does"""
         if self.fsync and "w" in self.mode:
             (bucket, key) = get_bucket_key(self.path)
-            aws_s3api(['wait', 'object-exists', '--bucket', bucket, '--key', key])
+            for _ in range(WAIT_ATTEMPTS):
+                try:
+                    return s3client.default_client().head_object(bucket, key)
+                except FileNotFoundError:
+                    time.sleep(WAIT_DELAY)
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), self.path)
 
     # The following 4 methods are only needed for direct use of s3open as object, outside with-statement, rather than as a context manager
     def __iter__(self):
@@ -463,20 +1675,350 @@ class s3open:
         return self.file_obj.close()
 
 
-def s3exists(path):
-    """Return True if the S3 file exists. Should be replaced with an s3api function"""
-    out = subprocess.Popen(['aws', 's3', 'ls', '--page-size', '10', path],
-                           stdout=subprocess.PIPE, encoding='utf-8').communicate()[0]
-    return len(out) > 0
+def s3exists(path, *, client=None, cache=None):
+    """Return True if the S3 object exists, or if any object exists below it, as 'aws s3 ls' would.
+    Uses and fills the metadata cache."""
+    return s3exists_many([path], client=client, cache=cache)[path]
+
+
+def _before(key):
+    """Return a start-after value that lists every key >= key"""
+    if not key or key[-1] == '\0':
+        return key[0:-1]
+    return key[0:-1] + chr(ord(key[-1]) - 1) + KEY_MAX
+
+
+def _exists_group(client, cache, bucket, keys):
+    """Resolve the sorted keys of one group with as few listings as possible. Each listing starts at
+    the first unresolved key and resolves every key up to the last one it returns, so dense keys
+    are answered a page at a time and sparse keys with about one listing each."""
+    import bisect
+
+    prefix = os.path.commonprefix(keys)
+    ret = {}
+    i = 0
+    while i < len(keys):
+        page = client.list_objects_v2(bucket, prefix, start_after=_before(keys[i]))
+        listed = [obj[_Key] for obj in page['Contents']]
+        for obj in page['Contents']:
+            cache.put(bucket, obj[_Key], _listed_info(obj))
+        while i < len(keys) and (not page['IsTruncated'] or keys[i] <= listed[-1]):
+            # Any key that starts with keys[i] and sorts after the page would put listed[-1] between them,
+            # so listed[-1] would start with keys[i] too.
+            j = bisect.bisect_left(listed, keys[i])
+            ret[keys[i]] = j < len(listed) and listed[j].startswith(keys[i])
+            if not ret[keys[i]]:
+                cache.put(bucket, keys[i], None)
+            i += 1
+    return ret
 
 
-def s3rm(path):
-    """Remove an S3 object"""
+def s3exists_many(paths, *, client=None, cache=None, threads=EXISTS_THREADS):
+    """Check the existence of many S3 paths with few requests. Returns a dictionary mapping each path
+    to True if the object exists or if any object exists below it, as s3exists() would.
+    Paths in the metadata cache are answered from it. The rest are grouped by bucket and directory,
+    and each group is resolved with a handful of listings that start at its unresolved keys;
+    the groups are listed by threads threads. The results are added to the metadata cache.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    client = client or s3client.default_client()
+    cache = cache if cache is not None else metadata_cache
+    ret = {}
+    groups = defaultdict(set)
+    for path in paths:
+        (bucket, key) = get_bucket_key(path)
+        (found, info) = cache.get(bucket, key)
+        if found:
+            ret[path] = info is not None
+        else:
+            groups[(bucket, key.rpartition('/')[0])].add(key)
+    resolved = {}
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        futures = {(bucket, directory): pool.submit(_exists_group, client, cache, bucket, sorted(keys))
+                   for ((bucket, directory), keys) in groups.items()}
+        for ((bucket, directory), f) in futures.items():
+            resolved.update({(bucket, key): exists for (key, exists) in f.result().items()})
+    for path in paths:
+        if path not in ret:
+            ret[path] = resolved[get_bucket_key(path)]
+    return ret
+
+
+def delete_objects(bucket, keys, *, batch_size=DELETE_BATCH, threads=TRANSFER_THREADS, progress=None, client=None):
+    """Delete keys with DeleteObjects requests of up to batch_size keys, running threads batches at once.
+    keys may be a generator (e.g. a listing) of keys or of list_objects() dictionaries; it is consumed
+    as batches are sent, so only threads batches are in memory. Keys that fail with a transient error
+    are retried in a later request, with backoff, up to DELETE_RETRIES times.
+    @param progress - if provided, called with a dictionary describing each finished batch:
+                      its Batch number, the number Deleted, its Errors, and the Seconds it took.
+    Returns a dictionary with the total number Deleted, the number of Batches, and the final Errors.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    client = client or s3client.default_client()
+    inflight = threading.BoundedSemaphore(threads)
+    lock = threading.Lock()
+    ret = {'Deleted': 0, 'Batches': 0, 'Errors': []}
+
+    def delete_batch(number, batch):
+        try:
+            t0 = time.time()
+            deleted = 0
+            errors = []
+            for retry in range(DELETE_RETRIES):
+                if retry:
+                    time.sleep(s3client.RETRY_MS_DELAY * (2 ** retry) / 1000)
+                for key in batch:
+                    metadata_cache.invalidate(bucket, key)
+                res = client.delete_objects(bucket, batch)
+                deleted += len(res['Deleted'])
+                errors = [e for e in res['Errors'] if e['Code'] not in DELETE_RETRY_CODES]
+                batch = [e['Key'] for e in res['Errors'] if e['Code'] in DELETE_RETRY_CODES]
+                if not batch:
+                    break
+            errors += [{'Key': key, 'Code': 'RetriesExceeded', 'Message': ''} for key in batch]
+            result = {'Batch': number, 'Deleted': deleted, 'Errors': errors, 'Seconds': time.time() - t0}
+            logging.info("s3://%s delete batch %d: %d deleted, %d errors", bucket, number, deleted, len(errors))
+            with lock:
+                ret['Deleted'] += deleted
+                ret['Errors'] += errors
+                if progress:
+                    progress(result)
+            return result
+        finally:
+            inflight.release()
+
+    def batches():
+        batch = []
+        for key in keys:
+            batch.append(key[_Key] if isinstance(key, dict) else key)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        futures = []
+        for (number, batch) in enumerate(batches()):
+            inflight.acquire()
+            pending = []
+            for f in futures:
+                if f.done():
+                    f.result()          # raise the exception of a failed batch
+                else:
+                    pending.append(f)
+            futures = pending + [pool.submit(delete_batch, number, batch)]
+            ret['Batches'] += 1
+        for f in futures:
+            f.result()
+    return ret
+
+
+def delete_prefix(bucket, prefix, *, raw_prefix=False, **kwargs):
+    """Delete every object under prefix with delete_objects(), streaming the keys from a parallel listing.
+    prefix is treated as a directory: 'run1' deletes run1/... but not run10/... or run1_old/...
+    @param raw_prefix - if True, delete every key that starts with prefix, as given.
+    """
+    if not prefix:
+        raise ValueError("will not delete an entire bucket")
+    if not raw_prefix and not prefix.endswith('/'):
+        prefix += '/'
+    return delete_objects(bucket, list_objects(bucket, prefix, parallel=True), **kwargs)
+
+
+def s3rm(path, recursive=False, **kwargs):
+    """Remove an S3 object
+    @param recursive - if True, remove every object under the prefix path with delete_prefix(), passing it kwargs.
+    """
     (bucket, key) = get_bucket_key(path)
-    res = aws_s3api(['delete-object', '--bucket', bucket, '--key', key])
-    print("res:",type(res))
-    if res['DeleteMarker'] != True:
-        raise RuntimeError("Unknown response from delete-object: {}".format(res))
+    if recursive:
+        return delete_prefix(bucket, key, **kwargs)
+    delete_object(bucket, key)
+
+
+#
+# Sync
+#
+
+def _listing_time(last_modified):
+    """Convert a LastModified from a listing (e.g. 2024-01-31T12:00:00.000Z) to seconds since the epoch"""
+    import datetime
+    return datetime.datetime.fromisoformat(last_modified.replace('Z', '+00:00')).timestamp()
+
+
+def _sync_selected(rel, include, exclude):
+    """A path is selected unless it matches an exclude pattern and no include pattern"""
+    import fnmatch
+    return (not any(fnmatch.fnmatchcase(rel, pat) for pat in exclude or []) or
+            any(fnmatch.fnmatchcase(rel, pat) for pat in include or []))
+
+
+def _file_digests(fname):
+    digests = TransferDigests(PART_SIZE)
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(PART_SIZE), b''):
+            digests.update(block)
+    digests.finish()
+    return digests
+
+
+def _local_files(root):
+    """Return {relative path: (size, mtime)} for the files below root, with '/' separators"""
+    ret = {}
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            st = os.stat(path)
+            ret[os.path.relpath(path, root).replace(os.sep, '/')] = (st.st_size, st.st_mtime)
+    return ret
+
+
+def _sync_key_path(rel):
+    """Return True if an object with the relative key rel can be synced with a local file.
+    Folder markers (keys ending in '/') are skipped, and so are keys that would leave the local root."""
+    if not rel or rel.endswith('/'):
+        return False
+    path = os.path.normpath(rel)
+    if os.path.isabs(path) or path == '..' or path.startswith('..' + os.sep):
+        logging.warning("sync: skipping %s, which is outside the directory", rel)
+        return False
+    return True
+
+
+def sync_plan(src, dest, *, include=None, exclude=None, delete=False, checksum=False, client=None):
+    """Compare an S3 prefix with a local directory and return the list of actions that would make dest
+    a copy of src. Exactly one of src and dest must be an s3:// URL. Each action is a dictionary with
+    the Action ('download', 'upload' or 'delete'), the Path relative to both roots, its Size and the Reason.
+
+    Folder markers, and keys such as a/../../b that would be outside the local directory, are skipped.
+
+    A file is transferred if it is missing from dest or its size differs. A download also happens if the
+    local mtime is not the object's LastModified, which sync() sets on the files that it downloads;
+    an upload also happens if the local file is newer than the object.
+    @param include, exclude - lists of fnmatch patterns for the relative paths. A path is skipped if it
+                              matches an exclude pattern, unless it also matches an include pattern.
+    @param delete   - if True, also delete what is in dest but not in src.
+    @param checksum - if True, also transfer files whose size and time agree but whose MD5 or multipart
+                      ETag (for parts of PART_SIZE) does not match the object's ETag. Local files are read.
+    """
+    downloading = src.startswith('s3://')
+    if downloading == dest.startswith('s3://'):
+        raise ValueError("sync needs one s3:// URL and one local directory")
+    (s3root, localroot) = (src, dest) if downloading else (dest, src)
+    (bucket, prefix) = get_bucket_key(s3root)
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    remote = {obj[_Key][len(prefix):]: obj
+              for obj in list_objects(bucket, prefix, parallel=True, client=client)
+              if _sync_key_path(obj[_Key][len(prefix):]) and _sync_selected(obj[_Key][len(prefix):], include, exclude)}
+    local = {rel: stat for (rel, stat) in (_local_files(localroot) if os.path.isdir(localroot) else {}).items()
+             if _sync_selected(rel, include, exclude)}
+    (sources, dests) = (remote, local) if downloading else (local, remote)
+    plan = []
+    for rel in sorted(sources):
+        if downloading:
+            (obj, stat) = (remote[rel], local.get(rel))
+        else:
+            (obj, stat) = (remote.get(rel), local[rel])
+        size = obj[_Size] if downloading else stat[0]
+        if stat is None or obj is None:
+            reason = 'missing'
+        elif obj[_Size] != stat[0]:
+            reason = 'size'
+        elif downloading and int(stat[1]) != int(_listing_time(obj[_LastModified])):
+            reason = 'mtime'
+        elif not downloading and stat[1] > _listing_time(obj[_LastModified]):
+            reason = 'newer'
+        elif checksum and not _file_digests(os.path.join(localroot, rel)).matches(obj[_ETag]):
+            reason = 'etag'
+        else:
+            continue
+        action = {'Action': 'download' if downloading else 'upload', 'Path': rel, 'Size': size, 'Reason': reason}
+        if downloading:
+            action[_LastModified] = obj[_LastModified]
+        plan.append(action)
+    if delete:
+        for rel in sorted(set(dests) - set(sources)):
+            size = dests[rel][0] if downloading else dests[rel][_Size]
+            plan.append({'Action': 'delete', 'Path': rel, 'Size': size, 'Reason': 'extra'})
+    return plan
+
+
+def _sync_download(bucket, key, fname, last_modified, client, digests=False):
+    """Download to a temporary file beside fname, give it the object's time, and rename it into place.
+    With digests, the download is hashed and checked against the object's stored digests."""
+    os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+    tmp = "{}.{}.s3tmp".format(fname, os.getpid())
+    if os.path.exists(tmp):
+        os.unlink(tmp)
+    parallel_get_object(bucket, key, tmp, threads=SYNC_PART_THREADS, client=client, digests=digests)
+    mtime = _listing_time(last_modified)
+    os.utime(tmp, (mtime, mtime))
+    os.replace(tmp, fname)
+
+
+def sync(src, dest, *, include=None, exclude=None, delete=False, checksum=False, dry_run=False,
+         threads=TRANSFER_THREADS, progress=None, client=None):
+    """Make dest a copy of src, where one is an s3:// prefix and the other a local directory,
+    transferring only what sync_plan() finds has changed. Files are transferred by a pool of threads;
+    each file larger than PART_SIZE is itself transferred in parts by SYNC_PART_THREADS threads.
+    A failed transfer does not stop the others.
+    @param checksum - see sync_plan(). The files transferred are also hashed: uploads are sent with the
+                      Content-MD5 of each part and downloads are checked against the objects' stored digests.
+    @param dry_run  - if True, return the plan without changing anything.
+    @param progress - if provided, called with each action once it is done, with its Seconds and any Error added.
+    Returns a dictionary with the Plan, the number Transferred and Deleted, the Bytes transferred,
+    and the Errors, each an action with its Error.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    client = client or s3client.default_client()
+    plan = sync_plan(src, dest, include=include, exclude=exclude, delete=delete, checksum=checksum, client=client)
+    ret = {'Plan': plan, 'Transferred': 0, 'Deleted': 0, 'Bytes': 0, 'Errors': []}
+    if dry_run:
+        return ret
+    downloading = src.startswith('s3://')
+    (s3root, localroot) = (src, dest) if downloading else (dest, src)
+    (bucket, prefix) = get_bucket_key(s3root)
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    lock = threading.Lock()
+
+    def run(action):
+        t0 = time.time()
+        key = prefix + action['Path']
+        fname = os.path.join(localroot, *action['Path'].split('/'))
+        result = dict(action)
+        try:
+            if action['Action'] == 'download':
+                _sync_download(bucket, key, fname, action[_LastModified], client, digests=checksum)
+            elif action['Action'] == 'upload':
+                put_object(bucket, key, fname, client=client, digests=checksum)
+            elif downloading:
+                os.unlink(fname)
+            else:
+                metadata_cache.invalidate(bucket, key)
+                client.delete_object(bucket, key)
+        except (OSError, RuntimeError) as e:
+            result['Error'] = str(e)
+        result['Seconds'] = time.time() - t0
+        with lock:
+            if 'Error' in result:
+                ret['Errors'].append(result)
+            elif action['Action'] == 'delete':
+                ret['Deleted'] += 1
+            else:
+                ret['Transferred'] += 1
+                ret['Bytes'] += action['Size']
+            if progress:
+                progress(result)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for f in [pool.submit(run, action) for action in plan]:
+            f.result()
+    return ret
 
 
 if __name__ == "__main__":
@@ -491,20 +2033,61 @@ if __name__ == "__main__":
     parser.add_argument("--debug", action='store_true')
     parser.add_argument("--search", help="Search for something")
     parser.add_argument("--threads", help="For searching, the number of threads to use", type=int, default=20)
+    parser.add_argument("--parallel", action='store_true', help="for ls, list shards of the prefix in parallel")
+    parser.add_argument("--rm", action='store_true', help="delete every object under each root, in parallel batches")
+    parser.add_argument("--compact", help="compact the small objects under each root into objects under this s3 prefix")
+    parser.add_argument("--target-size", help="for compact, the size of the objects to build", type=int,
+                        default=COMPACT_TARGET_SIZE)
+    parser.add_argument("--sync", help="make this s3 prefix or local directory a copy of each root")
+    parser.add_argument("--include", action='append', help="for sync, a pattern of paths to include despite --exclude")
+    parser.add_argument("--exclude", action='append', help="for sync, a pattern of paths to skip")
+    parser.add_argument("--delete", action='store_true', help="for sync, delete what is not in the root")
+    parser.add_argument("--checksum", action='store_true', help="for sync, also compare local digests with ETags")
+    parser.add_argument("--dry-run", action='store_true', help="for sync, print the plan without transferring")
     parser.add_argument("roots", nargs="+")
     args = parser.parse_args()
     if args.debug:
         debug = args.debug
     for root in args.roots:
+        if args.sync:
+            res = sync(root, args.sync, include=args.include, exclude=args.exclude, delete=args.delete,
+                       checksum=args.checksum, dry_run=args.dry_run, threads=args.threads)
+            for action in res['Plan'] if args.dry_run else res['Errors']:
+                print("{Action:8} {Size:18,} {Path} ({})".format(action.get('Error', action['Reason']), **action))
+            count += res['Transferred'] + res['Deleted']
+            continue
         (bucket, prefix) = get_bucket_key(root)
         if args.ls:
-            for data in list_objects(bucket, prefix, delimiter=args.delimiter):
+            if args.parallel:
+                listing = list_objects(bucket, prefix, parallel=True, ordered=True, threads=args.threads)
+            else:
+                listing = list_objects(bucket, prefix, delimiter=args.delimiter)
+            for data in listing:
                 print("{:18,} {}".format(data[_Size], data[_Key]))
                 count += 1
-        if args.search:
-            for data in search_objects(bucket, prefix, name=args.search, searchFoundPrefixes=False, threads=args.threads):
-                print("{:18,} {}".format(data[_Size], data[_Key]))
+        if args.rm:
+            res = s3rm(root, recursive=True, threads=args.threads,
+                       progress=lambda batch: print("batch {Batch}: {Deleted} deleted, {} errors, {Seconds:.2f}s".format(
+                           len(batch['Errors']), **batch), file=sys.stderr))
+            for error in res['Errors']:
+                print("{Key}: {Code} {Message}".format(**error))
+            count += res['Deleted']
+        if args.compact:
+            (dest_bucket, dest_prefix) = get_bucket_key(args.compact)
+            if dest_bucket != bucket:
+                raise ValueError("--compact must be in the same bucket as the roots")
+            for data in compact_objects(bucket, prefix, dest_prefix, target_size=args.target_size, threads=args.threads):
+                print("{:18,} {} ({} objects)".format(data[_Size], data[_Key], len(data['Sources'])))
                 count += 1
+        if args.search:
+            async def search():
+                found = 0
+                async for data in search_objects_async(bucket, prefix, name=args.search, searchFoundPrefixes=False,
+                                                       concurrency=args.threads):
+                    print("{:18,} {}".format(data[_Size], data[_Key]), flush=True)
+                    found += 1
+                return found
+            count += run_coroutine(search())
     t1 = time.time()
     print("Total files:  {}".format(count), file=sys.stderr)
     print("Elapsed time: {}".format(t1 - t0), file=sys.stderr)
@@ -0,0 +1,879 @@
+"""s3client.py
+
+An in-process client for the Amazon S3 REST API that is written with
+the Python standard library only (no boto or boto3).
+
+Requests are signed with AWS Signature Version 4 and sent over pooled
+keep-alive HTTP connections, so that small operations such as ranged
+reads do not pay for starting the aws CLI and a new TLS handshake on
+every call.
+
+Configuration comes from the same places that the aws CLI uses:
+
+* Credentials: AWS_ACCESS_KEY_ID/AWS_SECRET_ACCESS_KEY/AWS_SESSION_TOKEN,
+  then ~/.aws/credentials (profile AWS_PROFILE or default), then the
+  EC2 instance role from the instance metadata service.
+* Region: AWS_REGION or AWS_DEFAULT_REGION, then ~/.aws/config.
+* Endpoint: AWS_ENDPOINT_URL_S3 or AWS_ENDPOINT_URL. When an endpoint
+  is given, path-style addressing is used. This is how the client is
+  pointed at a local S3-compatible server for testing.
+
+CliClient has the same methods as S3Client but runs the aws CLI for each
+call. It is kept as a fallback for hosts where only the CLI is set up;
+set CTOOLS_S3_BACKEND=cli to make it the process-wide client.
+"""
+
+import base64
+import configparser
+import datetime
+import errno
+import hashlib
+import hmac
+import http.client
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+from collections import namedtuple
+from urllib.parse import urlparse, quote
+
+# Bring in aws from the current directory
+sys.path.append(os.path.dirname(__file__))
+import aws
+
+AWS_ENDPOINT_URL_S3 = 'AWS_ENDPOINT_URL_S3'
+AWS_ENDPOINT_URL = 'AWS_ENDPOINT_URL'
+AWS_ACCESS_KEY_ID = 'AWS_ACCESS_KEY_ID'
+AWS_SECRET_ACCESS_KEY = 'AWS_SECRET_ACCESS_KEY'
+AWS_SESSION_TOKEN = 'AWS_SESSION_TOKEN'
+AWS_PROFILE = 'AWS_PROFILE'
+AWS_REGION = 'AWS_REGION'
+AWS_DEFAULT_REGION = 'AWS_DEFAULT_REGION'
+CTOOLS_S3_BACKEND = 'CTOOLS_S3_BACKEND'
+
+DEFAULT_REGION = 'us-east-1'
+DEFAULT_TIMEOUT = 60            # seconds for a socket operation
+POOL_SIZE = 64                  # idle keep-alive connections kept per endpoint
+
+# Retries with exponential backoff, as in emr.py
+MAX_RETRIES = 7
+RETRY_MS_DELAY = 50
+RETRY_STATUS = (500, 502, 503, 504)
+
+# Adaptive concurrency. Requests are limited per (bucket, top-level prefix), which is how S3
+# partitions its request rate. Each limit grows by one request per round trip while it is in
+# use and is cut by DECREASE_FACTOR on a throttle or when latency rises to LATENCY_FACTOR times
+# the best seen.
+INITIAL_CONCURRENCY = 16
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 256
+DECREASE_FACTOR = 0.5
+LATENCY_FACTOR = 4
+LATENCY_SLACK = 0.1             # seconds that latency may rise before it counts, so that jitter on fast requests is ignored
+LATENCY_ALPHA = 0.1             # weight of each new sample in the smoothed latency
+THROTTLE_STATUS = (429, 503)
+CTOOLS_S3_MAX_BANDWIDTH = 'CTOOLS_S3_MAX_BANDWIDTH'   # optional cap in bytes per second for the whole process
+
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+IMDS_CREDENTIALS_URL = 'http://169.254.169.254/latest/meta-data/iam/security-credentials/'
+IMDS_TIMEOUT = 2
+
+debug = False
+
+Credentials = namedtuple('Credentials', ['access_key', 'secret_key', 'token', 'expiration'])
+
+
+class S3Error(RuntimeError):
+    """An error response from S3. code is the S3 error code, e.g. 'SlowDown' or 'AccessDenied'."""
+
+    def __init__(self, status, code, message, method, path):
+        super().__init__("{} {} failed: {} {} {}".format(method, path, status, code, message))
+        self.status = status
+        self.code = code
+        self.message = message
+
+
+class S3Response:
+    """The status, headers (with lower-case names) and fully-read body of an S3 request."""
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def __repr__(self):
+        return "S3Response<status:{} length:{}>".format(self.status, len(self.body))
+
+
+def strip_etag(etag):
+    """S3 returns ETags wrapped in quotes"""
+    if etag and etag[0] == '"':
+        return etag[1:-1]
+    return etag
+
+
+def parse_xml(body):
+    """Parse an S3 XML document, removing the namespace from the tags."""
+    root = ET.fromstring(body)
+    for elem in root.iter():
+        if '}' in elem.tag:
+            elem.tag = elem.tag.split('}', 1)[1]
+    return root
+
+
+################################################################
+###
+### Configuration
+###
+################################################################
+
+def _aws_config(fname, section):
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(os.path.expanduser(fname))
+    if section in config:
+        return config[section]
+    return {}
+
+
+def get_region():
+    for var in [AWS_REGION, AWS_DEFAULT_REGION]:
+        if os.environ.get(var):
+            return os.environ[var]
+    profile = os.environ.get(AWS_PROFILE, 'default')
+    section = 'default' if profile == 'default' else 'profile ' + profile
+    return _aws_config('~/.aws/config', section).get('region', DEFAULT_REGION)
+
+
+def get_endpoint_url():
+    for var in [AWS_ENDPOINT_URL_S3, AWS_ENDPOINT_URL]:
+        if os.environ.get(var):
+            return os.environ[var]
+    return None
+
+
+def _instance_credentials():
+    """Return the credentials of the EC2 instance role, or None if we are not on EC2."""
+    try:
+        role = aws.get_url(IMDS_CREDENTIALS_URL, timeout=IMDS_TIMEOUT).strip().split("\n")[0]
+        data = aws.get_url_json(IMDS_CREDENTIALS_URL + role, timeout=IMDS_TIMEOUT)
+    except (OSError, ValueError):
+        return None
+    expiration = datetime.datetime.strptime(data['Expiration'], '%Y-%m-%dT%H:%M:%SZ')
+    expiration = expiration.replace(tzinfo=datetime.timezone.utc).timestamp()
+    return Credentials(data['AccessKeyId'], data['SecretAccessKey'], data.get('Token'), expiration)
+
+
+def get_credentials():
+    """Find AWS credentials the way the aws CLI does. Returns None if there are none."""
+    if os.environ.get(AWS_ACCESS_KEY_ID) and os.environ.get(AWS_SECRET_ACCESS_KEY):
+        return Credentials(os.environ[AWS_ACCESS_KEY_ID], os.environ[AWS_SECRET_ACCESS_KEY],
+                           os.environ.get(AWS_SESSION_TOKEN), None)
+    section = _aws_config('~/.aws/credentials', os.environ.get(AWS_PROFILE, 'default'))
+    if section.get('aws_access_key_id') and section.get('aws_secret_access_key'):
+        return Credentials(section['aws_access_key_id'], section['aws_secret_access_key'],
+                           section.get('aws_session_token'), None)
+    return _instance_credentials()
+
+
+################################################################
+###
+### Signature Version 4
+###
+################################################################
+
+def uri_encode(s, safe='-_.~'):
+    return quote(s, safe=safe)
+
+
+def canonical_query(query):
+    return '&'.join("{}={}".format(uri_encode(k), uri_encode(str(v)))
+                    for (k, v) in sorted(query.items()))
+
+
+def _hmac(key, msg):
+    return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+
+
+def sign_v4(credentials, region, method, path, query, headers, payload_hash, amzdate, service='s3'):
+    """Add the SigV4 headers to headers (which must include 'host') and return it.
+    @param path  - the URI-encoded path
+    @param query - dictionary of query parameters
+    @param amzdate - the time of the request in YYYYMMDDTHHMMSSZ format
+    """
+    headers['x-amz-date'] = amzdate
+    headers['x-amz-content-sha256'] = payload_hash
+    if credentials.token:
+        headers['x-amz-security-token'] = credentials.token
+    names = sorted(headers, key=str.lower)
+    canonical_headers = ''.join("{}:{}\n".format(name.lower(), " ".join(str(headers[name]).split()))
+                                for name in names)
+    signed_headers = ';'.join(name.lower() for name in names)
+    canonical_request = "\n".join([method, path, canonical_query(query), canonical_headers,
+                                   signed_headers, payload_hash])
+    datestamp = amzdate[0:8]
+    scope = "{}/{}/{}/aws4_request".format(datestamp, region, service)
+    string_to_sign = "\n".join(['AWS4-HMAC-SHA256', amzdate, scope,
+                                hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()])
+    key = _hmac(('AWS4' + credentials.secret_key).encode('utf-8'), datestamp)
+    key = _hmac(key, region)
+    key = _hmac(key, service)
+    key = _hmac(key, 'aws4_request')
+    signature = hmac.new(key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+    headers['Authorization'] = "AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, Signature={}".format(
+        credentials.access_key, scope, signed_headers, signature)
+    return headers
+
+
+################################################################
+###
+### Connection pooling
+###
+################################################################
+
+class ConnectionPool:
+    """Idle keep-alive connections to a single endpoint, shared by the threads of a process.
+    A connection is checked out for exactly one request and returned once its response is read.
+    The pool is discarded in a child process after a fork."""
+
+    def __init__(self, scheme, netloc, maxsize=POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = []
+        self.pid = os.getpid()
+        self.created = 0
+
+    def get(self):
+        """Return (conn, reused)"""
+        with self.lock:
+            if self.pid != os.getpid():
+                self.idle = []
+                self.pid = os.getpid()
+            if self.idle:
+                return (self.idle.pop(), True)
+            self.created += 1
+        if self.scheme == 'https':
+            return (http.client.HTTPSConnection(self.netloc, timeout=self.timeout), False)
+        return (http.client.HTTPConnection(self.netloc, timeout=self.timeout), False)
+
+    def put(self, conn):
+        with self.lock:
+            if self.pid == os.getpid() and len(self.idle) < self.maxsize:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.idle = []
+
+
+################################################################
+###
+### Scheduling
+###
+################################################################
+
+class AIMDLimiter:
+    """Limits the requests in flight to one S3 partition with additive increase and multiplicative decrease.
+    While the limit is reached, each successful request adds 1/limit, so the limit grows by about one
+    per round trip. A throttle response, or a smoothed latency above LATENCY_FACTOR times the best
+    latency seen, multiplies it by DECREASE_FACTOR, at most once per round trip."""
+
+    def __init__(self, initial=INITIAL_CONCURRENCY, minimum=MIN_CONCURRENCY, maximum=MAX_CONCURRENCY):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.inflight = 0
+        self.latency = None         # smoothed latency
+        self.baseline = None        # best latency, which drifts slowly towards the smoothed latency
+        self.last_decrease = 0
+        self.throttles = 0
+        self.cond = threading.Condition()
+
+    def __repr__(self):
+        return "AIMDLimiter<limit:{:.1f} inflight:{}>".format(self.limit, self.inflight)
+
+    def acquire(self):
+        with self.cond:
+            while self.inflight >= int(self.limit):
+                self.cond.wait()
+            self.inflight += 1
+
+    def _decrease(self, now):
+        if now - self.last_decrease >= (self.latency or 0):
+            self.limit = max(self.minimum, self.limit * DECREASE_FACTOR)
+            self.last_decrease = now
+
+    def release(self, seconds, throttled=False):
+        """Return a slot, recording the latency of its request and whether it was throttled"""
+        with self.cond:
+            saturated = self.inflight == int(self.limit)
+            self.inflight -= 1
+            now = time.monotonic()
+            if throttled:
+                self.throttles += 1
+                self._decrease(now)
+            elif seconds is not None:
+                if self.latency is None:
+                    (self.latency, self.baseline) = (seconds, seconds)
+                self.latency += LATENCY_ALPHA * (seconds - self.latency)
+                self.baseline = min(seconds, self.baseline + LATENCY_ALPHA / 10 * (self.latency - self.baseline))
+                if self.latency > LATENCY_FACTOR * self.baseline + LATENCY_SLACK:
+                    self._decrease(now)
+                elif saturated:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+
+class TokenBucket:
+    """Paces bytes to rate bytes per second, allowing bursts of up to one second"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate) - nbytes
+            self.last = now
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class TransferScheduler:
+    """Shared by every request of a client: an AIMDLimiter for each S3 partition and an optional
+    TokenBucket for the process's bandwidth. Callers can use thread pools as large as they like;
+    the limiters decide how many requests actually run. The state is discarded in a child process after a fork."""
+
+    def __init__(self, *, initial=INITIAL_CONCURRENCY, minimum=MIN_CONCURRENCY, maximum=MAX_CONCURRENCY,
+                 max_bandwidth=None):
+        """
+        @param max_bandwidth - if provided, the most bytes per second sent and received.
+                               Defaults to $CTOOLS_S3_MAX_BANDWIDTH.
+        """
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        if max_bandwidth is None and os.environ.get(CTOOLS_S3_MAX_BANDWIDTH):
+            max_bandwidth = float(os.environ[CTOOLS_S3_MAX_BANDWIDTH])
+        self.max_bandwidth = max_bandwidth
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.limiters = dict()
+        self.bandwidth = TokenBucket(self.max_bandwidth) if self.max_bandwidth else None
+
+    @staticmethod
+    def partition(bucket, key):
+        return (bucket, key.partition('/')[0])
+
+    def limiter(self, bucket, key):
+        with self.lock:
+            if self.pid != os.getpid():
+                self._reset()
+            part = self.partition(bucket, key)
+            if part not in self.limiters:
+                self.limiters[part] = AIMDLimiter(self.initial, self.minimum, self.maximum)
+            return self.limiters[part]
+
+    def throttle(self, nbytes):
+        """Wait as long as the bandwidth cap requires for nbytes"""
+        if self.bandwidth and nbytes:
+            self.bandwidth.consume(nbytes)
+
+    def stats(self):
+        """Return a dictionary mapping each partition to its limit, requests in flight and throttles"""
+        with self.lock:
+            return {part: {'limit': limiter.limit, 'inflight': limiter.inflight, 'throttles': limiter.throttles}
+                    for (part, limiter) in self.limiters.items()}
+
+
+################################################################
+###
+### The client
+###
+################################################################
+
+class S3Client:
+    """A thread-safe S3 client. A single instance should be shared by the whole process."""
+
+    def __init__(self, endpoint_url=None, region=None, credentials=None, anonymous=False,
+                 timeout=DEFAULT_TIMEOUT, pool_size=POOL_SIZE, scheduler=None):
+        """
+        @param endpoint_url - URL of an S3-compatible server. Defaults to AWS_ENDPOINT_URL_S3/AWS_ENDPOINT_URL,
+                              then to the AWS regional endpoint.
+        @param credentials  - a Credentials object. Defaults to get_credentials().
+        @param anonymous    - if True, send unsigned requests.
+        @param scheduler    - the TransferScheduler that limits concurrency and bandwidth. Defaults to a new one.
+        """
+        self.region = region or get_region()
+        self.endpoint_url = endpoint_url or get_endpoint_url()
+        self.anonymous = anonymous
+        self.credentials = credentials
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.pools = dict()
+        self.lock = threading.Lock()
+        self.scheduler = scheduler or TransferScheduler()
+
+    def __repr__(self):
+        return "S3Client<endpoint:{} region:{}>".format(self.endpoint_url, self.region)
+
+    def _credentials(self):
+        if self.anonymous:
+            return None
+        with self.lock:
+            if (self.credentials is None or
+                    (self.credentials.expiration and self.credentials.expiration < time.time() + 300)):
+                self.credentials = get_credentials()
+            return self.credentials
+
+    def _pool(self, scheme, netloc):
+        with self.lock:
+            if (scheme, netloc) not in self.pools:
+                self.pools[(scheme, netloc)] = ConnectionPool(scheme, netloc, self.pool_size, self.timeout)
+            return self.pools[(scheme, netloc)]
+
+    def _location(self, bucket, key):
+        """Return (scheme, netloc, path) for a bucket and key"""
+        if self.endpoint_url:
+            p = urlparse(self.endpoint_url)
+            path = p.path.rstrip('/') + '/' + bucket
+            if key:
+                path += '/' + key
+            return (p.scheme, p.netloc, uri_encode(path, safe='/-_.~'))
+        if bucket and ('.' not in bucket):
+            return ('https', "{}.s3.{}.amazonaws.com".format(bucket, self.region), uri_encode('/' + key, safe='/-_.~'))
+        return ('https', "s3.{}.amazonaws.com".format(self.region),
+                uri_encode('/{}/{}'.format(bucket, key) if bucket else '/', safe='/-_.~'))
+
+    def request(self, method, bucket, key='', *, query=None, headers=None, body=b'', ok=(200, 204, 206)):
+        """Perform a signed request, retrying on connection errors and on 5xx responses.
+        @param ok - the statuses that count as success
+        Returns an S3Response. Raises FileNotFoundError for a missing bucket or key, S3Error otherwise.
+        """
+        query = query or {}
+        (scheme, netloc, path) = self._location(bucket, key)
+        pool = self._pool(scheme, netloc)
+        limiter = self.scheduler.limiter(bucket, key or query.get('prefix', ''))
+        url = path + ('?' + canonical_query(query) if query else '')
+        for retry in range(MAX_RETRIES):
+            hdrs = dict(headers or {})
+            hdrs['host'] = netloc
+            credentials = self._credentials()
+            if credentials:
+                sign_v4(credentials, self.region, method, path, query, hdrs, UNSIGNED_PAYLOAD,
+                        time.strftime('%Y%m%dT%H%M%SZ', time.gmtime()))
+            if debug:
+                print("{} {}://{}{} {}".format(method, scheme, netloc, url, headers), file=sys.stderr)
+            self.scheduler.throttle(len(body or b''))
+            limiter.acquire()
+            (conn, reused) = pool.get()
+            try:
+                conn.request(method, url, body=body or None, headers=hdrs)
+                t0 = time.monotonic()
+                r = conn.getresponse()
+                latency = time.monotonic() - t0     # time to the first byte, whatever the size of the body
+                data = r.read()
+            except (http.client.HTTPException, ConnectionError, socket.timeout) as e:
+                limiter.release(None)
+                conn.close()
+                if retry + 1 == MAX_RETRIES:
+                    raise
+                if not reused:      # a stale keep-alive connection is retried immediately
+                    time.sleep(RETRY_MS_DELAY * (2 ** retry) / 1000)
+                continue
+            except BaseException:
+                limiter.release(None)
+                conn.close()
+                raise
+            limiter.release(latency, throttled=r.status in THROTTLE_STATUS)
+            self.scheduler.throttle(len(data))
+            if r.will_close:
+                conn.close()
+            else:
+                pool.put(conn)
+            resp = S3Response(r.status, {k.lower(): v for (k, v) in r.getheaders()}, data)
+            if resp.status in ok:
+                return resp
+            if resp.status in RETRY_STATUS and retry + 1 < MAX_RETRIES:
+                time.sleep(RETRY_MS_DELAY * (2 ** retry) / 1000)
+                continue
+            self._raise(method, bucket, key, resp)
+        raise RuntimeError("{} s3://{}/{}: retries exceeded".format(method, bucket, key))
+
+    @staticmethod
+    def _raise(method, bucket, key, resp):
+        code = message = ''
+        if resp.body:
+            try:
+                root = parse_xml(resp.body)
+                code = root.findtext('Code', '')
+                message = root.findtext('Message', '')
+            except ET.ParseError:
+                message = resp.body[0:200]
+        if resp.status == 404 or code in ('NoSuchKey', 'NoSuchBucket'):
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), "s3://{}/{}".format(bucket, key))
+        raise S3Error(resp.status, code, message, method, "s3://{}/{}".format(bucket, key))
+
+    ################################################################
+    # Object operations
+
+    def head_object(self, bucket, key):
+        """Return a dictionary in the format of the head-object API"""
+        h = self.request('HEAD', bucket, key).headers
+        ret = {'ContentLength': int(h.get('content-length', 0)),
+               'ETag': h.get('etag'),
+               'LastModified': h.get('last-modified'),
+               'ContentType': h.get('content-type'),
+               'Metadata': {k[11:]: v for (k, v) in h.items() if k.startswith('x-amz-meta-')}}
+        return ret
+
+    def get_range(self, bucket, key, start, length, etag=None):
+        """Return length bytes of an object starting at start.
+        @param etag - if provided, fail with S3Error (412) if the object has changed.
+        """
+        headers = {'Range': 'bytes={}-{}'.format(start, start + length - 1)}
+        if etag:
+            headers['If-Match'] = '"{}"'.format(strip_etag(etag))
+        return self.request('GET', bucket, key, headers=headers).body
+
+    @staticmethod
+    def _metadata_headers(metadata):
+        return {'x-amz-meta-' + k: v for (k, v) in (metadata or {}).items()}
+
+    @staticmethod
+    def _md5_header(headers, content_md5):
+        if content_md5:
+            headers['Content-MD5'] = base64.b64encode(content_md5).decode('ascii')
+        return headers
+
+    def put_object(self, bucket, key, body, metadata=None, content_md5=None):
+        """Upload body (bytes) as an object. Returns a dictionary with the ETag.
+        @param content_md5 - the binary MD5 digest of body. If provided, S3 rejects a body that does not match.
+        """
+        headers = self._md5_header(self._metadata_headers(metadata), content_md5)
+        resp = self.request('PUT', bucket, key, headers=headers, body=body)
+        return {'ETag': resp.headers.get('etag')}
+
+    def copy_object(self, bucket, key, source_bucket, source_key, metadata=None):
+        """Copy an object of up to 5 GiB within S3. If metadata is provided it replaces the source's.
+        Returns a dictionary with the ETag of the new object."""
+        headers = {'x-amz-copy-source': uri_encode('/{}/{}'.format(source_bucket, source_key), safe='/-_.~')}
+        if metadata is not None:
+            headers['x-amz-metadata-directive'] = 'REPLACE'
+            headers.update(self._metadata_headers(metadata))
+        resp = self.request('PUT', bucket, key, headers=headers)
+        result = parse_xml(resp.body)
+        if result.tag == 'Error':
+            raise S3Error(resp.status, result.findtext('Code'), result.findtext('Message'),
+                          'PUT', "s3://{}/{}".format(bucket, key))
+        return {'ETag': result.findtext('ETag')}
+
+    ################################################################
+    # Listing
+
+    @staticmethod
+    def _object_dict(elem):
+        """Convert a <Contents> element to the dictionary that the list-objects-v2 API returns"""
+        ret = {'Key': elem.findtext('Key'),
+               'LastModified': elem.findtext('LastModified'),
+               'ETag': elem.findtext('ETag'),
+               'Size': int(elem.findtext('Size', '0'))}
+        if elem.find('StorageClass') is not None:
+            ret['StorageClass'] = elem.findtext('StorageClass')
+        return ret
+
+    def list_objects_v2(self, bucket, prefix='', *, delimiter=None, start_after=None,
+                        continuation_token=None, max_keys=1000):
+        """Return one page of the list-objects-v2 API as a dictionary with Contents, CommonPrefixes,
+        IsTruncated and NextContinuationToken"""
+        query = {'list-type': 2, 'prefix': prefix or '', 'max-keys': max_keys}
+        if delimiter:
+            query['delimiter'] = delimiter
+        if start_after:
+            query['start-after'] = start_after
+        if continuation_token:
+            query['continuation-token'] = continuation_token
+        root = parse_xml(self.request('GET', bucket, query=query).body)
+        return {'Contents': [self._object_dict(e) for e in root.findall('Contents')],
+                'CommonPrefixes': [{'Prefix': e.findtext('Prefix')} for e in root.findall('CommonPrefixes')],
+                'IsTruncated': root.findtext('IsTruncated') == 'true',
+                'NextContinuationToken': root.findtext('NextContinuationToken')}
+
+    def list_pages(self, bucket, prefix='', *, delimiter=None, start_after=None, max_keys=1000):
+        """Generate every page of a listing"""
+        token = None
+        while True:
+            page = self.list_objects_v2(bucket, prefix, delimiter=delimiter, start_after=start_after,
+                                        continuation_token=token, max_keys=max_keys)
+            yield page
+            if not page['IsTruncated']:
+                return
+            token = page['NextContinuationToken']
+
+    def delete_object(self, bucket, key):
+        self.request('DELETE', bucket, key)
+
+    def delete_objects(self, bucket, keys):
+        """Delete up to 1000 keys with one DeleteObjects request.
+        Returns a dictionary with the list of Deleted keys and a list of Errors, each a dictionary
+        with the Key, Code and Message."""
+        root = ET.Element('Delete')
+        ET.SubElement(root, 'Quiet').text = 'true'
+        for key in keys:
+            ET.SubElement(ET.SubElement(root, 'Object'), 'Key').text = key
+        body = ET.tostring(root)
+        headers = {'Content-MD5': base64.b64encode(hashlib.md5(body).digest()).decode('ascii')}
+        result = parse_xml(self.request('POST', bucket, query={'delete': ''}, headers=headers, body=body).body)
+        errors = [{'Key': e.findtext('Key'), 'Code': e.findtext('Code'), 'Message': e.findtext('Message')}
+                  for e in result.findall('Error')]
+        failed = set(e['Key'] for e in errors)
+        return {'Deleted': [key for key in keys if key not in failed], 'Errors': errors}
+
+    ################################################################
+    # Multipart uploads
+
+    def create_multipart_upload(self, bucket, key, metadata=None):
+        """Start a multipart upload and return its UploadId"""
+        resp = self.request('POST', bucket, key, query={'uploads': ''}, headers=self._metadata_headers(metadata))
+        return parse_xml(resp.body).findtext('UploadId')
+
+    def upload_part(self, bucket, key, upload_id, part_number, body, content_md5=None):
+        """Upload one part (numbered from 1) and return its ETag.
+        @param content_md5 - the binary MD5 digest of body. If provided, S3 rejects a body that does not match.
+        """
+        resp = self.request('PUT', bucket, key, query={'partNumber': part_number, 'uploadId': upload_id},
+                            headers=self._md5_header({}, content_md5), body=body)
+        return resp.headers.get('etag')
+
+    def upload_part_copy(self, bucket, key, upload_id, part_number, source_bucket, source_key, start=None, end=None):
+        """Copy bytes start..end-1 of another object (all of it if start is None) into a part,
+        without the data leaving S3. Returns the part's ETag."""
+        headers = {'x-amz-copy-source': uri_encode('/{}/{}'.format(source_bucket, source_key), safe='/-_.~')}
+        if start is not None:
+            headers['x-amz-copy-source-range'] = 'bytes={}-{}'.format(start, end - 1)
+        resp = self.request('PUT', bucket, key, query={'partNumber': part_number, 'uploadId': upload_id},
+                            headers=headers)
+        result = parse_xml(resp.body)
+        if result.tag == 'Error':
+            raise S3Error(resp.status, result.findtext('Code'), result.findtext('Message'),
+                          'PUT', "s3://{}/{}".format(bucket, key))
+        return result.findtext('ETag')
+
+    def complete_multipart_upload(self, bucket, key, upload_id, parts):
+        """Complete a multipart upload.
+        @param parts - list of (part_number, etag) in part_number order.
+        Returns a dictionary with the ETag of the new object.
+        """
+        root = ET.Element('CompleteMultipartUpload')
+        for (part_number, etag) in parts:
+            part = ET.SubElement(root, 'Part')
+            ET.SubElement(part, 'PartNumber').text = str(part_number)
+            ET.SubElement(part, 'ETag').text = etag
+        resp = self.request('POST', bucket, key, query={'uploadId': upload_id}, body=ET.tostring(root))
+        # S3 can report a failure with a 200 status once it has started sending the response
+        result = parse_xml(resp.body)
+        if result.tag == 'Error':
+            raise S3Error(resp.status, result.findtext('Code'), result.findtext('Message'),
+                          'POST', "s3://{}/{}".format(bucket, key))
+        return {'ETag': result.findtext('ETag'), 'Location': result.findtext('Location')}
+
+    def abort_multipart_upload(self, bucket, key, upload_id):
+        self.request('DELETE', bucket, key, query={'uploadId': upload_id})
+
+    def close(self):
+        with self.lock:
+            for pool in self.pools.values():
+                pool.close()
+
+
+################################################################
+###
+### The aws CLI fallback
+###
+################################################################
+
+class CliClient:
+    """A client with the same methods as S3Client that runs 'aws s3api' for every call.
+    It is much slower, but needs nothing beyond a working aws CLI."""
+
+    def __init__(self, aws=None, endpoint_url=None):
+        """
+        @param aws          - the aws executable. Defaults to the one on the PATH.
+        @param endpoint_url - URL of an S3-compatible server. Defaults to AWS_ENDPOINT_URL_S3/AWS_ENDPOINT_URL.
+        """
+        self.aws = aws or shutil.which('aws')
+        if self.aws is None:
+            raise RuntimeError("Cannot find aws executable")
+        self.endpoint_url = endpoint_url or get_endpoint_url()
+
+    def __repr__(self):
+        return "CliClient<aws:{} endpoint:{}>".format(self.aws, self.endpoint_url)
+
+    def run(self, cmd, bucket, key=''):
+        """Run an s3api command and return its JSON output as a dictionary.
+        Raises FileNotFoundError for a missing bucket or key, S3Error otherwise."""
+        fcmd = [self.aws, 's3api', '--output=json'] + cmd
+        if self.endpoint_url:
+            fcmd += ['--endpoint-url', self.endpoint_url]
+        if debug:
+            print(" ".join(fcmd), file=sys.stderr)
+        p = subprocess.run(fcmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if p.returncode != 0:
+            err = p.stderr.decode('utf-8', errors='replace').strip()
+            m = re.search(r'\((\w+)\)', err)
+            code = m.group(1) if m else ''
+            if code in ('404', 'NoSuchKey', 'NoSuchBucket', 'NotFound') or 'does not exist' in err:
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), "s3://{}/{}".format(bucket, key))
+            raise S3Error(0, code, err, cmd[0], "s3://{}/{}".format(bucket, key))
+        return json.loads(p.stdout) if p.stdout.strip() else {}
+
+    def _run_with_body(self, cmd, bucket, key, body):
+        """Run a command that takes --body, passing body through a temporary file"""
+        with tempfile.NamedTemporaryFile() as tf:
+            tf.write(body)
+            tf.flush()
+            return self.run(cmd + ['--body', tf.name], bucket, key)
+
+    def head_object(self, bucket, key):
+        r = self.run(['head-object', '--bucket', bucket, '--key', key], bucket, key)
+        return {'ContentLength': r.get('ContentLength', 0),
+                'ETag': r.get('ETag'),
+                'LastModified': r.get('LastModified'),
+                'ContentType': r.get('ContentType'),
+                'Metadata': r.get('Metadata', {})}
+
+    def get_range(self, bucket, key, start, length, etag=None):
+        cmd = ['get-object', '--bucket', bucket, '--key', key, '--range', 'bytes={}-{}'.format(start, start + length - 1)]
+        if etag:
+            cmd += ['--if-match', '"{}"'.format(strip_etag(etag))]
+        with tempfile.NamedTemporaryFile() as tf:
+            self.run(cmd + [tf.name], bucket, key)
+            return tf.read()
+
+    def put_object(self, bucket, key, body, metadata=None, content_md5=None):
+        cmd = ['put-object', '--bucket', bucket, '--key', key]
+        if metadata:
+            cmd += ['--metadata', json.dumps(metadata)]
+        if content_md5:
+            cmd += ['--content-md5', base64.b64encode(content_md5).decode('ascii')]
+        return {'ETag': self._run_with_body(cmd, bucket, key, body).get('ETag')}
+
+    def copy_object(self, bucket, key, source_bucket, source_key, metadata=None):
+        cmd = ['copy-object', '--bucket', bucket, '--key', key, '--copy-source', '{}/{}'.format(source_bucket, source_key)]
+        if metadata is not None:
+            cmd += ['--metadata-directive', 'REPLACE', '--metadata', json.dumps(metadata)]
+        return {'ETag': self.run(cmd, bucket, key)['CopyObjectResult']['ETag']}
+
+    def list_objects_v2(self, bucket, prefix='', *, delimiter=None, start_after=None,
+                        continuation_token=None, max_keys=1000):
+        cmd = ['list-objects-v2', '--bucket', bucket, '--prefix', prefix or '', '--max-keys', str(max_keys),
+               '--no-paginate']
+        if delimiter:
+            cmd += ['--delimiter', delimiter]
+        if start_after:
+            cmd += ['--start-after', start_after]
+        if continuation_token:
+            cmd += ['--continuation-token', continuation_token]
+        r = self.run(cmd, bucket)
+        return {'Contents': r.get('Contents', []),
+                'CommonPrefixes': r.get('CommonPrefixes', []),
+                'IsTruncated': r.get('IsTruncated', False),
+                'NextContinuationToken': r.get('NextContinuationToken')}
+
+    list_pages = S3Client.list_pages
+
+    def delete_object(self, bucket, key):
+        self.run(['delete-object', '--bucket', bucket, '--key', key], bucket, key)
+
+    def delete_objects(self, bucket, keys):
+        delete = {'Objects': [{'Key': key} for key in keys], 'Quiet': True}
+        r = self.run(['delete-objects', '--bucket', bucket, '--delete', json.dumps(delete)], bucket)
+        errors = [{'Key': e.get('Key'), 'Code': e.get('Code'), 'Message': e.get('Message')}
+                  for e in r.get('Errors', [])]
+        failed = set(e['Key'] for e in errors)
+        return {'Deleted': [key for key in keys if key not in failed], 'Errors': errors}
+
+    def create_multipart_upload(self, bucket, key, metadata=None):
+        cmd = ['create-multipart-upload', '--bucket', bucket, '--key', key]
+        if metadata:
+            cmd += ['--metadata', json.dumps(metadata)]
+        return self.run(cmd, bucket, key)['UploadId']
+
+    def upload_part(self, bucket, key, upload_id, part_number, body, content_md5=None):
+        cmd = ['upload-part', '--bucket', bucket, '--key', key, '--upload-id', upload_id,
+               '--part-number', str(part_number)]
+        if content_md5:
+            cmd += ['--content-md5', base64.b64encode(content_md5).decode('ascii')]
+        return self._run_with_body(cmd, bucket, key, body)['ETag']
+
+    def upload_part_copy(self, bucket, key, upload_id, part_number, source_bucket, source_key, start=None, end=None):
+        cmd = ['upload-part-copy', '--bucket', bucket, '--key', key, '--upload-id', upload_id,
+               '--part-number', str(part_number), '--copy-source', '{}/{}'.format(source_bucket, source_key)]
+        if start is not None:
+            cmd += ['--copy-source-range', 'bytes={}-{}'.format(start, end - 1)]
+        return self.run(cmd, bucket, key)['CopyPartResult']['ETag']
+
+    def complete_multipart_upload(self, bucket, key, upload_id, parts):
+        upload = {'Parts': [{'PartNumber': part_number, 'ETag': etag} for (part_number, etag) in parts]}
+        r = self.run(['complete-multipart-upload', '--bucket', bucket, '--key', key, '--upload-id', upload_id,
+                      '--multipart-upload', json.dumps(upload)], bucket, key)
+        return {'ETag': r.get('ETag'), 'Location': r.get('Location')}
+
+    def abort_multipart_upload(self, bucket, key, upload_id):
+        self.run(['abort-multipart-upload', '--bucket', bucket, '--key', key, '--upload-id', upload_id], bucket, key)
+
+    def close(self):
+        return
+
+
+BACKENDS = {'client': S3Client, 'cli': CliClient}
+
+_default_client = None
+_default_lock = threading.Lock()
+
+
+def make_client(backend=None, **kwargs):
+    """Create a client for a backend: 'client' for the in-process S3Client, or 'cli' for the aws CLI.
+    The backend defaults to $CTOOLS_S3_BACKEND, then to 'client'."""
+    backend = backend or os.environ.get(CTOOLS_S3_BACKEND) or 'client'
+    if backend not in BACKENDS:
+        raise ValueError("unknown S3 backend {}; expecting one of {}".format(backend, ", ".join(BACKENDS)))
+    return BACKENDS[backend](**kwargs)
+
+
+def default_client():
+    """Return the process-wide client, creating it with make_client() on first use."""
+    global _default_client
+    with _default_lock:
+        if _default_client is None:
+            _default_client = make_client()
+        return _default_client
+
+
+def set_default_client(client):
+    """Replace the process-wide client, e.g. with one pointed at a local test server. Returns the old client."""
+    global _default_client
+    with _default_lock:
+        (old, _default_client) = (_default_client, client)
+        return old
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""s3index.py
+
+Keep a local SQLite3 index of the objects under S3 prefixes, so that repeated searches,
+size totals and existence checks do not have to list S3 again.
+
+A snapshot of a prefix is divided into shards: the objects directly below the prefix,
+and one shard for each sub-prefix found with the '/' delimiter. A refresh lists the
+prefix with the delimiter again and then re-lists only the sub-prefixes that are new
+or may have changed. A sub-prefix is considered unchanged if it holds a marker object
+(by default Spark's _SUCCESS file) whose ETag and LastModified are the same as when it
+was last listed. Sub-prefixes without a marker are re-listed on every refresh, and
+sub-prefixes that have disappeared are removed from the index.
+
+Usage:
+    s3index.py --db index.db --refresh s3://bucket/prefix/
+    s3index.py --db index.db --search _SUCCESS s3://bucket/prefix/
+    s3index.py --db index.db --du s3://bucket/prefix/
+    s3index.py --db index.db --exists s3://bucket/prefix/key
+"""
+
+import os
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Bring in s3 and dbfile from the current directory
+sys.path.append(os.path.dirname(__file__))
+import s3
+from dbfile import DBSqlite3
+
+DEFAULT_MARKER = '_SUCCESS'
+PROBE_THREADS = 16
+INSERT_BATCH = 10000
+KEY_MAX = '\U0010ffff'      # sorts after every character that can follow a prefix
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (bucket TEXT, key TEXT, name TEXT, size INTEGER, etag TEXT,
+                                    last_modified TEXT, shard TEXT, PRIMARY KEY (bucket, key));
+CREATE INDEX IF NOT EXISTS objects_name ON objects (bucket, name);
+CREATE INDEX IF NOT EXISTS objects_shard ON objects (bucket, shard);
+CREATE TABLE IF NOT EXISTS shards (bucket TEXT, prefix TEXT, root TEXT, signature TEXT, listed REAL,
+                                   PRIMARY KEY (bucket, prefix));
+"""
+
+
+class S3Index:
+    def __init__(self, fname, *, marker=DEFAULT_MARKER, client=None):
+        """
+        @param fname  - the SQLite3 database file
+        @param marker - the name of the object whose ETag and LastModified show whether a sub-prefix has changed.
+        """
+        self.db = DBSqlite3(fname, dicts=False)
+        self.db.create_schema(SCHEMA)
+        self.marker = marker
+        self.client = client
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def _client(self):
+        return self.client or s3.s3client.default_client()
+
+    @staticmethod
+    def _row(bucket, obj, shard):
+        return (bucket, obj[s3._Key], obj[s3._Key].split('/')[-1], obj[s3._Size], obj[s3._ETag],
+                obj[s3._LastModified], shard)
+
+    def _signature(self, prefix, objs):
+        """The signature of a shard is the ETag and LastModified of its marker, or None"""
+        for obj in objs:
+            if obj[s3._Key] == prefix + self.marker:
+                return "{} {}".format(obj[s3._ETag], obj[s3._LastModified])
+        return None
+
+    def _replace_shard(self, bucket, root, prefix, objs):
+        """Replace the objects of a shard. objs may be a generator; it is inserted in batches."""
+        c = self.db.conn
+        with c:
+            c.execute("DELETE FROM objects WHERE bucket=? AND shard=?", (bucket, prefix))
+            signature = None
+            count = 0
+            batch = []
+            for obj in objs:
+                batch.append(self._row(bucket, obj, prefix))
+                if obj[s3._Key] == prefix + self.marker:
+                    signature = self._signature(prefix, [obj])
+                if len(batch) >= INSERT_BATCH:
+                    c.executemany("INSERT OR REPLACE INTO objects VALUES (?,?,?,?,?,?,?)", batch)
+                    count += len(batch)
+                    batch = []
+            c.executemany("INSERT OR REPLACE INTO objects VALUES (?,?,?,?,?,?,?)", batch)
+            count += len(batch)
+            c.execute("INSERT OR REPLACE INTO shards VALUES (?,?,?,?,?)",
+                      (bucket, prefix, root, signature, time.time()))
+        return count
+
+    def _unchanged(self, bucket, prefix, signature):
+        """Probe a sub-prefix's marker with a one-key listing"""
+        if signature is None:
+            return False
+        page = self._client().list_objects_v2(bucket, prefix + self.marker, max_keys=1)
+        return self._signature(prefix, page['Contents']) == signature
+
+    def refresh(self, bucket, prefix='', *, threads=s3.LIST_THREADS):
+        """Snapshot or refresh the index of everything under prefix (default the whole bucket).
+        Returns a dictionary counting the shards listed, skipped and removed, and the keys listed."""
+        if bucket.startswith('s3://'):
+            (bucket, prefix) = s3.get_bucket_key(bucket)
+        prefix = prefix or ''       # the root of the shards; NULL would never match it
+        client = self._client()
+        top = []
+        subprefixes = []
+        for page in client.list_pages(bucket, prefix, delimiter='/'):
+            top += page['Contents']
+            subprefixes += [p[s3._Prefix] for p in page['CommonPrefixes']]
+        ret = {'listed': 1, 'skipped': 0, 'removed': 0, 'keys': self._replace_shard(bucket, prefix, prefix, top)}
+
+        known = dict(self.db.conn.execute("SELECT prefix, signature FROM shards WHERE bucket=? AND root=?",
+                                          (bucket, prefix)).fetchall())
+        with self.db.conn as c:
+            for gone in set(known) - set(subprefixes) - {prefix}:
+                c.execute("DELETE FROM objects WHERE bucket=? AND shard=?", (bucket, gone))
+                c.execute("DELETE FROM shards WHERE bucket=? AND prefix=?", (bucket, gone))
+                ret['removed'] += 1
+
+        with ThreadPoolExecutor(max_workers=PROBE_THREADS) as pool:
+            unchanged = list(pool.map(lambda p: p in known and self._unchanged(bucket, p, known[p]), subprefixes))
+        for (sub, skip) in zip(subprefixes, unchanged):
+            if skip:
+                ret['skipped'] += 1
+                continue
+            ret['listed'] += 1
+            ret['keys'] += self._replace_shard(bucket, prefix, sub,
+                                               s3.parallel_list_objects(bucket, sub, threads=threads, client=client))
+        return ret
+
+    ################################################################
+    # Queries answered from the index
+
+    @staticmethod
+    def _dict(row):
+        (key, size, etag, last_modified) = row
+        return {s3._Key: key, s3._Size: size, s3._ETag: etag, s3._LastModified: last_modified}
+
+    def list_objects(self, bucket, prefix='', limit=None):
+        """Generate the indexed objects under prefix in key order, as list_objects() would"""
+        sql = "SELECT key, size, etag, last_modified FROM objects WHERE bucket=? AND key>=? AND key<? ORDER BY key"
+        if limit:
+            sql += " LIMIT {}".format(int(limit))
+        for row in self.db.conn.execute(sql, (bucket, prefix, prefix + KEY_MAX)):
+            yield self._dict(row)
+
+    def search_objects(self, bucket, prefix='', *, name, limit=None):
+        """Return the indexed objects under prefix whose last path component is name"""
+        sql = ("SELECT key, size, etag, last_modified FROM objects WHERE bucket=? AND name=? AND key>=? AND key<? "
+               "ORDER BY key")
+        if limit:
+            sql += " LIMIT {}".format(int(limit))
+        return [self._dict(row) for row in self.db.conn.execute(sql, (bucket, name, prefix, prefix + KEY_MAX))]
+
+    def object_sizes(self, bucket, prefix=''):
+        return [row[0] for row in self.db.conn.execute(
+            "SELECT size FROM objects WHERE bucket=? AND key>=? AND key<? ORDER BY key", (bucket, prefix, prefix + KEY_MAX))]
+
+    def sum_object_sizes(self, bucket, prefix=''):
+        (total,) = self.db.conn.execute("SELECT COALESCE(SUM(size),0) FROM objects WHERE bucket=? AND key>=? AND key<?",
+                                        (bucket, prefix, prefix + KEY_MAX)).fetchone()
+        return total
+
+    def exists(self, path):
+        """Return True if the s3:// path was present when the index was last refreshed"""
+        (bucket, key) = s3.get_bucket_key(path)
+        return self.db.conn.execute("SELECT 1 FROM objects WHERE bucket=? AND key=?", (bucket, key)).fetchone() is not None
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter,
+                            description="Maintain and query a local index of S3 prefixes.")
+    parser.add_argument("--db", help="the index database", required=True)
+    parser.add_argument("--refresh", action='store_true', help="snapshot or refresh the index of each root")
+    parser.add_argument("--marker", help="object that shows whether a sub-prefix changed", default=DEFAULT_MARKER)
+    parser.add_argument("--threads", help="threads for listing", type=int, default=s3.LIST_THREADS)
+    parser.add_argument("--ls", action='store_true', help="list the indexed objects under each root")
+    parser.add_argument("--search", help="search the index for a name")
+    parser.add_argument("--du", action='store_true', help="print the total size of the objects under each root")
+    parser.add_argument("--exists", action='store_true', help="report whether each root is an indexed object")
+    parser.add_argument("roots", nargs="+")
+    args = parser.parse_args()
+
+    t0 = time.time()
+    with S3Index(args.db, marker=args.marker) as index:
+        for root in args.roots:
+            (bucket, prefix) = s3.get_bucket_key(root)
+            if args.refresh:
+                res = index.refresh(bucket, prefix, threads=args.threads)
+                print("{}: listed {listed} shards ({keys:,} keys), skipped {skipped}, removed {removed}".format(
+                    root, **res), file=sys.stderr)
+            if args.ls:
+                for data in index.list_objects(bucket, prefix):
+                    print("{:18,} {}".format(data[s3._Size], data[s3._Key]))
+            if args.search:
+                for data in index.search_objects(bucket, prefix, name=args.search):
+                    print("{:18,} {}".format(data[s3._Size], data[s3._Key]))
+            if args.du:
+                print("{:18,} {}".format(index.sum_object_sizes(bucket, prefix), root))
+            if args.exists:
+                print("{} {}".format(root, index.exists(root)))
+    print("Elapsed time: {}".format(time.time() - t0), file=sys.stderr)
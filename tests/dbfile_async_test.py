@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# Test the asyncio database layer with the SQLite3 backend
+
+import asyncio
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.append( os.path.join( os.path.dirname(__file__), "../..") )
+
+import ctools.dbfile_async as dbfile_async
+
+
+def test_async_csfr(tmp_path):
+    async def main():
+        async with dbfile_async.AsyncDBSqlite3(str(tmp_path / "test.db"), pool_size=4) as db:
+            await db.csfr("CREATE TABLE t (a INTEGER PRIMARY KEY, b TEXT)")
+            assert await db.csfr("INSERT INTO t (a, b) VALUES (%s, %s)", [1, 'one']) == 1
+            await db.csfr("INSERT IGNORE INTO t (a, b) VALUES (%s, %s)", [1, 'uno'])
+            assert await db.csfr("UPDATE t SET b=%s WHERE a=%s", ['ONE', 1], rowcount=1) == 1
+            with pytest.raises(RuntimeError):
+                await db.csfr("UPDATE t SET b=%s WHERE a=%s", ['TWO', 2], rowcount=1)
+
+            # many concurrent queries share the pool
+            await asyncio.gather(*[db.csfr("INSERT INTO t (a, b) VALUES (%s, %s)", [n, str(n)])
+                                   for n in range(2, 100)])
+            results = await asyncio.gather(*[db.csfr("SELECT b FROM t WHERE a=%s", [n]) for n in range(1, 100)])
+            assert results[0] == [('ONE',)] and results[98] == [('99',)]
+            stats = db.stats()
+            assert stats['peak_in_use'] <= 4 and stats['checkouts'] > 100
+
+            names = []
+            rows = await db.csfr("SELECT a, b FROM t WHERE a<%s ORDER BY a", [3], asDicts=True,
+                                 get_column_names=names)
+            assert names == ['a', 'b']
+            assert rows == [{'a': 1, 'b': 'ONE'}, {'a': 2, 'b': '2'}]
+            with pytest.raises(sqlite3.OperationalError):
+                await db.csfr("SELECT c FROM t")
+    asyncio.run(main())
+
+
+def test_async_retry(tmp_path, monkeypatch):
+    monkeypatch.setattr(dbfile_async.dbfile, 'RETRY_DELAY_TIME', 0)
+    failures = [sqlite3.OperationalError("database is locked")]
+
+    class Flaky(dbfile_async.AsyncSqlite3Connection):
+        def _execute(self, sql, vals, fetch):
+            if failures and sql.startswith('SELECT'):
+                raise failures.pop()
+            return super()._execute(sql, vals, fetch)
+
+    async def main():
+        db = dbfile_async.AsyncDBSqlite3(str(tmp_path / "test.db"), pool_size=2)
+        db.pool.connect = lambda: Flaky.connect(db.fname)
+        await db.csfr("CREATE TABLE t (a INTEGER)")
+        await db.csfr("INSERT INTO t (a) VALUES (%s)", [5])
+        assert await db.csfr("SELECT a FROM t") == [(5,)]
+        # the connection that raised was discarded and replaced
+        assert db.stats()['discarded'] == 1 and db.stats()['connects'] == 2
+        await db.close()
+    asyncio.run(main())
+
+
+def test_async_pool_wait():
+    made = []
+
+    class FakeConnection:
+        async def ping(self):
+            return True
+
+        def close(self):
+            pass
+
+    async def connect():
+        made.append(FakeConnection())
+        return made[-1]
+
+    async def main():
+        pool = dbfile_async.AsyncConnectionPool(connect, max_size=1, wait_timeout=0.05)
+        a = await pool.checkout()
+        with pytest.raises(TimeoutError):
+            await pool.checkout()
+        asyncio.get_running_loop().call_later(0.01, pool.checkin, a)
+        assert await pool.checkout(timeout=1) is a
+        assert pool.stats()['waits'] == 2 and len(made) == 1
+    asyncio.run(main())
+
+
+def test_async_mysql_transient_error():
+    errors = pytest.importorskip('pymysql.err')
+    db = dbfile_async.AsyncDBMySQL.__new__(dbfile_async.AsyncDBMySQL)
+    assert db.transient_error(errors.OperationalError(2013, "Lost connection to MySQL server"))
+    assert db.transient_error(errors.InternalError(1205, "Lock wait timeout exceeded"))
+    assert not db.transient_error(errors.InternalError(1054, "Unknown column 'c' in 'field list'"))
+    assert not db.transient_error(errors.ProgrammingError(1064, "You have an error in your SQL syntax"))
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# Test the parts of dbfile that do not need a MySQL server
+
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+
+import pytest
+
+sys.path.append( os.path.join( os.path.dirname(__file__), "../..") )
+
+import ctools.dbfile as dbfile
+
+
+class FakeConnection:
+    def __init__(self):
+        self.alive = True
+        self.closed = False
+
+    def ping(self):
+        return self.alive
+
+    def close(self):
+        self.closed = True
+
+
+def test_connection_pool():
+    made = []
+
+    def connect():
+        made.append(FakeConnection())
+        return made[-1]
+    pool = dbfile.ConnectionPool(connect, max_size=2, idle_timeout=60, ping_after=60, wait_timeout=0.2)
+
+    # connections are reused once checked in
+    a = pool.checkout()
+    pool.checkin(a)
+    assert pool.checkout() is a
+    b = pool.checkout()
+    assert len(made) == 2
+    assert pool.stats()['in_use'] == 2
+
+    # the pool is bounded: a third checkout waits for a checkin, or times out
+    with pytest.raises(TimeoutError):
+        pool.checkout()
+    threading.Timer(0.05, pool.checkin, (b,)).start()
+    assert pool.checkout() is b
+    stats = pool.stats()
+    assert stats['waits'] == 2 and stats['max_wait'] > 0
+    assert stats['peak_in_use'] == 2 and stats['connects'] == 2
+
+    # a connection that raises is discarded, not returned to the pool
+    pool.checkin(b)
+    with pytest.raises(ValueError):
+        with pool.connection() as db:
+            assert db is b
+            raise ValueError()
+    assert b.closed
+    assert pool.stats()['size'] == 1 and pool.stats()['discarded'] == 1
+    pool.checkin(a)
+    assert pool.stats()['idle'] == 1
+    pool.clear()
+    assert a.closed
+    assert pool.stats()['size'] == 0
+
+
+def test_connection_pool_idle():
+    made = []
+
+    def connect():
+        made.append(FakeConnection())
+        return made[-1]
+    pool = dbfile.ConnectionPool(connect, max_size=4, idle_timeout=60, ping_after=0)
+
+    # a connection idle longer than ping_after is pinged, and replaced if it is dead
+    a = pool.checkout()
+    pool.checkin(a)
+    a.alive = False
+    b = pool.checkout()
+    assert b is not a and a.closed
+    assert pool.stats()['pings'] == 1 and pool.stats()['stale'] == 1
+    pool.checkin(b)
+    assert pool.checkout() is b
+    pool.checkin(b)
+
+    # connections idle longer than idle_timeout are closed
+    pool.idle_timeout = 0.01
+    time.sleep(0.02)
+    c = pool.checkout()
+    assert b.closed and c is not b
+    assert pool.stats()['reaped'] == 1 and pool.stats()['size'] == 1
+
+
+def test_insert_batches():
+    rows = [(n, 'x' * 10) for n in range(25)]
+    assert [len(b) for b in dbfile.insert_batches(iter(rows), batch_rows=10)] == [10, 10, 5]
+    # each row is about 8+13 bytes
+    assert [len(b) for b in dbfile.insert_batches(rows, batch_rows=100, batch_bytes=100)][0] == 5
+
+
+def test_bulk_insert(tmp_path):
+    db = dbfile.DBSqlite3(str(tmp_path / "test.db"), dicts=False)
+    db.create_schema("CREATE TABLE t (a INTEGER PRIMARY KEY, b TEXT CHECK (b != 'bad'))")
+    assert db.bulk_insert('t', ['a', 'b'], ((n, str(n)) for n in range(2500)), batch_rows=1000) == 2500
+    assert db.execselect("SELECT COUNT(*), SUM(a) FROM t") == (2500, sum(range(2500)))
+
+    # duplicates can be ignored
+    db.bulk_insert('t', ['a', 'b'], [(0, 'zero'), (2500, '2500')], ignore=True)
+    assert db.execselect("SELECT COUNT(*) FROM t") == (2501,)
+
+    # a batch that fails is rolled back as a unit
+    with pytest.raises(sqlite3.IntegrityError):
+        db.bulk_insert('t', ['a', 'b'], [(3000, 'good'), (3001, 'bad')])
+    assert db.execselect("SELECT COUNT(*) FROM t WHERE a>=3000") == (0,)
+
+
+def test_bulk_insert_retry(tmp_path, monkeypatch):
+    monkeypatch.setattr(dbfile, 'RETRY_DELAY_TIME', 0)
+    db = dbfile.DBSqlite3(str(tmp_path / "test.db"), dicts=False)
+    db.create_schema("CREATE TABLE t (a INTEGER, b TEXT)")
+    failures = [sqlite3.OperationalError("database is locked")]
+    insert_batch = db.insert_batch
+
+    def flaky(*args, **kwargs):
+        if failures:
+            raise failures.pop()
+        return insert_batch(*args, **kwargs)
+    db.insert_batch = flaky
+    assert db.bulk_insert('t', ['a', 'b'], [(1, 'one'), (2, 'two')]) == 2
+    assert db.execselect("SELECT COUNT(*) FROM t") == (2,)
+
+
+def test_csfr_stream(tmp_path):
+    db = dbfile.DBSqlite3(str(tmp_path / "test.db"), dicts=False)
+    db.create_schema("CREATE TABLE t (a INTEGER, b TEXT)")
+    db.bulk_insert('t', ['a', 'b'], ((n, str(n)) for n in range(25)))
+
+    rows = db.csfr_stream(None, "SELECT a, b FROM t WHERE a<%s ORDER BY a", [20], fetch_rows=7)
+    assert next(rows) == (0, '0')
+    assert len(list(rows)) == 19
+
+    names = []
+    chunks = list(db.csfr_stream(None, "SELECT a, b FROM t ORDER BY a", chunk_rows=10, asDicts=True,
+                                 get_column_names=names))
+    assert names == ['a', 'b']
+    assert [len(c) for c in chunks] == [10, 10, 5]
+    assert chunks[2][4] == {'a': 24, 'b': '24'}
+
+
+def columns_db(tmp_path):
+    db = dbfile.DBSqlite3(str(tmp_path / "test.db"), dicts=False)
+    db.create_schema("CREATE TABLE t (a INTEGER, b TEXT, c REAL, d INTEGER)")
+    db.bulk_insert('t', ['a', 'b', 'c', 'd'],
+                   ((n, ['red', 'green'][n % 2], n / 2, None if n == 5 else n) for n in range(25)))
+    return db
+
+
+def test_columns_numpy(tmp_path):
+    np = pytest.importorskip('numpy')
+    db = columns_db(tmp_path)
+    cols = db.csfr(None, "SELECT a, b, c, d FROM t ORDER BY a", format='numpy')
+    assert list(cols) == ['a', 'b', 'c', 'd']
+    assert cols['a'].dtype == np.int64 and cols['a'].sum() == sum(range(25))
+    assert cols['c'].dtype == np.float64
+    assert cols['d'].dtype == np.float64 and np.isnan(cols['d'][5])
+    assert cols['b'][0] == 'red' and cols['b'][0] is cols['b'][2]
+    assert db.execselect("SELECT a FROM t WHERE a<?", (3,), format='numpy')['a'].tolist() == [0, 1, 2]
+
+    # the columns are the same when they are built from several chunks
+    c = db.conn.execute("SELECT a, b, c, d FROM t ORDER BY a")
+    chunked = dbfile.fetch_columns(c, 'numpy', fetch_rows=4)
+    for name in cols:
+        assert np.array_equal(cols[name], chunked[name], equal_nan=(name != 'b'))
+    with pytest.raises(ValueError):
+        db.csfr(None, "SELECT a FROM t", format='csv')
+
+
+def test_columns_arrow(tmp_path):
+    pa = pytest.importorskip('pyarrow')
+    db = columns_db(tmp_path)
+    c = db.conn.execute("SELECT a, b, c, d FROM t ORDER BY a")
+    table = dbfile.fetch_columns(c, 'arrow', fetch_rows=5)
+    assert table.num_rows == 25
+    assert table.column('a').type == pa.int64()
+    assert pa.types.is_dictionary(table.column('b').type)
+    assert table.column('b').to_pylist()[0:3] == ['red', 'green', 'red']
+    assert table.column('d').null_count == 1
+
+
+class RecordingCursor:
+    def __init__(self):
+        self.executed = []
+
+    def execute(self, sql, vals=None):
+        self.executed.append(sql)
+
+
+def test_session_state():
+    # DBMySQL without a server: only the session bookkeeping is exercised
+    db = dbfile.DBMySQL.__new__(dbfile.DBMySQL)
+    db.session = {'autocommit': 1, 'time_zone': 'America/New_York'}
+    c = RecordingCursor()
+    db.set_session(c)
+    db.set_session(c, 'America/New_York')
+    assert c.executed == []
+    db.set_session(c, 'UTC')
+    db.set_session(c, 'UTC')
+    assert c.executed == ['SET @@session.time_zone = "UTC"']
+
+    # setups always run, because the query may change a variable that they set
+    c = RecordingCursor()
+    db.run_setup(c, "SET @rank=0")
+    db.run_setup(c, "SET @rank=0")
+    db.run_setup(c, "SELECT 1")
+    assert c.executed == ["SET @rank=0", "SET @rank=0", "SELECT 1"]
+
+    # a setup that may change the session makes everything be set again
+    db.session = {'autocommit': 1, 'time_zone': 'UTC'}
+    db.run_setup(c, "SET autocommit=0")
+    c = RecordingCursor()
+    db.set_session(c, 'UTC')
+    assert c.executed == ['SET autocommit=1', 'SET @@session.time_zone = "UTC"']
+
+    # and so does a query that may change it
+    db.session_changed("set time_zone='UTC'")
+    c = RecordingCursor()
+    db.set_session(c, 'UTC')
+    assert c.executed == ['SET autocommit=1', 'SET @@session.time_zone = "UTC"']
+
+
+def test_query_cache():
+    cache = dbfile.QueryCache(max_entries=2)
+    calls = []
+
+    def run(names):
+        names[:] = ['a']
+        calls.append(1)
+        return [(len(calls),)]
+    names = []
+    assert cache.cached('db', 60, "SELECT a  FROM t WHERE a=%s", [1], names, run) == [(1,)]
+    assert cache.cached('db', 60, "SELECT a FROM t\n WHERE a=%s", [1], None, run) == [(1,)]
+    assert names == ['a'] and len(calls) == 1
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+    # different parameters or a different scope are different entries; the oldest is evicted
+    cache.cached('db', 60, "SELECT a FROM t WHERE a=%s", [2], None, run)
+    cache.cached('other', 60, "SELECT a FROM t WHERE a=%s", [1], None, run)
+    assert len(calls) == 3 and cache.stats()['entries'] == 2
+
+    # writes invalidate the tables that they touch, in their own scope
+    cache.invalidate_cmd('db', "UPDATE u SET a=1")
+    cache.invalidate_cmd('db', "SELECT a FROM t")
+    assert cache.stats()['entries'] == 2
+    cache.invalidate_cmd('db', "INSERT INTO `t` (a) VALUES (%s)")
+    assert cache.stats()['entries'] == 1 and cache.stats()['invalidations'] == 1
+    cache.invalidate_cmd('other', "CALL refresh()")
+    assert cache.stats()['entries'] == 0
+
+    # entries expire after their TTL
+    cache.cached('db', 0, "SELECT a FROM t", [], None, run)
+    cache.cached('db', 0, "SELECT a FROM t", [], None, run)
+    assert len(calls) == 5
+
+    # the tables of every FROM list are found; an entry whose tables are not known is cleared by any write
+    assert dbfile.read_tables("SELECT a.x FROM a, `db`.`b` AS c JOIN d ON c.x=d.x "
+                              "WHERE a.x IN (SELECT x FROM e) ORDER BY 1") == {'a', 'b', 'd', 'e'}
+    assert dbfile.read_tables("SELECT * FROM (SELECT x FROM a) s, b") == {'a', 'b'}
+    assert dbfile.read_tables("DESC t") == {'t'}
+    assert dbfile.read_tables("SELECT * FROM (a JOIN b)") is None
+    assert dbfile.read_tables("SHOW TABLES") is None
+    cache.clear()
+    cache.cached('db', 60, "SHOW TABLES", [], None, run)
+    assert cache.stats()['entries'] == 1
+    cache.invalidate_cmd('db', "DELETE FROM u")
+    assert cache.stats()['entries'] == 0
+
+    # callers get their own copies of dictionary rows, as csfr(asDicts=True) returns them
+    def run_dicts(names):
+        return [OrderedDict([('a', 1)])]
+    rows = cache.cached('db', 60, "SELECT a FROM d", [], None, run_dicts)
+    rows[0]['a'] = 'changed'
+    rows = cache.cached('db', 60, "SELECT a FROM d", [], None, run_dicts)
+    assert rows == [{'a': 1}] and isinstance(rows[0], OrderedDict)
+    rows[0]['a'] = 'changed'
+    assert cache.cached('db', 60, "SELECT a FROM d", [], None, run_dicts) == [{'a': 1}]
+
+
+def test_csfr_cache(tmp_path):
+    db = dbfile.DBSqlite3(str(tmp_path / "test.db"), dicts=False)
+    db.create_schema("CREATE TABLE t (a INTEGER); CREATE TABLE u (a INTEGER)")
+    db.csfr(None, "INSERT INTO t (a) VALUES (%s)", [1])
+    assert db.csfr(None, "SELECT a FROM t", cache=True) == [(1,)]
+    db.conn.execute("INSERT INTO t (a) VALUES (2)")         # not seen by the cache
+    assert db.csfr(None, "SELECT a FROM t", cache=True) == [(1,)]
+    assert len(db.csfr(None, "SELECT a FROM t")) == 2
+    db.csfr(None, "INSERT INTO u (a) VALUES (%s)", [3])
+    assert db.csfr(None, "SELECT a FROM t", cache=True) == [(1,)]
+    db.csfr(None, "INSERT INTO t (a) VALUES (%s)", [3])
+    assert len(db.csfr(None, "SELECT a FROM t", cache=True)) == 3
+    db.bulk_insert('t', ['a'], [(4,)])
+    assert len(db.csfr(None, "SELECT a FROM t", cache=True)) == 4
+    assert db.query_cache.stats()['hits'] == 2
+
+    # a write to any table of a comma join invalidates it
+    assert db.csfr(None, "SELECT t.a FROM t, u WHERE t.a=u.a", cache=True) == [(3,)]
+    db.csfr(None, "INSERT INTO u (a) VALUES (%s)", [1])
+    assert sorted(db.csfr(None, "SELECT t.a FROM t, u WHERE t.a=u.a", cache=True)) == [(1,), (3,)]
+
+    # every statement that can be cached returns its rows
+    plan = db.csfr(None, "EXPLAIN SELECT a FROM t", cache=True)
+    assert plan and db.csfr(None, "EXPLAIN SELECT a FROM t", cache=True) == plan
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Benchmark ctools.s3 against the local S3 stand-in, so that the numbers can be compared between releases.
+
+It measures listing throughput, sequential and random read throughput of S3File and s3open,
+small-object latency, and upload throughput, each at several concurrency levels, and writes
+the results as JSON.
+
+Usage:
+    python tests/s3_benchmark.py --output s3_benchmark.json
+    python tests/s3_benchmark.py --quick          # small sizes, for a smoke test
+
+The stand-in runs in the same process over loopback, so the numbers measure the client's
+overhead (signing, pooling, caching, threading) rather than the network or S3 itself.
+"""
+
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../.."))
+sys.path.append(os.path.dirname(__file__))
+
+import ctools.s3 as s3
+from s3_standin import S3StandIn
+
+BUCKET = 'bench'
+MB = 1024 * 1024
+
+FULL = {'list_keys': 20000, 'read_bytes': 64 * MB, 'random_reads': 400, 'random_size': 64 * 1024,
+        'small_objects': 500, 'small_size': 1024, 'upload_bytes': 64 * MB, 'concurrency': [1, 4, 16]}
+QUICK = {'list_keys': 2000, 'read_bytes': 4 * MB, 'random_reads': 40, 'random_size': 16 * 1024,
+         'small_objects': 50, 'small_size': 1024, 'upload_bytes': 4 * MB, 'concurrency': [1, 4]}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def timed(func):
+    t0 = time.perf_counter()
+    func()
+    return time.perf_counter() - t0
+
+
+def bench_list(server, client, params):
+    for n in range(params['list_keys']):
+        server.put(BUCKET, 'list/{:03}/{:08}'.format(n % 100, n), b'')
+    ret = [{'benchmark': 'list_objects', 'concurrency': 1, 'keys': params['list_keys'],
+            'seconds': timed(lambda: sum(1 for _ in s3.list_objects(BUCKET, 'list/')))}]
+    for threads in params['concurrency']:
+        ret.append({'benchmark': 'parallel_list_objects', 'concurrency': threads, 'keys': params['list_keys'],
+                    'seconds': timed(lambda: sum(1 for _ in s3.parallel_list_objects(
+                        BUCKET, 'list/', threads=threads, client=client)))})
+    for r in ret:
+        r['keys_per_sec'] = r['keys'] / r['seconds']
+    return ret
+
+
+def bench_read(server, client, params):
+    size = params['read_bytes']
+    server.put(BUCKET, 'read/big.bin', os.urandom(size))
+    path = 's3://{}/read/big.bin'.format(BUCKET)
+    ret = []
+
+    def sequential(readahead):
+        f = s3.S3File(path, cache=s3.BlockCache(), client=client, readahead_blocks=readahead)
+        while f.read(MB):
+            pass
+        f.close()
+    for readahead in (0, s3.READAHEAD_BLOCKS):
+        ret.append({'benchmark': 'S3File sequential', 'concurrency': 1, 'readahead_blocks': readahead,
+                    'bytes': size, 'seconds': timed(lambda: sequential(readahead))})
+
+    def s3open_read(parallel, threads):
+        with s3.s3open(path, 'rb', parallel=parallel, threads=threads) as f:
+            while f.read(MB):
+                pass
+    ret.append({'benchmark': 's3open', 'concurrency': 1, 'bytes': size, 'seconds': timed(lambda: s3open_read(False, 1))})
+    for threads in params['concurrency']:
+        ret.append({'benchmark': 's3open parallel', 'concurrency': threads, 'bytes': size,
+                    'seconds': timed(lambda: s3open_read(True, threads))})
+
+    rng = random.Random(1)
+    offsets = [rng.randrange(0, size - params['random_size']) for _ in range(params['random_reads'])]
+    for threads in params['concurrency']:
+        f = s3.S3File(path, block_size=params['random_size'], cache=s3.BlockCache(), client=client,
+                      readahead_blocks=0)
+
+        def read_at(offset):
+            return len(f.view(offset, params['random_size']))
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            seconds = timed(lambda: list(pool.map(read_at, offsets)))
+        ret.append({'benchmark': 'S3File random', 'concurrency': threads, 'reads': len(offsets),
+                    'bytes': len(offsets) * params['random_size'], 'seconds': seconds,
+                    'reads_per_sec': len(offsets) / seconds})
+    for r in ret:
+        r['MBps'] = r['bytes'] / MB / r['seconds']
+    return ret
+
+
+def bench_small(server, client, params):
+    keys = ['small/{:06}'.format(n) for n in range(params['small_objects'])]
+    data = os.urandom(params['small_size'])
+    for key in keys:
+        server.put(BUCKET, key, data)
+    ret = []
+    for (name, op) in (('head_object', lambda key: client.head_object(BUCKET, key)),
+                       ('get_object', lambda key: client.get_range(BUCKET, key, 0, len(data)))):
+        for threads in params['concurrency']:
+            latencies = []
+            lock = threading.Lock()
+
+            def run(key):
+                t0 = time.perf_counter()
+                op(key)
+                with lock:
+                    latencies.append(time.perf_counter() - t0)
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                seconds = timed(lambda: list(pool.map(run, keys)))
+            ret.append({'benchmark': 'small ' + name, 'concurrency': threads, 'requests': len(keys),
+                        'seconds': seconds, 'requests_per_sec': len(keys) / seconds,
+                        'p50_ms': percentile(latencies, 50) * 1000, 'p99_ms': percentile(latencies, 99) * 1000})
+    return ret
+
+
+def bench_upload(server, client, params):
+    data = os.urandom(params['upload_bytes'])
+    ret = []
+    for threads in params['concurrency']:
+        def upload():
+            with s3.S3MultipartWriter('s3://{}/upload/{}'.format(BUCKET, threads), threads=threads,
+                                      client=client) as f:
+                for i in range(0, len(data), MB):
+                    f.write(data[i:i + MB])
+        seconds = timed(upload)
+        ret.append({'benchmark': 'S3MultipartWriter', 'concurrency': threads, 'bytes': len(data),
+                    'seconds': seconds, 'MBps': len(data) / MB / seconds})
+    return ret
+
+
+BENCHMARKS = [bench_list, bench_read, bench_small, bench_upload]
+
+
+def run_benchmarks(params):
+    """Start a stand-in, run every benchmark against it, and return the results as a dictionary"""
+    server = S3StandIn().start()
+    client = s3.s3client.S3Client(endpoint_url=server.url, anonymous=True)
+    old = s3.s3client.set_default_client(client)
+    try:
+        results = []
+        for bench in BENCHMARKS:
+            results += bench(server, client, params)
+    finally:
+        s3.s3client.set_default_client(old)
+        client.close()
+        server.stop()
+    return {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'params': params,
+            'results': results}
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter,
+                            description="Benchmark ctools.s3 against a local S3 stand-in.")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--quick", action='store_true', help="use small sizes, for a smoke test")
+    parser.add_argument("--concurrency", help="comma-separated concurrency levels")
+    args = parser.parse_args()
+
+    params = dict(QUICK if args.quick else FULL)
+    if args.concurrency:
+        params['concurrency'] = [int(c) for c in args.concurrency.split(',')]
+    report = run_benchmarks(params)
+    for r in report['results']:
+        rate = next(("{:,.1f} {}".format(r[k], k) for k in ('MBps', 'keys_per_sec', 'requests_per_sec') if k in r), '')
+        print("{:28} x{:<3} {:8.3f}s  {}".format(r['benchmark'], r['concurrency'], r['seconds'], rate),
+              file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+A minimal in-memory S3-compatible server for testing the in-process S3 client.
+It implements just enough of the S3 REST API (path-style addressing, no authentication)
+to exercise ctools.s3 without AWS.
+
+Usage:
+    server = S3StandIn().start()
+    client = S3Client(endpoint_url=server.url, anonymous=True)
+    ...
+    server.stop()
+"""
+
+import base64
+import email.utils
+import hashlib
+import itertools
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, unquote, parse_qsl
+
+
+class S3Object:
+    def __init__(self, data, metadata=None, etag=None):
+        self.data = bytes(data)
+        self.etag = etag or hashlib.md5(self.data).hexdigest()
+        self.last_modified = time.time()
+        self.metadata = metadata or {}
+
+
+class S3StandIn:
+    def __init__(self, host='127.0.0.1', port=0):
+        self.buckets = defaultdict(dict)
+        self.lock = threading.Lock()
+        self.requests = []          # (method, path, range) for every request received
+        self.uploads = {}           # upload_id -> (bucket, key, metadata, {part_number: data})
+        self.upload_ids = itertools.count(1)
+        self.min_part_size = 0      # S3 requires 5 MiB for all but the last part; tests may set a smaller value
+        self.delete_failures = {}   # key -> number of times that DeleteObjects should fail to delete it
+        self.slowdowns = 0          # number of requests to answer with 503 SlowDown
+        standin = self
+
+        class Handler(S3Handler):
+            server_state = standin
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = "http://{}:{}".format(*self.httpd.server_address)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def put(self, bucket, key, data, metadata=None, etag=None):
+        with self.lock:
+            self.buckets[bucket][key] = S3Object(data, metadata, etag)
+        return self.buckets[bucket][key]
+
+    def get(self, bucket, key):
+        return self.buckets[bucket][key].data
+
+    def count(self, method):
+        return len([r for r in self.requests if r[0] == method])
+
+
+class S3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True      # headers and body are separate writes; don't wait for a delayed ACK
+    server_state = None
+
+    def log_message(self, *args):
+        pass
+
+    def _parse(self):
+        p = urlparse(self.path)
+        (bucket, _, key) = p.path[1:].partition('/')
+        self.bucket = unquote(bucket)
+        self.key = unquote(key)
+        self.query = dict(parse_qsl(p.query, keep_blank_values=True))
+        length = int(self.headers.get('Content-Length', 0))
+        self.body = self.rfile.read(length) if length else b''
+        self.server_state.requests.append((self.command, self.path, self.headers.get('Range')))
+        with self.server_state.lock:
+            if self.server_state.slowdowns > 0:
+                self.server_state.slowdowns -= 1
+                self._error(503, 'SlowDown')
+                return True
+        return False
+
+    def _send(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for (k, v) in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _error(self, status, code):
+        body = "<?xml version='1.0'?><Error><Code>{}</Code><Message>{}</Message></Error>".format(code, self.path)
+        self._send(status, body.encode('utf-8'), {'Content-Type': 'application/xml'})
+
+    def _object(self):
+        obj = self.server_state.buckets.get(self.bucket, {}).get(self.key)
+        if obj is None:
+            self._error(404, 'NoSuchKey')
+        return obj
+
+    @staticmethod
+    def _object_headers(obj):
+        headers = {'ETag': '"{}"'.format(obj.etag),
+                   'Last-Modified': email.utils.formatdate(obj.last_modified, usegmt=True),
+                   'Content-Type': 'binary/octet-stream'}
+        for (k, v) in obj.metadata.items():
+            headers['x-amz-meta-' + k] = v
+        return headers
+
+    def do_HEAD(self):
+        if self._parse():
+            return
+        obj = self._object()
+        if obj:
+            headers = self._object_headers(obj)
+            self.send_response(200)
+            for (k, v) in headers.items():
+                self.send_header(k, v)
+            self.send_header('Content-Length', str(len(obj.data)))
+            self.end_headers()
+
+    def _list(self):
+        q = self.query
+        prefix = q.get('prefix', '')
+        delimiter = q.get('delimiter')
+        max_keys = int(q.get('max-keys', 1000))
+        after = q.get('continuation-token') or q.get('start-after') or ''
+        objects = self.server_state.buckets.get(self.bucket, {})
+        root = ET.Element('ListBucketResult')
+        count = 0
+        last = None
+        truncated = False
+        for key in sorted(objects, key=lambda k: k.encode('utf-8')):
+            if not key.startswith(prefix) or key.encode('utf-8') <= after.encode('utf-8'):
+                continue
+            if delimiter and delimiter in key[len(prefix):]:
+                common = key[0:key.index(delimiter, len(prefix)) + len(delimiter)]
+                if last is not None and last == common:
+                    continue
+                if count == max_keys:
+                    truncated = True
+                    break
+                ET.SubElement(ET.SubElement(root, 'CommonPrefixes'), 'Prefix').text = common
+                # the continuation token skips everything under the common prefix
+                last = common
+                after_key = common + '\U0010ffff'
+            else:
+                if count == max_keys:
+                    truncated = True
+                    break
+                obj = objects[key]
+                contents = ET.SubElement(root, 'Contents')
+                ET.SubElement(contents, 'Key').text = key
+                ET.SubElement(contents, 'LastModified').text = time.strftime(
+                    '%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(obj.last_modified))
+                ET.SubElement(contents, 'ETag').text = '"{}"'.format(obj.etag)
+                ET.SubElement(contents, 'Size').text = str(len(obj.data))
+                ET.SubElement(contents, 'StorageClass').text = 'STANDARD'
+                last = key
+                after_key = key
+            count += 1
+        ET.SubElement(root, 'KeyCount').text = str(count)
+        ET.SubElement(root, 'IsTruncated').text = 'true' if truncated else 'false'
+        if truncated:
+            ET.SubElement(root, 'NextContinuationToken').text = after_key
+        self._xml(root)
+
+    def do_GET(self):
+        if self._parse():
+            return
+        if self.key == '':
+            return self._list()
+        obj = self._object()
+        if obj is None:
+            return
+        if_match = self.headers.get('If-Match')
+        if if_match and if_match.strip('"') != obj.etag:
+            return self._error(412, 'PreconditionFailed')
+        headers = self._object_headers(obj)
+        rng = self.headers.get('Range')
+        if rng:
+            (start, _, end) = rng.split('=')[1].partition('-')
+            start = int(start)
+            end = min(int(end), len(obj.data) - 1) if end else len(obj.data) - 1
+            if start >= len(obj.data):
+                return self._error(416, 'InvalidRange')
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, len(obj.data))
+            return self._send(206, obj.data[start:end + 1], headers)
+        self._send(200, obj.data, headers)
+
+    def _metadata(self):
+        return {k[11:].lower(): v for (k, v) in self.headers.items() if k.lower().startswith('x-amz-meta-')}
+
+    def _xml(self, root):
+        self._send(200, ET.tostring(root), {'Content-Type': 'application/xml'})
+
+    def do_PUT(self):
+        if self._parse():
+            return
+        state = self.server_state
+        content_md5 = self.headers.get('Content-MD5')
+        if content_md5 and base64.b64decode(content_md5) != hashlib.md5(self.body).digest():
+            return self._error(400, 'BadDigest')
+        if 'uploadId' in self.query:
+            if self.query['uploadId'] not in state.uploads:
+                return self._error(404, 'NoSuchUpload')
+            source = self.headers.get('x-amz-copy-source')
+            if source:
+                (bucket, _, key) = unquote(source).lstrip('/').partition('/')
+                obj = state.buckets.get(bucket, {}).get(key)
+                if obj is None:
+                    return self._error(404, 'NoSuchKey')
+                data = obj.data
+                rng = self.headers.get('x-amz-copy-source-range')
+                if rng:
+                    (start, _, end) = rng.split('=')[1].partition('-')
+                    data = data[int(start):int(end) + 1]
+            else:
+                data = self.body
+            state.uploads[self.query['uploadId']][3][int(self.query['partNumber'])] = data
+            etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+            if source:
+                root = ET.Element('CopyPartResult')
+                ET.SubElement(root, 'ETag').text = etag
+                return self._xml(root)
+            return self._send(200, b'', {'ETag': etag})
+        source = self.headers.get('x-amz-copy-source')
+        if source:
+            (bucket, _, key) = unquote(source).lstrip('/').partition('/')
+            src = state.buckets.get(bucket, {}).get(key)
+            if src is None:
+                return self._error(404, 'NoSuchKey')
+            replace = self.headers.get('x-amz-metadata-directive') == 'REPLACE'
+            obj = state.put(self.bucket, self.key, src.data, self._metadata() if replace else dict(src.metadata))
+            root = ET.Element('CopyObjectResult')
+            ET.SubElement(root, 'ETag').text = '"{}"'.format(obj.etag)
+            return self._xml(root)
+        obj = state.put(self.bucket, self.key, self.body, self._metadata())
+        self._send(200, b'', {'ETag': '"{}"'.format(obj.etag)})
+
+    def do_POST(self):
+        if self._parse():
+            return
+        state = self.server_state
+        if 'uploads' in self.query:
+            upload_id = str(next(state.upload_ids))
+            state.uploads[upload_id] = (self.bucket, self.key, self._metadata(), {})
+            root = ET.Element('InitiateMultipartUploadResult')
+            ET.SubElement(root, 'UploadId').text = upload_id
+            return self._xml(root)
+        if 'delete' in self.query:
+            root = ET.Element('DeleteResult')
+            with state.lock:
+                for key in [e.text for e in ET.fromstring(self.body).iter('Key')]:
+                    if state.delete_failures.get(key):
+                        state.delete_failures[key] -= 1
+                        error = ET.SubElement(root, 'Error')
+                        ET.SubElement(error, 'Key').text = key
+                        ET.SubElement(error, 'Code').text = 'InternalError'
+                        ET.SubElement(error, 'Message').text = 'injected failure'
+                    else:
+                        state.buckets[self.bucket].pop(key, None)
+            return self._xml(root)
+        if 'uploadId' in self.query:
+            if self.query['uploadId'] not in state.uploads:
+                return self._error(404, 'NoSuchUpload')
+            (bucket, key, metadata, parts) = state.uploads.pop(self.query['uploadId'])
+            numbers = [int(e.text) for e in ET.fromstring(self.body).iter('PartNumber')]
+            if numbers != sorted(numbers) or any(n not in parts for n in numbers):
+                return self._error(400, 'InvalidPart')
+            if any(len(parts[n]) < state.min_part_size for n in numbers[0:-1]):
+                return self._error(400, 'EntityTooSmall')
+            digests = b''.join(hashlib.md5(parts[n]).digest() for n in numbers)
+            etag = "{}-{}".format(hashlib.md5(digests).hexdigest(), len(numbers))
+            state.put(bucket, key, b''.join(parts[n] for n in numbers), metadata, etag)
+            root = ET.Element('CompleteMultipartUploadResult')
+            ET.SubElement(root, 'Location').text = self.path
+            ET.SubElement(root, 'ETag').text = '"{}"'.format(etag)
+            return self._xml(root)
+        self._error(400, 'InvalidRequest')
+
+    def do_DELETE(self):
+        if self._parse():
+            return
+        if 'uploadId' in self.query:
+            self.server_state.uploads.pop(self.query['uploadId'], None)
+            return self._send(204)
+        with self.server_state.lock:
+            self.server_state.buckets[self.bucket].pop(self.key, None)
+        self._send(204)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# Test the S3 listing index against a local S3-compatible server
+
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.append( os.path.join( os.path.dirname(__file__), "../..") )
+
+import ctools.s3 as s3
+import ctools.s3index as s3index
+from s3_standin import S3StandIn
+
+
+@pytest.fixture
+def standin():
+    server = S3StandIn().start()
+    client = s3.s3client.S3Client(endpoint_url=server.url, anonymous=True)
+    old = s3.s3client.set_default_client(client)
+    yield server
+    s3.s3client.set_default_client(old)
+    client.close()
+    server.stop()
+
+
+def test_s3index(standin, tmp_path):
+    server = standin
+    for part in range(3):
+        for i in range(5):
+            server.put('bucket', 'out/part={}/file-{}'.format(part, i), b'x' * 10)
+        server.put('bucket', 'out/part={}/_SUCCESS'.format(part), b'')
+    server.put('bucket', 'out/nomarker/file', b'y' * 7)
+    server.put('bucket', 'out/README', b'z')
+
+    with s3index.S3Index(str(tmp_path / 'index.db')) as index:
+        res = index.refresh('s3://bucket/out/')
+        assert res['listed'] == 5 and res['keys'] == 20
+        assert index.sum_object_sizes('bucket', 'out/') == 158
+        assert index.object_sizes('bucket', 'out/part=1/') == [0] + [10] * 5
+        assert len(index.search_objects('bucket', 'out/', name='_SUCCESS')) == 3
+        assert index.exists('s3://bucket/out/part=2/file-4')
+        assert not index.exists('s3://bucket/out/part=2/file-5')
+
+        # Rewrite one partition, add one, and remove one
+        server.put('bucket', 'out/part=1/file-5', b'x')
+        time.sleep(1.1)
+        server.put('bucket', 'out/part=1/_SUCCESS', b'')
+        server.put('bucket', 'out/part=3/_SUCCESS', b'')
+        for key in [key for key in server.buckets['bucket'] if key.startswith('out/part=2/')]:
+            del server.buckets['bucket'][key]
+        res = index.refresh('bucket', 'out/')
+        assert res == {'listed': 4, 'skipped': 1, 'removed': 1, 'keys': 10}
+        assert index.exists('s3://bucket/out/part=1/file-5')
+        assert not index.exists('s3://bucket/out/part=2/file-4')
+        assert [obj['Key'] for obj in index.list_objects('bucket', 'out/part=3')] == ['out/part=3/_SUCCESS']
+
+
+def test_s3index_whole_bucket(standin, tmp_path):
+    server = standin
+    server.put('bucket', 'a/_SUCCESS', b'')
+    server.put('bucket', 'a/file', b'x' * 3)
+    server.put('bucket', 'top', b'y')
+
+    with s3index.S3Index(str(tmp_path / 'index.db')) as index:
+        assert index.refresh('bucket') == {'listed': 2, 'skipped': 0, 'removed': 0, 'keys': 3}
+        assert index.sum_object_sizes('bucket', '') == 4
+
+        # the shards are found again under the bucket's root
+        server.put('bucket', 'b/_SUCCESS', b'')
+        assert index.refresh('bucket') == {'listed': 2, 'skipped': 1, 'removed': 0, 'keys': 2}
+        assert index.exists('s3://bucket/b/_SUCCESS')